@@ -1,75 +1,398 @@
 #Final Project GUI
 import tkinter as tk
 from tkinter import ttk, filedialog
+from tkinter import font as tkfont
 import ds_messenger as ds
+import ds_store
+import ds_failover
+import ds_token_cache
+import ds_poller
+import ds_outbox
+import ds_roster
+import ds_profiler
 from tkinter.simpledialog import askstring # https://docs.python.org/3/library/dialog.html
+import argparse
+import os
 import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackgroundWorker:
+    """
+    Runs network calls on a background executor so the Tk main thread never waits on the DS server. Results are put
+    on a thread-safe queue that is drained on the main thread with root.after, where their callbacks are run.
+    Local work, such as searching the message store, runs on an executor of its own, so it never waits behind a
+    slow network call.
+    """
+    def __init__(self, root, max_workers:int=1, poll_ms:int=50):
+        """
+        initializer for BackgroundWorker.
+
+        :param root: the Tk root window whose event loop runs the callbacks.  
+        :param max_workers: the number of worker threads for network calls. One worker keeps sends in the order
+                            they were made.  
+        :param poll_ms: how often, in milliseconds, finished calls are checked for.
+        """
+        self.root = root
+        self.poll_ms = poll_ms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ds-network')
+        self._local = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ds-local')
+        self._results = queue.Queue()
+        self._closed = False
+        self.root.after(self.poll_ms, self._drain)
+
+    def submit(self, fn, *args, on_done=None, local=False):
+        """
+        Runs fn(*args) on a worker thread. on_done(result, error) is then called on the main thread, with error set
+        to the exception fn raised, if any. local=True runs it on the thread for local work instead of behind the
+        network calls.
+        """
+        def run():
+            try:
+                result = fn(*args)
+            except Exception as e:
+                self._results.put((on_done, None, e))
+            else:
+                self._results.put((on_done, result, None))
+        return (self._local if local else self._executor).submit(run)
+
+    def call(self, fn, *args):
+        """
+        Runs fn(*args) on the main thread. Safe to call from any thread.
+        """
+        self._results.put((lambda result, error: fn(*args), None, None))
+
+    def shutdown(self):
+        """
+        Stops the workers, dropping calls that have not started.
+        """
+        self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._local.shutdown(wait=False, cancel_futures=True)
+
+    def _drain(self):
+        while True:
+            try:
+                on_done, result, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if on_done is not None:
+                # timed on its own when the GUI is profiled
+                ds_profiler.run(on_done, result, error)
+        if not self._closed:
+            self.root.after(self.poll_ms, self._drain)
+
+
+class Poller:
+    """
+    Polls the DS server for new messages on the BackgroundWorker whenever its PollScheduler says a poll is due, and
+    hands the new messages to the scheduler's subscribers. A poll never starts while the previous one is running.
+    """
+    def __init__(self, root, worker, poll, scheduler=None, on_error=None):
+        """
+        initializer for Poller.
+
+        :param root: the Tk root window whose event loop times the polls.  
+        :param worker: the BackgroundWorker that runs the polls.  
+        :param poll: the function that polls, returning the new messages or False.  
+        :param scheduler: the ds_poller.PollScheduler deciding when to poll, a new one if None.  
+        :param on_error: called with the exception, or None, when a poll fails.
+        """
+        self.root = root
+        self.worker = worker
+        self.poll = poll
+        self.scheduler = ds_poller.PollScheduler() if scheduler is None else scheduler
+        self.on_error = on_error
+        self._after = None
+        self._stopped = True
+
+    def start(self):
+        """
+        Starts polling, with the first poll right away.
+        """
+        self._stopped = False
+        self._schedule()
+
+    def stop(self):
+        """
+        Stops polling. A poll already running still delivers its messages.
+        """
+        self._stopped = True
+        if self._after is not None:
+            self.root.after_cancel(self._after)
+            self._after = None
+
+    def activity(self):
+        """
+        Polls soon, because the user did something that makes new messages likely.
+        """
+        self.scheduler.activity()
+        if not self.scheduler.polling:
+            self._schedule()
+
+    def _schedule(self):
+        if self._stopped:
+            return
+        if self._after is not None:
+            self.root.after_cancel(self._after)
+        self._after = self.root.after(int(self.scheduler.delay() * 1000), self._poll)
+
+    def _poll(self):
+        self._after = None
+        if self.scheduler.begin():
+            self.worker.submit(self.poll, on_done=self._polled)
+
+    def _polled(self, result, error):
+        if error is not None or result is False:
+            self.scheduler.finish(False)
+            if self.on_error is not None:
+                self.on_error(error)
+        else:
+            self.scheduler.finish(result)
+        self._schedule()
 
 
 class Body(tk.Frame):
     """
     The body part of the GUI. Includes a treeview widget displaying the usernames of the user's friends, a history message widget displaying the messages the user's friends
     have sent to the user, and a entry widget allowing the user to enter message he/she want to send to his/her friends.
+
+    The messages of each sender are kept formatted in an index that grows as messages arrive, so switching to a
+    conversation only renders the most recent window of it, and older windows are rendered when the user scrolls up.
+    Conversations are read from the store a page at a time, starting from the most recent, so how fast the window
+    opens does not depend on the size of the history.
+
+    The users are kept in a ds_roster.Roster with their unread messages and last activity, and the treeview only
+    holds the rows that fit in it, keyed by username. Scrolling the treeview redraws those rows from the roster.
     """
-    def __init__(self, root, current_user=None):
+    # how many messages of a conversation are rendered at a time
+    WINDOW = 500
+
+    def __init__(self, root, current_user=None, worker=None, poller=None):
         """
         initializer for Body of the GUI.
 
-        :param current_user: the user who are using the GUI to send and receive messages.
+        :param current_user: the user who are using the GUI to send and receive messages.  
+        :param worker: the BackgroundWorker that runs network calls.  
+        :param poller: the Poller that brings new messages.
         """
         tk.Frame.__init__(self,root)
         self.root = root
         self.current_user = current_user
-        self._messages = []
-        self._users = []
-        self.index = None
-        try:
-            self.entry = self.current_user.retrieve_all()
-        except ds.FailToJoin:
-            # Toplevel object which will be treated as a new window 
-            closeWindow = tk.Toplevel(self.root)
-            closeWindow.title("Wrong Log In!!")
-            closeWindow.geometry("300x200")
-
-            login_frame = tk.Frame(master=closeWindow, bg="")
-            login_frame.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
-        
-            editor_frame = tk.Frame(master=login_frame, bg="red")
-            editor_frame.pack(fill=tk.BOTH, side=tk.LEFT, expand=True)
-        
-        
-            login_editor = tk.Text(editor_frame, width=0)
-            login_editor.pack(fill=tk.BOTH, side=tk.LEFT, expand=True, padx=0, pady=0)
+        self.worker = worker
+        self.poller = poller
+        self.roster = ds_roster.Roster()
+        # the user selected in the treeview, who may be scrolled out of it
+        self.selected = None
+        # the position in the roster of the first row in the treeview, and how many rows fit in it
+        self._roster_top = 0
+        self._roster_rows = 20
+        self._roster_pending = False
+        # sender -> formatted lines of their most recent messages, filled from the store a page at a time
+        self._conversations = {}
+        # sender -> where the page before their loaded lines starts in the store, None once all are loaded
+        self._cursors = {}
+        self._shown_user = None
+        self._shown_from = 0
+        self.store = self.current_user.store
+        # draw the history already in the local store, then show what the poller brings as it arrives
+        self._draw()
+        self.poller.scheduler.subscribe(self.add_messages)
+        self.poller.on_error = self._poll_failed
 
-            login_editor.insert(0.0, "Failed to Log in. The password is incorrect. Please close all the windows and start over.\n")
+    def _poll_failed(self, error):
+        """
+        Shows the log in failure, or reports a poll that did not reach the server.
+        """
+        if isinstance(error, ds.FailToJoin):
+            self.poller.stop()
+            self.show_login_failed()
         else:
-            self._draw()
+            print("Fail to sync messages with the server.")
+
+    def add_messages(self, messages):
+        """
+        Adds newly arrived messages to the index, the roster and, if their conversation is shown, the end of the
+        history message widget. Messages of conversations that are not shown count as unread.
+
+        :param messages: DirectMessage objects, oldest first.
+        """
+        for dm in messages:
+            sender = dm['recipient']
+            self.roster.message(sender, float(dm['timestamp']), unread=sender != self._shown_user)
+            lines = self._conversations.get(sender)
+            if lines is None:
+                # not shown yet, it will be loaded from the store
+                continue
+            line = self._format_message(dm)
+            if sender == self._shown_user:
+                if not lines:
+                    self.message_reader.delete(0.0, 'end')
+                self.message_reader.insert('end', line)
+            lines.append(line)
+        self._schedule_roster()
+
+    def show_login_failed(self):
+        """
+        Opens a window telling the user the log in failed.
+        """
+        # Toplevel object which will be treated as a new window 
+        closeWindow = tk.Toplevel(self.root)
+        closeWindow.title("Wrong Log In!!")
+        closeWindow.geometry("300x200")
+
+        login_frame = tk.Frame(master=closeWindow, bg="")
+        login_frame.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
+    
+        editor_frame = tk.Frame(master=login_frame, bg="red")
+        editor_frame.pack(fill=tk.BOTH, side=tk.LEFT, expand=True)
+    
+    
+        login_editor = tk.Text(editor_frame, width=0)
+        login_editor.pack(fill=tk.BOTH, side=tk.LEFT, expand=True, padx=0, pady=0)
+
+        login_editor.insert(0.0, "Failed to Log in. The password is incorrect. Please close all the windows and start over.\n")
         
 
     def node_select(self, event):
         """
         Detects which friend has been chosen by the user and will display the message this friend has sent to the user.
         """
-        self.index = int(self.user_tree.selection()[0])-1
-        from_user = self._users[self.index]
-        self.set_history_message(self.entry, from_user)
+        selection = self.user_tree.selection()
+        if not selection:
+            # the selected row was scrolled out of the treeview
+            return
+        from_user = selection[0]
+        if from_user == self.selected:
+            # reselected after being redrawn
+            return
+        self.selected = from_user
+        self.show_conversation(from_user)
+
+    def show_conversation(self, from_user:str):
+        """
+        Displays the most recent messages from a user, taking them from the index.
+
+        :param from_user: The username that the user choose to check for history messages.
+        """
+        lines = self._conversations.get(from_user)
+        if lines is None:
+            page, self._cursors[from_user] = self.store.page(from_user, limit=self.WINDOW)
+            lines = [self._format_message(dm) for dm in page]
+            self._conversations[from_user] = lines
+        self._shown_user = from_user
+        self.roster.mark_read(from_user)
+        self._schedule_roster()
+        self._shown_from = max(0, len(lines) - self.WINDOW)
+        self.message_reader.delete(0.0, 'end')
+        if not lines:
+            self.message_reader.insert(0.0, "No old messages. Start communicating.\n")
+        else:
+            self.message_reader.insert('end', ''.join(lines[self._shown_from:]))
+            self.message_reader.see('end')
+
+    def _show_older(self):
+        """
+        Renders the window of messages before the ones displayed, keeping the view where it was. Messages that
+        have not been loaded yet are read from the store first.
+        """
+        if self._shown_user is None or not self._has_older() or self.message_reader.yview()[0] > 0:
+            return
+        lines = self._conversations[self._shown_user]
+        if self._shown_from == 0:
+            page, self._cursors[self._shown_user] = self.store.page(self._shown_user,
+                                                                     self._cursors[self._shown_user], self.WINDOW)
+            lines[:0] = [self._format_message(dm) for dm in page]
+            self._shown_from = len(page)
+            if not page:
+                return
+        start = max(0, self._shown_from - self.WINDOW)
+        self.message_reader.insert('1.0', ''.join(lines[start:self._shown_from]))
+        self.message_reader.yview(str(self._shown_from - start + 1) + '.0')
+        self._shown_from = start
+
+    def _reader_scrolled(self, first, last):
+        """
+        Updates the scrollbar of the history message widget, rendering older messages when it reaches the top.
+        """
+        self.message_reader_scrollbar.set(first, last)
+        if float(first) == 0.0 and self._has_older():
+            self.after_idle(self._show_older)
+
+    def _has_older(self) -> bool:
+        """
+        True if the shown conversation has messages before the ones displayed.
+        """
+        if self._shown_user is None:
+            return False
+        return self._shown_from > 0 or self._cursors.get(self._shown_user) is not None
+
+    def search(self, event=None):
+        """
+        Searches the stored messages for the words in the search box, in the background. A word like from:name
+        only searches the messages of that user.
+        """
+        words = self.search_entry.get().split()
+        sender = None
+        for word in words:
+            if word.startswith('from:') and len(word) > 5:
+                sender = word[5:]
+        text = ' '.join(word for word in words if not word.startswith('from:'))
+        if not text and sender is None:
+            return
+        # searching the store takes milliseconds, so it does not wait behind a sync or a send
+        self.worker.submit(self.store.search, text, sender, local=True,
+                           on_done=lambda result, error: self.show_search_results(text, result, error))
+
+    def show_search_results(self, text:str, results, error=None):
+        """
+        Displays the messages found by search in the history message widget.
+
+        :param text: The words that were searched for.  
+        :param results: The MessageBatch search found.  
+        :param error: The exception the search raised, if any.
+        """
+        self._clear_selection()
+        self._shown_user = None
+        self._shown_from = 0
+        self.message_reader.delete(0.0, 'end')
+        if error is not None:
+            self.message_reader.insert(0.0, "The search failed: " + str(error) + "\n")
+            return
+        self.message_reader.insert('end', str(len(results)) + " messages found for \"" + text + "\":\n\n")
+        self.message_reader.insert('end', ''.join(self._format_message(dm) for dm in results))
+        self.message_reader.see('end')
+
+    def _clear_selection(self):
+        """
+        Forgets the selected user once their conversation is no longer displayed, so selecting them again shows it.
+        """
+        self.selected = None
+        selection = self.user_tree.selection()
+        if selection:
+            self.user_tree.selection_remove(*selection)
+
+    def _format_message(self, dm) -> str:
+        """
+        Returns a message as a line of the history message widget.
+        """
+        # localtime() from https://docs.python.org/3/library/time.html#time.localtime
+        # and https://overiq.com/python-3-time-module/
+        ltime = time.localtime(float(dm['timestamp']))
+        local_time = str(ltime.tm_mon) + '/' + str(ltime.tm_mday) + '/' + str(ltime.tm_year) + ' at '\
+                     + str(ltime.tm_hour) + ':' + str(ltime.tm_min) + ':' + str(ltime.tm_sec)
+        return local_time + ": " + dm['recipient'] + ": " + dm['message'] + "\n"
 
 
     def set_users(self):
         """
-        insert the username of the current user's friend list into the treeview widget in order.
-        """
-        id = 1
-        # update the add_user widget.
-        for DirectMessage in self.entry:
-            # add all senders in to a list
-            if DirectMessage['recipient'] not in self._users:
-                self._users.append(DirectMessage['recipient'])
-        # displays all of the DS users that have sent you messages
-        for sender in self._users:
-            self._insert_user_tree(id, sender)
-            id += 1
-            
+        Puts the users who have sent messages into the roster, with their number of messages and last activity
+        from the store, and draws the rows that fit in the treeview.
+        """
+        for sender, count, last_timestamp in self.store.sender_activity():
+            self.roster.add(sender, count, last_timestamp)
+        self._draw_roster()
 
     def insert_user(self, user: str):
         """
@@ -77,18 +400,117 @@ class Body(tk.Frame):
 
         :param user: the username of the friend wanted to be added into the tree widget.
         """
-        self._users.append(user)
-        self._insert_user_tree(len(self._users), user)
+        if self.roster.add(user):
+            self._schedule_roster()
+
+    def sort_users(self, order:str):
+        """
+        Sorts the treeview by ds_roster.ACTIVITY, NAME or ADDED and scrolls it to the top.
+
+        :param order: the order to sort in.
+        """
+        self.roster.set_order(order)
+        self._roster_top = 0
+        self._draw_roster()
+
+    def _schedule_roster(self):
+        """
+        Redraws the treeview once the pending events are handled, so a batch of messages only redraws it once.
+        """
+        if not self._roster_pending:
+            self._roster_pending = True
+            self.after_idle(self._draw_roster)
+
+    def _draw_roster(self):
+        """
+        Shows the rows of the roster that fit in the treeview, from the row it is scrolled to. Rows already in the
+        treeview are updated and moved rather than inserted again, so the selection stays on them.
+        """
+        self._roster_pending = False
+        total = len(self.roster)
+        self._roster_top = max(0, min(self._roster_top, total - self._roster_rows))
+        users = self.roster.rows(self._roster_top, self._roster_top + self._roster_rows)
+        shown = set(users)
+        tree = self.user_tree
+        stale = [iid for iid in tree.get_children() if iid not in shown]
+        if stale:
+            tree.delete(*stale)
+        for position, user in enumerate(users):
+            name = user
+            if len(name) > 25:
+                name = name[:24] + "..."
+            unread = self.roster.unread(user)
+            values = (unread or '', self._format_activity(self.roster.last_activity(user)))
+            tags = ('unread',) if unread else ()
+            if tree.exists(user):
+                tree.item(user, text=name, values=values, tags=tags)
+                tree.move(user, '', position)
+            else:
+                tree.insert('', position, user, text=name, values=values, tags=tags)
+        if self.selected in shown and tree.selection() != (self.selected,):
+            tree.selection_set(self.selected)
+        if total:
+            self.user_tree_scrollbar.set(self._roster_top / total, (self._roster_top + len(users)) / total)
+        else:
+            self.user_tree_scrollbar.set(0.0, 1.0)
+
+    def _roster_yview(self, *args):
+        """
+        Scrolls the treeview through the roster, called by its scrollbar as a Tk yview command.
+        """
+        if args[0] == 'moveto':
+            self._roster_top = int(float(args[1]) * len(self.roster))
+        elif args[0] == 'scroll':
+            step = self._roster_rows if args[2] == 'pages' else 1
+            self._roster_top += int(args[1]) * step
+        self._draw_roster()
+
+    def _roster_wheel(self, event):
+        """
+        Scrolls the treeview with the mouse wheel.
+        """
+        up = event.num == 4 or event.delta > 0
+        self._roster_yview('scroll', -3 if up else 3, 'units')
+        return 'break'
 
-    def _insert_user_tree(self, id, username):
-        '''
-        insert the username to the user_tree
-        '''
-        name = username
-        if len(name) > 25:
-            name = name[:24] + "..."
+    def _roster_key(self, event, step:int):
+        """
+        Moves the selection up or down a row with the arrow keys, scrolling the treeview when it leaves it.
+        """
+        position = self.roster.index(self.selected) + step if self.selected in self.roster else 0
+        position = max(0, min(position, len(self.roster) - 1))
+        if position < self._roster_top:
+            self._roster_top = position
+        elif position >= self._roster_top + self._roster_rows:
+            self._roster_top = position - self._roster_rows + 1
+        users = self.roster.rows(position, position + 1)
+        if users:
+            self.selected = None
+            self._draw_roster()
+            self.user_tree.selection_set(users[0])
+            self.user_tree.focus(users[0])
+        return 'break'
 
-        self.user_tree.insert('', id, id, text=name)
+    def _roster_resized(self, event):
+        """
+        Redraws the treeview with as many rows as fit in its new height.
+        """
+        rowheight = ttk.Style().lookup('Treeview', 'rowheight') or 20
+        rows = max(1, event.height // int(rowheight) - 1)
+        if rows != self._roster_rows:
+            self._roster_rows = rows
+            self._draw_roster()
+
+    def _format_activity(self, timestamp:float) -> str:
+        """
+        Returns the time of the last message of a user as shown in the treeview, the time of day if it was today.
+        """
+        if not timestamp:
+            return ''
+        ltime = time.localtime(timestamp)
+        if ltime[:3] == time.localtime()[:3]:
+            return time.strftime('%H:%M', ltime)
+        return str(ltime.tm_mon) + '/' + str(ltime.tm_mday) + '/' + str(ltime.tm_year)
 
     def get_text_entry(self):
         """
@@ -98,43 +520,45 @@ class Body(tk.Frame):
         """
         return self.message_editor.get('1.0', 'end').rstrip()
 
-    def set_history_message(self, text:list, from_user:str):
-        """
-        Clears the texts currently displaying on the upper widget of the body frame, and then displays the time and content of the messages of the user selected in the
-        treeview on the upper right widget.
-
-        :param text: A nested list including the lists of the time, username, and message that the user have sent.  
-        :param from_user: The username that the user choose to check for history messages.
-        """
-        self.message_reader.delete(0.0, 'end')
-        message_menu = ""
-        if text == []:
-            self.message_reader.insert(0.0, "No old messages. Start communicating.\n")
-        else:
-            for i in text:
-                if i['recipient'] == from_user:
-                    # localtime() from https://docs.python.org/3/library/time.html#time.localtime
-                    # and https://overiq.com/python-3-time-module/
-                    ltime = time.localtime(float(i['timestamp']))
-                    local_time = str(ltime.tm_mon) + '/' + str(ltime.tm_mday) + '/' + str(ltime.tm_year) + ' at '\
-                                 + str(ltime.tm_hour) + ':' + str(ltime.tm_min) + ':' + str(ltime.tm_sec)
-                    message_menu = message_menu + local_time + ": " + i['recipient'] + ": " + i['message'] +"\n"
-            if message_menu == "":
-                self.message_reader.insert(0.0, "No old messages. Start communicating.\n")
-            else:
-                self.message_reader.insert(0.0, message_menu)
-        
-        
     def _draw(self):
         """
         Draws the userframe, the treeview widget, the message_history widget, and the message_editor widget.
         """
         user_frame = tk.Frame(master=self, width=250)
         user_frame.pack(fill=tk.BOTH, side=tk.LEFT)
+
+        # search box over the stored history
+        search_frame = tk.Frame(master=user_frame)
+        search_frame.pack(fill=tk.X, side=tk.TOP, padx=5, pady=(5, 0))
+        self.search_entry = tk.Entry(search_frame)
+        self.search_entry.bind('<Return>', self.search)
+        self.search_entry.pack(fill=tk.X, side=tk.LEFT, expand=True)
+        search_button = tk.Button(master=search_frame, text="Search", command=self.search)
+        search_button.pack(side=tk.LEFT, padx=(5, 0))
         
-        self.user_tree = ttk.Treeview(user_frame)
+        # the treeview only holds the rows in view, and its scrollbar scrolls through the roster
+        tree_frame = tk.Frame(master=user_frame)
+        tree_frame.pack(fill=tk.BOTH, side=tk.TOP, expand=True, padx=5, pady=5)
+        self.user_tree = ttk.Treeview(tree_frame, columns=('unread', 'last'), selectmode='browse')
+        self.user_tree.heading('#0', text='Friends', command=lambda: self.sort_users(ds_roster.NAME))
+        self.user_tree.heading('unread', text='New')
+        self.user_tree.heading('last', text='Last', command=lambda: self.sort_users(ds_roster.ACTIVITY))
+        self.user_tree.column('#0', width=140)
+        self.user_tree.column('unread', width=40, anchor=tk.E)
+        self.user_tree.column('last', width=80, anchor=tk.E)
+        bold = tkfont.nametofont('TkDefaultFont').copy()
+        bold.configure(weight='bold')
+        self.user_tree.tag_configure('unread', font=bold)
         self.user_tree.bind("<<TreeviewSelect>>", self.node_select)
-        self.user_tree.pack(fill=tk.BOTH, side=tk.TOP, expand=True, padx=5, pady=5)
+        self.user_tree.bind('<Configure>', self._roster_resized)
+        self.user_tree.bind('<MouseWheel>', self._roster_wheel)
+        self.user_tree.bind('<Button-4>', self._roster_wheel)
+        self.user_tree.bind('<Button-5>', self._roster_wheel)
+        self.user_tree.bind('<Up>', lambda event: self._roster_key(event, -1))
+        self.user_tree.bind('<Down>', lambda event: self._roster_key(event, 1))
+        self.user_tree.pack(fill=tk.BOTH, side=tk.LEFT, expand=True)
+        self.user_tree_scrollbar = tk.Scrollbar(master=tree_frame, command=self._roster_yview)
+        self.user_tree_scrollbar.pack(fill=tk.Y, side=tk.LEFT)
 
         # set the add user widget
         self.set_users()
@@ -151,10 +575,14 @@ class Body(tk.Frame):
         
         self.message_reader = tk.Text(reader_frame, width=0)
         self.message_reader.pack(fill=tk.BOTH, side=tk.LEFT, expand=True, padx=0, pady=0)
+        # colors for the state of messages being sent
+        self.message_reader.tag_configure('pending', foreground='gray')
+        self.message_reader.tag_configure('sent', foreground='green')
+        self.message_reader.tag_configure('failed', foreground='red')
 
-        message_reader_scrollbar = tk.Scrollbar(master=rscroll_frame, command=self.message_reader.yview)
-        self.message_reader['yscrollcommand'] = message_reader_scrollbar.set
-        message_reader_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
+        self.message_reader_scrollbar = tk.Scrollbar(master=rscroll_frame, command=self.message_reader.yview)
+        self.message_reader['yscrollcommand'] = self._reader_scrolled
+        self.message_reader_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
 
         # writing message frame
         message_frame = tk.Frame(master=self, bg="")
@@ -229,19 +657,33 @@ class MainApp(tk.Frame):
     """
     Calls the body and footer to form a complete GUI.
     """
-    def __init__(self, root):
+    def __init__(self, root, synthetic:tuple=None):
         """
         Initializes the GUI with asking the username and password of the user.
+
+        :param synthetic: (senders, messages) to fill the GUI with that many made-up senders and messages from each,
+                          and receive more made-up messages, instead of logging in to the server.
         """
         tk.Frame.__init__(self, root)
         self.root = root
+        self.synthetic = synthetic
         self.user_lst = []
+        # network calls run on a background worker so the window never freezes
+        self.worker = BackgroundWorker(self.root)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
         # ask username and password
-        self.sender()
+        if synthetic is None:
+            self.sender()
+            poll = self.messenger.sync
+        else:
+            poll = self.synthetic_sender(*synthetic)
+        # one poller fetches new messages for every view, more often while conversations are active
+        self.poller = Poller(self.root, self.worker, poll)
 
         # After initialization of the current user is complete, call the _draw method to pack the widgets
         # into the root frame
         self._draw()
+        self.poller.start()
 
     def sender(self):
         """
@@ -250,37 +692,99 @@ class MainApp(tk.Frame):
         # askstring() from https://docs.python.org/3/library/dialog.html
         self.username = askstring("Username", "Please Enter your username")
         self.password = askstring("Password", "Please Enter your password")
-        # self.messenger is an instance of class DirectMessenger
-        self.messenger = ds.DirectMessenger("168.235.86.101", self.username, self.password)
+        # self.messenger is an instance of class DirectMessenger, keeping the message history in a local store
+        # and its token in the token cache, so it does not have to join the server again on the next start.
+        # Set DS_SERVER to host or host:port to use another server, such as a local ds_server. More servers can
+        # follow, separated by commas, to fail over to when the first does not answer.
+        servers = [ds_failover.parse_address(address.strip(), ds.PORT)
+                   for address in os.environ.get("DS_SERVER", "168.235.86.101").split(',') if address.strip()]
+        server, port = servers[0]
+        store = ds_store.MessageStore(ds_store.default_path(server, self.username))
+        token_cache = ds_token_cache.TokenCache(ds_token_cache.default_path())
+        self.messenger = ds.DirectMessenger(server, self.username, self.password, store=store, port=port,
+                                            token_cache=token_cache, servers=servers[1:])
+        # messages are queued in a log on disk and sent in the background, so none are lost while the server is
+        # unreachable, and those still queued when the GUI closes are sent the next time it starts
+        self.outbox = ds_outbox.Outbox(self.messenger, ds_outbox.default_path(server, self.username),
+                                       on_status=self._send_status)
             
         
+    def synthetic_sender(self, senders:int, messages:int):
+        """
+        Creates an offline stand-in for DirectMessenger whose store holds made-up senders and messages, without
+        asking for a log in. Nothing is sent over the network, so sent messages end up failed.
+
+        :param senders: how many made-up senders.  
+        :param messages: how many messages from each.
+
+        :return: the function the poller calls to receive more made-up messages
+        """
+        self.username = 'synthetic'
+        self.password = ''
+        store = ds_profiler.synthetic_store(senders, messages, seed=0)
+        self.messenger = ds_profiler.OfflineMessenger(self.username, store)
+        self.outbox = ds_outbox.Outbox(self.messenger, max_attempts=1, on_status=self._send_status)
+        return ds_profiler.SyntheticFeed(store, senders)
+
     def send(self):
         """
         Connects to the send_callback in Footer and sends messages to selected user in the treeview.
         """
-        if self.body.index == None:
+        recipient_name = self.body.selected
+        if recipient_name is None:
             self.body.message_reader.delete(0.0, 'end')
             self.body.message_reader.insert(0.0, "No user selected.\n")
-            pass
         else:
-            recipient_name = self.body._users[self.body.index]
             message = self.body.get_text_entry()
-            result = self.messenger.send(message, recipient_name)
-            if result:
-                print("Post sent.")
-                sent_msg = self.username + ' sent: ' + message +'\n'
-                self.body.message_reader.insert('end', sent_msg)
-            else:
-                print("Post fail to send.")
-                self.body.message_reader.delete(0.0, 'end')
-                self.body.message_reader.insert(0.0, "Messages failed to send. You cannot wrap a line.")
+            # show the message right away as pending, and update its state when the outbox has sent it
+            message_id = self.outbox.send(message, recipient_name)
+            status_tag = 'status' + str(message_id)
+            self.body.message_reader.insert('end', self.username + ' sent: ' + message + ' ')
+            self.body.message_reader.insert('end', '(sending...)', (status_tag, 'pending'))
+            self.body.message_reader.insert('end', '\n')
+
+    def _send_status(self, message_id:int, status:str):
+        """
+        Called by the outbox from its own thread when a message is sent or given up.
+        """
+        self.worker.call(self._send_done, 'status' + str(message_id), status == ds_outbox.SENT)
+
+    def _send_done(self, status_tag:str, sent:bool):
+        """
+        Marks a message shown by send as sent or failed.
+
+        :param status_tag: the text tag around the state of the message.  
+        :param sent: True if the server accepted the message.
+        """
+        if sent:
+            print("Post sent.")
+            # a reply may come soon
+            self.poller.activity()
+        else:
+            print("Post fail to send.")
+        reader = self.body.message_reader
+        ranges = reader.tag_ranges(status_tag)
+        if ranges:
+            # the message is still on screen
+            reader.delete(ranges[0], ranges[1])
+            reader.insert(ranges[0], '(sent)' if sent else '(failed)', (status_tag, 'sent' if sent else 'failed'))
+
+    def close(self):
+        """
+        Stops polling, the outbox and the background worker and closes the window.
+        """
+        self.poller.stop()
+        self.outbox.close(timeout=1.0)
+        self.worker.shutdown()
+        self.root.destroy()
         
     def add_user(self):
         """
         Connects to the add_user_callback in Footer and adds the username of the friend the user want to add to the treeview.
         """
         new_username = askstring("Username", "Please Enter the username")
-        self.body.insert_user(new_username)
+        if new_username:
+            self.body.insert_user(new_username)
 
         
     def _draw(self):
@@ -288,20 +792,44 @@ class MainApp(tk.Frame):
         Draws the body and footer of the GUI.
         """
         # The Body and Footer classes must be initialized and packed into the root window.
-        self.body = Body(self.root, current_user=self.messenger)
+        self.body = Body(self.root, current_user=self.messenger, worker=self.worker, poller=self.poller)
         self.body.pack(fill=tk.BOTH, side = tk.TOP)
         
         self.footer = Footer(self.root, send_callback=self.send, add_user_callback=self.add_user)
         self.footer.pack(fill=tk.BOTH, side=tk.BOTTOM)
 
 if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='ICS 32 Distributed Social Platform')
+    parser.add_argument('--profile', nargs='?', const='-', default=None, metavar='REPORT',
+                        help='record event loop stalls and slow callbacks and write a JSON report to REPORT, '
+                             'or stderr, on exit')
+    parser.add_argument('--stall-ms', type=float, default=100.0,
+                        help='milliseconds a callback has to run to be recorded as a stall')
+    parser.add_argument('--synthetic', type=int, default=None, metavar='SENDERS',
+                        help='fill the window with this many made-up senders instead of logging in')
+    parser.add_argument('--synthetic-messages', type=int, default=100, metavar='MESSAGES',
+                        help='made-up messages from each sender')
+    args = parser.parse_args()
+
     main = tk.Tk()
     
     main.title("ICS 32 Distributed Social Platform")
     
     main.option_add('*tearOff', False)
-    MainApp(main)
+    monitor = None
+    if args.profile is not None:
+        # started before the window is built, so every callback it registers is timed
+        monitor = ds_profiler.StallMonitor(main, threshold=args.stall_ms / 1000)
+        monitor.start()
+    started = time.perf_counter()
+    synthetic = None if args.synthetic is None else (args.synthetic, args.synthetic_messages)
+    MainApp(main, synthetic=synthetic)
 
     main.update()
     main.minsize(720, main.winfo_height())
+    if monitor is not None:
+        monitor.info["startup_seconds"] = time.perf_counter() - started
     main.mainloop()
+    if monitor is not None:
+        monitor.stop()
+        monitor.write_report(None if args.profile == '-' else args.profile)
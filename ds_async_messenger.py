@@ -0,0 +1,248 @@
+import asyncio
+from collections import deque
+import time
+import ds_protocol
+import ds_codec
+from ds_messenger import PORT, FailToJoin, RetrieveProtocol, MessageBatch, response_type, messages_from_response
+
+
+class AsyncDirectMessenger:
+    """
+    The AsyncDirectMessenger class is the asyncio counterpart of DirectMessenger. One instance keeps one joined
+    connection to the DS server, and any number of coroutines can issue requests over it at the same time: requests
+    are written as they come and the responses, which the server sends back in order, are handed to their callers.
+
+    Every request accepts a timeout in seconds. A request that times out or is cancelled gives up waiting, and its
+    response is dropped when it arrives, so the connection stays usable.
+
+    With a ds_governor.Governor, requests wait for it before they are written and report their outcome to it.
+    """
+    def __init__(self, dsuserver=None, username=None, password=None, timeout:float=None, limit:int=2 ** 26,
+                 port:int=PORT, governor=None):
+        """
+        Initializer for AsyncDirectMessenger.
+
+        :param dsuserver: The IP address of the official ICS 32 Distributed Social Server.  
+        :param username: Initialize with your username.  
+        :param password: Initialize with your password.  
+        :param timeout: Default timeout in seconds for each request, None to wait forever.  
+        :param limit: The longest response line in bytes that will be read.  
+        :param port: The port of the DS server.  
+        :param governor: A ds_governor.Governor that every request waits for, shared with the other clients of the
+                         server.
+
+        """
+        self.token = None
+        self.dsuserver = dsuserver
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.limit = limit
+        self.port = port
+        self.governor = governor
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._pending = deque()
+        self._connect_lock = asyncio.Lock()
+
+
+    async def __aenter__(self):
+        await self.join()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+    @property
+    def connected(self) -> bool:
+        """
+        True if the connection to the DS server is open.
+        """
+        return self._read_task is not None and not self._read_task.done()
+
+
+    async def join(self, timeout:float=None) -> str:
+        """
+        Connect to the DS server and join it if that has not happened yet.
+
+        Raises OSError if the server cannot be reached and FailToJoin if the server rejects the user.
+
+        :param timeout: Seconds to wait, defaults to the messenger's timeout.
+
+        :return: str, the user token
+        """
+        if not self.connected:
+            await asyncio.wait_for(self._connect(), self._timeout(timeout))
+        return self.token
+
+
+    async def close(self):
+        """
+        Close the connection to the DS server.
+        """
+        if self._read_task is not None:
+            self._read_task.cancel()
+            # wait for the reader to stop without swallowing a cancellation of the caller
+            await asyncio.wait([self._read_task])
+            self._read_task = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+            self._writer = None
+        self._fail_pending(ConnectionError("The connection to the DS server was closed."))
+
+
+    async def send(self, message:str, recipient:str, timeout:float=None) -> bool:
+        """
+        Send a direct message to another user.
+
+        :param message: The message you want to send.  
+        :param recipient: The user you want to send messages to.  
+        :param timeout: Seconds to wait, defaults to the messenger's timeout.
+
+        :return: bool
+        """
+        srv_msg = await self._request(lambda token: ds_protocol.post(token, message, recipient, str(time.time())),
+                                      timeout)
+        return response_type(srv_msg) == 'ok'
+
+
+    async def retrieve_new(self, timeout:float=None) -> MessageBatch:
+        """
+        Retrieve unread messages from the DS server as a MessageBatch.
+
+        :param timeout: Seconds to wait, defaults to the messenger's timeout.
+
+        :return: MessageBatch
+        """
+        srv_msg = await self._request(lambda token: RetrieveProtocol(token, 'new').new_message(), timeout)
+        return messages_from_response(srv_msg)
+
+
+    async def retrieve_all(self, timeout:float=None) -> MessageBatch:
+        """
+        Retrieve all messages from the DS server as a MessageBatch.
+
+        :param timeout: Seconds to wait, defaults to the messenger's timeout.
+
+        :return: MessageBatch
+        """
+        srv_msg = await self._request(lambda token: RetrieveProtocol(token, 'all').all_message(), timeout)
+        return messages_from_response(srv_msg)
+
+
+    async def bio(self, bio:str, timeout:float=None) -> bool:
+        """
+        Update the bio of the user.
+
+        :param bio: The new bio.  
+        :param timeout: Seconds to wait, defaults to the messenger's timeout.
+
+        :return: bool
+        """
+        srv_msg = await self._request(lambda token: ds_protocol.bio(token, bio), timeout)
+        return response_type(srv_msg) == 'ok'
+
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+
+    async def _request(self, build, timeout:float=None) -> str:
+        """
+        Write one request and wait for the line the server responds with.
+
+        :param build: A function taking the current token and returning the JSON request.  
+        :param timeout: Seconds to wait, defaults to the messenger's timeout.
+
+        :return: str
+        """
+        async def request():
+            await self.join()
+            future = self._write(build(self.token))
+            await self._writer.drain()
+            # if this is cancelled the future stays queued and the reader drops its response
+            return await future
+        if self.governor is None:
+            return await asyncio.wait_for(request(), self._timeout(timeout))
+
+        if not await self.governor.acquire_async(self._timeout(timeout)):
+            raise asyncio.TimeoutError("The rate limit did not allow the request in time.")
+        ok = None
+        started = time.monotonic()
+        try:
+            srv_msg = await asyncio.wait_for(request(), self._timeout(timeout))
+            ok = response_type(srv_msg) != 'error'
+            return srv_msg
+        except (OSError, asyncio.TimeoutError):
+            ok = False
+            raise
+        finally:
+            self.governor.release(ok, None if ok is None else time.monotonic() - started)
+
+
+    def _write(self, msg:str) -> asyncio.Future:
+        """
+        Write a request and queue the future its response will be delivered to.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._writer.write((msg + '\n').encode())
+        return future
+
+
+    async def _connect(self):
+        """
+        Open the connection, join the server and start reading responses.
+        """
+        async with self._connect_lock:
+            if self.connected:
+                return
+            await self.close()
+            self._reader, self._writer = await asyncio.open_connection(self.dsuserver, self.port, limit=self.limit)
+            try:
+                self._writer.write((ds_protocol.join(self.dsuserver, self.username, self.password) + '\n').encode())
+                await self._writer.drain()
+                r_join = (await self._reader.readline()).decode()
+                if not r_join:
+                    raise ConnectionError("The DS server closed the connection while joining.")
+                if response_type(r_join) != 'ok':
+                    raise FailToJoin("Failed to join the server. The password is incorrect.")
+                self.token = ds_codec.loads(r_join)['response']['token']
+            except BaseException:
+                self._writer.close()
+                self._writer = None
+                raise
+            self._read_task = asyncio.create_task(self._read_responses())
+
+
+    async def _read_responses(self):
+        """
+        Deliver each response line to the oldest waiting request, until the connection drops.
+        """
+        error = ConnectionError("The connection to the DS server was lost.")
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                future = self._pending.popleft() if self._pending else None
+                if future is not None and not future.done():
+                    future.set_result(line.decode())
+        except (OSError, ValueError) as e:
+            error = ConnectionError("The connection to the DS server was lost: " + str(e))
+        finally:
+            self._fail_pending(error)
+
+
+    def _fail_pending(self, error:Exception):
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,248 @@
+"""
+ds_bench measures the speed of the DS client: the ds_protocol encoders, response decoding on synthetic histories,
+and end-to-end send and retrieve throughput and latency against a local ds_server on the loopback interface.
+
+Run it with:
+
+    [YOUR PYTHON] -m ds_bench [--sizes 1000,100000,1000000] [--messages 2000] [--output results.json]
+
+The results are written as JSON, one record per benchmark, so runs of different versions can be compared.
+"""
+import argparse
+import asyncio
+import io
+import json
+import platform
+import sys
+import threading
+import time
+import ds_codec
+import ds_protocol
+import ds_messenger as ds
+from ds_server import LocalDSServer
+
+
+def _record(name:str, n:int, seconds:float, latencies:list=None, **extra) -> dict:
+    """
+    Returns one benchmark result.
+
+    :param name: The name of the benchmark.  
+    :param n: How many operations were timed.  
+    :param seconds: How long they took altogether.  
+    :param latencies: The time each operation took, if measured one by one.
+
+    :return: dict
+    """
+    result = {"name": name, "n": n, "seconds": seconds, "ops_per_sec": n / seconds if seconds else None}
+    if latencies:
+        latencies = sorted(latencies)
+        result["p50_ms"] = latencies[len(latencies) // 2] * 1000
+        result["p99_ms"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    result.update(extra)
+    return result
+
+
+def _best_of(fn, repeat:int=3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def synthetic_response(size:int, senders:int=100) -> str:
+    """
+    Returns a response to a retrieve request holding a history of generated messages.
+
+    :param size: How many messages the history has.  
+    :param senders: How many different users sent them.
+
+    :return: str
+    """
+    start = time.time() - size
+    messages = [{"message": "synthetic message number " + str(i), "from": "sender" + str(i % senders),
+                 "timestamp": str(start + i)} for i in range(size)]
+    return ds_codec.dumps({"response": {"type": "ok", "messages": messages}})
+
+
+def bench_encode(n:int=100000) -> list:
+    """
+    Times the ds_protocol encoders and RetrieveProtocol.
+    """
+    token = "f0e1d2c3b4a5968778695a4b3c2d1e0f"
+    results = []
+    cases = [
+        ("encode.join", lambda: ds_protocol.join("127.0.0.1", "username", "password")),
+        ("encode.post", lambda: ds_protocol.post(token, "a message with \"quotes\"\nand a newline", "friend",
+                                                 "1700000000.123456")),
+        ("encode.bio", lambda: ds_protocol.bio(token, "a short bio")),
+        ("encode.retrieve", lambda: ds.RetrieveProtocol(token, 'all').all_message()),
+    ]
+    for name, fn in cases:
+        def run():
+            for _ in range(n):
+                fn()
+        results.append(_record(name, n, _best_of(run)))
+    return results
+
+
+def bench_extract_json(n:int=100000) -> list:
+    """
+    Times DirectMessenger.extract_json on a join response.
+    """
+    messenger = ds.DirectMessenger()
+    r_join = '{"response": {"type": "ok", "message": "Welcome", "token": "f0e1d2c3b4a5968778695a4b3c2d1e0f"}}'
+
+    def run():
+        for _ in range(n):
+            messenger.extract_json(r_join)
+    return [_record("decode.extract_json", n, _best_of(run))]
+
+
+def bench_decode(sizes) -> list:
+    """
+    Times building messages from retrieve responses of each size, all at once and streamed.
+    """
+    results = []
+    for size in sizes:
+        response = synthetic_response(size)
+        repeat = 3 if size <= 100000 else 1
+        seconds = _best_of(lambda: ds.messages_from_response(response), repeat)
+        results.append(_record("decode.messages_from_response", size, seconds, size=size))
+
+        def stream():
+            for _ in ds.iter_response_messages(io.StringIO(response + '\n').read):
+                pass
+        seconds = _best_of(stream, repeat)
+        results.append(_record("decode.iter_response_messages", size, seconds, size=size))
+    return results
+
+
+def bench_end_to_end(messages:int=2000, history:int=100000) -> list:
+    """
+    Times sending and retrieving against a local ds_server on the loopback interface.
+    """
+    server = LocalDSServer(port=0)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    results = []
+    try:
+        sender = ds.DirectMessenger('127.0.0.1', 'bench_sender', 'password', port=server.port)
+        receiver = ds.DirectMessenger('127.0.0.1', 'bench_receiver', 'password', port=server.port)
+
+        # one connection and join for every send: a new messenger has no token to reuse
+        count = max(1, messages // 10)
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            ds.DirectMessenger('127.0.0.1', 'bench_sender', 'password', port=server.port).send(
+                'message ' + str(i), 'bench_receiver')
+            latencies.append(time.perf_counter() - start)
+        results.append(_record("e2e.send_join", count, sum(latencies), latencies))
+
+        # one connection for every send, reusing the token of the first join
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            sender.send('message ' + str(i), 'bench_receiver')
+            latencies.append(time.perf_counter() - start)
+        results.append(_record("e2e.send_connect", count, sum(latencies), latencies))
+
+        # one session connection for all sends
+        latencies = []
+        with sender:
+            for i in range(messages):
+                start = time.perf_counter()
+                sender.send('message ' + str(i), 'bench_receiver')
+                latencies.append(time.perf_counter() - start)
+        results.append(_record("e2e.send_session", messages, sum(latencies), latencies))
+
+        # pipelined sends
+        start = time.perf_counter()
+        sender.send_many(('message ' + str(i), 'bench_receiver') for i in range(messages))
+        results.append(_record("e2e.send_many", messages, time.perf_counter() - start))
+
+        # fill the mailbox, then retrieve it
+        sender.send_many(('history ' + str(i), 'bench_receiver') for i in range(history))
+        size = len(receiver.retrieve_all())
+        latencies = []
+        for _ in range(3):
+            start = time.perf_counter()
+            receiver.retrieve_all()
+            latencies.append(time.perf_counter() - start)
+        results.append(_record("e2e.retrieve_all", 3, sum(latencies), latencies, size=size,
+                               messages_per_sec=size * 3 / sum(latencies)))
+
+        start = time.perf_counter()
+        streamed = sum(1 for _ in receiver.iter_all())
+        seconds = time.perf_counter() - start
+        results.append(_record("e2e.iter_all", 1, seconds, size=streamed, messages_per_sec=streamed / seconds))
+
+        latencies = []
+        for _ in range(max(1, messages // 10)):
+            start = time.perf_counter()
+            receiver.retrieve_new()
+            latencies.append(time.perf_counter() - start)
+        results.append(_record("e2e.retrieve_new", len(latencies), sum(latencies), latencies))
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(server.close())
+        loop.close()
+    return results
+
+
+def run(sizes=(1000, 100000, 1000000), messages:int=2000, history:int=100000, end_to_end:bool=True) -> dict:
+    """
+    Runs every benchmark and returns the results with a description of the environment.
+
+    :param sizes: The history sizes to decode.  
+    :param messages: How many messages to send in the end-to-end benchmarks.  
+    :param history: How many messages to retrieve in the end-to-end benchmarks.  
+    :param end_to_end: False to skip the benchmarks that use a local server.
+
+    :return: dict
+    """
+    results = []
+    results += bench_encode()
+    results += bench_extract_json()
+    results += bench_decode(sizes)
+    if end_to_end:
+        results += bench_end_to_end(messages, history)
+    return {
+        "created": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "json_backend": ds_codec.backend,
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='ds_bench', description='Benchmark the DS client.')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated history sizes to decode')
+    parser.add_argument('--messages', type=int, default=2000, help='messages to send end to end')
+    parser.add_argument('--history', type=int, default=100000, help='messages to retrieve end to end')
+    parser.add_argument('--no-end-to-end', action='store_true', help='skip the benchmarks that use a local server')
+    parser.add_argument('--json-backend', default=None, help='orjson, ujson or json')
+    parser.add_argument('--output', default=None, help='file to write the JSON results to, default stdout')
+    args = parser.parse_args(argv)
+
+    if args.json_backend:
+        ds_codec.set_backend(args.json_backend)
+    report = run([int(size) for size in args.sizes.split(',') if size], args.messages, args.history,
+                 not args.no_end_to_end)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
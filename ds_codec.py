@@ -0,0 +1,64 @@
+"""
+ds_codec encodes and decodes the JSON of the DS protocol. It uses orjson or ujson when one of them is installed
+and the standard json module otherwise. Call dumps and loads through the module, ds_codec.dumps(...), so that
+set_backend takes effect everywhere.
+"""
+import json
+
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+backend = None
+
+
+def _json_dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def set_backend(name:str=None) -> str:
+    """
+    Choose the JSON library used by dumps and loads.
+
+    :param name: 'orjson', 'ujson' or 'json', or None for the fastest one installed.
+
+    :return: str, the name of the library in use
+    """
+    global backend, dumps, loads
+    for candidate in (BACKENDS if name is None else (name,)):
+        if candidate == 'orjson':
+            try:
+                import orjson
+            except ImportError:
+                if name is not None:
+                    raise
+                continue
+            dumps = lambda obj: orjson.dumps(obj).decode()
+            loads = orjson.loads
+        elif candidate == 'ujson':
+            try:
+                import ujson
+            except ImportError:
+                if name is not None:
+                    raise
+                continue
+            dumps = lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+            loads = ujson.loads
+        elif candidate == 'json':
+            dumps = _json_dumps
+            loads = json.loads
+        else:
+            raise ValueError("Unknown JSON backend: " + str(candidate))
+        backend = candidate
+        return backend
+
+
+"""
+dumps encodes an object as a JSON string. Every backend escapes quotes, backslashes and newlines.
+
+loads decodes a JSON str or bytes. Every backend raises a ValueError for malformed input.
+
+"""
+dumps = _json_dumps
+loads = json.loads
+
+set_backend()
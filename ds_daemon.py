@@ -0,0 +1,397 @@
+"""
+ds_daemon polls the DS server for new messages on behalf of many accounts at once, without the GUI. The accounts are
+split between worker processes, and each worker keeps a session open for every one of its accounts with
+AsyncDirectMessenger and polls them all concurrently. New messages are handed to a sink in the main process.
+
+Run it with:
+
+    [YOUR PYTHON] -m ds_daemon ROSTER [--workers N] [--interval SECONDS] [--output messages.jsonl]
+
+ROSTER is a JSON file holding a list of {"username", "password"} objects, which may also name their "server" and
+"port", or a CSV file of username,password[,server[,port]] lines.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from ds_async_messenger import AsyncDirectMessenger
+from ds_governor import Governor
+from ds_messenger import PORT, FailToJoin
+
+
+def load_roster(path:str, dsuserver:str=None, port:int=PORT) -> list:
+    """
+    Read the accounts to poll from a JSON or CSV roster file.
+
+    :param path: The roster file.  
+    :param dsuserver: The server of accounts that do not name one.  
+    :param port: The port of accounts that do not name one.
+
+    :return: list of dicts with "username", "password", "server" and "port"
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = [dict(zip(('username', 'password', 'server', 'port'), row))
+                       for row in csv.reader(f) if row and not row[0].startswith('#')]
+    accounts = []
+    for entry in entries:
+        accounts.append({"username": entry["username"], "password": entry["password"],
+                         "server": entry.get("server") or dsuserver, "port": int(entry.get("port") or port)})
+    return accounts
+
+
+class CallbackSink:
+    """
+    The CallbackSink class hands new messages to a function, called as callback(username, messages) with the
+    account they were sent to and a list of (sender, message, timestamp) tuples.
+    """
+    def __init__(self, callback):
+        """
+        Initializer for CallbackSink.
+
+        :param callback: The function to call.
+
+        """
+        self.callback = callback
+
+
+    def deliver(self, username:str, messages:list):
+        self.callback(username, messages)
+
+
+    def close(self):
+        pass
+
+
+class JSONLSink:
+    """
+    The JSONLSink class appends new messages to a file, one JSON object per line with the "account" the message was
+    sent to and its "from", "message" and "timestamp".
+    """
+    def __init__(self, path:str=None):
+        """
+        Initializer for JSONLSink.
+
+        :param path: The file to append to, None for standard output.
+
+        """
+        self._file = sys.stdout if path is None else open(path, 'a', encoding='utf-8')
+
+
+    def deliver(self, username:str, messages:list):
+        lines = [json.dumps({"account": username, "from": sender, "message": message, "timestamp": timestamp},
+                            ensure_ascii=False) + '\n' for sender, message, timestamp in messages]
+        self._file.write(''.join(lines))
+        self._file.flush()
+
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+class QueueSink:
+    """
+    The QueueSink class puts every batch of new messages on a queue as a (username, messages) tuple, for another
+    thread to consume.
+    """
+    def __init__(self, q=None):
+        """
+        Initializer for QueueSink.
+
+        :param q: The queue, a new queue.Queue if None.
+
+        """
+        self.queue = queue.Queue() if q is None else q
+
+
+    def deliver(self, username:str, messages:list):
+        self.queue.put((username, messages))
+
+
+    def close(self):
+        pass
+
+
+class PollingDaemon:
+    """
+    The PollingDaemon class polls the DS server for new messages of many accounts. The accounts are dealt out to
+    worker processes, each of which polls all of its accounts concurrently over one session per account, and new
+    messages are delivered to the sink from a thread of the calling process.
+
+    A governor created with shared=True is shared by all the workers, so it limits their polls together.
+    """
+    def __init__(self, accounts, sink, workers:int=None, interval:float=5.0, timeout:float=10.0,
+                 max_connecting:int=64, governor=None):
+        """
+        Initializer for PollingDaemon.
+
+        :param accounts: A list of dicts with "username", "password", "server" and "port", see load_roster.  
+        :param sink: A CallbackSink, JSONLSink, QueueSink or any object with deliver(username, messages).  
+        :param workers: How many worker processes to use, the number of CPUs if None.  
+        :param interval: Seconds between two polls of the same account.  
+        :param timeout: Seconds to wait for the server before a poll counts as failed.  
+        :param max_connecting: How many accounts of one worker may connect and join at the same time.  
+        :param governor: A ds_governor.Governor created with shared=True that every poll waits for.
+
+        """
+        self.accounts = list(accounts)
+        self.sink = sink
+        self.workers = max(1, min(workers or os.cpu_count() or 1, len(self.accounts) or 1))
+        self.interval = interval
+        self.timeout = timeout
+        self.max_connecting = max_connecting
+        self.governor = governor
+        self.polls = 0
+        self.messages = 0
+        self.errors = 0
+        self._started = None
+        self._stopped = None
+        self._processes = []
+        self._results = None
+        self._stop = None
+        self._collector = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+    def start(self):
+        """
+        Start the worker processes and the thread delivering their messages to the sink.
+        """
+        context = multiprocessing.get_context()
+        self._results = context.Queue()
+        self._stop = context.Event()
+        self._started = time.monotonic()
+        self._stopped = None
+        for worker in range(self.workers):
+            process = context.Process(target=_run_worker, daemon=True,
+                                      args=(self.accounts[worker::self.workers], self.interval, self.timeout,
+                                            self.max_connecting, self.governor, self._results, self._stop))
+            process.start()
+            self._processes.append(process)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+
+    def stop(self):
+        """
+        Stop the workers, deliver the messages they retrieved before stopping and close the sink.
+        """
+        if self._stop is None:
+            return
+        self._stop.set()
+        for process in self._processes:
+            process.join()
+        self._results.put(None)
+        self._collector.join()
+        self._stopped = time.monotonic()
+        self._processes = []
+        self._stop = None
+        self.sink.close()
+
+
+    def run(self, duration:float=None, stats_interval:float=None, stats_file=sys.stderr):
+        """
+        Start the daemon and poll until the duration is over or the process is interrupted.
+
+        :param duration: Seconds to run, None to run until interrupted.  
+        :param stats_interval: Seconds between lines of throughput statistics, None for none.  
+        :param stats_file: Where the statistics are written.
+        """
+        self.start()
+        try:
+            end = None if duration is None else time.monotonic() + duration
+            while end is None or time.monotonic() < end:
+                wait = stats_interval or 1.0
+                if end is not None:
+                    wait = min(wait, end - time.monotonic())
+                time.sleep(max(0.0, wait))
+                if stats_interval:
+                    print(json.dumps(self.stats()), file=stats_file, flush=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+    def stats(self) -> dict:
+        """
+        Returns the number of accounts and workers, the polls, messages and errors so far and their rates, and the
+        rate the governor allows if there is one.
+
+        :return: dict
+        """
+        elapsed = 0.0
+        if self._started is not None:
+            elapsed = (self._stopped or time.monotonic()) - self._started
+        stats = {"accounts": len(self.accounts), "workers": self.workers, "seconds": elapsed, "polls": self.polls,
+                 "messages": self.messages, "errors": self.errors,
+                 "polls_per_sec": self.polls / elapsed if elapsed else 0.0,
+                 "messages_per_sec": self.messages / elapsed if elapsed else 0.0}
+        if self.governor is not None:
+            stats["allowed_per_sec"] = self.governor.rate
+        return stats
+
+
+    def _collect(self):
+        """
+        Deliver the messages the workers send back and add up their counts, until stop puts None on the queue.
+        """
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            if item[0] == 'messages':
+                _, username, messages = item
+                self.messages += len(messages)
+                try:
+                    self.sink.deliver(username, messages)
+                except Exception as e:
+                    print("The sink failed to take the messages of " + str(username) + ": " + str(e),
+                          file=sys.stderr)
+            else:
+                _, polls, errors = item
+                self.polls += polls
+                self.errors += errors
+
+
+def _run_worker(accounts:list, interval:float, timeout:float, max_connecting:int, governor, results, stop):
+    try:
+        asyncio.run(_poll_accounts(accounts, interval, timeout, max_connecting, governor, results, stop))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _poll_accounts(accounts:list, interval:float, timeout:float, max_connecting:int, governor, results,
+                         stop):
+    """
+    Poll every account of one worker until the stop event is set, reporting the counts every second.
+
+    On stop no new polls are started, and the polls in flight are given up to timeout seconds to finish, since the
+    server has marked the messages of a 'new' retrieval read once it has answered it. Only then are the rest
+    cancelled.
+    """
+    counts = [0, 0]
+    connecting = asyncio.Semaphore(max_connecting)
+    stopping = asyncio.Event()
+    tasks = [asyncio.create_task(_poll_account(account, interval, timeout, connecting, governor, results, counts,
+                                               stopping))
+             for account in accounts]
+    try:
+        while not stop.is_set():
+            await asyncio.sleep(min(1.0, interval))
+            if counts != [0, 0]:
+                results.put(('stats', counts[0], counts[1]))
+                counts[:] = [0, 0]
+    finally:
+        stopping.set()
+        if tasks:
+            _, unfinished = await asyncio.wait(tasks, timeout=timeout)
+            for task in unfinished:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        results.put(('stats', counts[0], counts[1]))
+
+
+async def _poll_account(account:dict, interval:float, timeout:float, connecting:asyncio.Semaphore, governor,
+                        results, counts:list, stopping:asyncio.Event):
+    """
+    Poll one account for new messages every interval, backing off while the server cannot be reached, until
+    stopping is set. A poll already sent when it is set is finished and its messages are delivered.
+    """
+    messenger = AsyncDirectMessenger(account["server"], account["username"], account["password"], timeout=timeout,
+                                     port=account["port"], governor=governor)
+    # spread the first polls over the interval, so the accounts do not all poll at once
+    await _sleep_unless(stopping, random.uniform(0, interval))
+    failures = 0
+    try:
+        while not stopping.is_set():
+            started = time.monotonic()
+            try:
+                if not messenger.connected:
+                    async with connecting:
+                        await messenger.join()
+                if stopping.is_set():
+                    break
+                batch = await messenger.retrieve_new()
+            except FailToJoin:
+                counts[1] += 1
+                print("Failed to join the server as " + account["username"] + ", no longer polling it.",
+                      file=sys.stderr)
+                return
+            except (OSError, asyncio.TimeoutError, ValueError, KeyError):
+                counts[1] += 1
+                failures += 1
+                await messenger.close()
+                await _sleep_unless(stopping, min(60.0, interval * 2 ** failures) * random.uniform(0.5, 1.0))
+                continue
+            failures = 0
+            counts[0] += 1
+            if len(batch):
+                results.put(('messages', account["username"],
+                             list(zip(batch.recipients, batch.messages, batch.timestamps))))
+            await _sleep_unless(stopping, max(0.0, interval - (time.monotonic() - started)))
+    finally:
+        await messenger.close()
+
+
+async def _sleep_unless(event:asyncio.Event, seconds:float):
+    """
+    Sleep for seconds, or until the event is set if that comes first.
+    """
+    try:
+        await asyncio.wait_for(event.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='ds_daemon', description='Poll the DS server for many accounts.')
+    parser.add_argument('roster', help='JSON or CSV file of the accounts to poll')
+    parser.add_argument('--server', default='168.235.86.101', help='server of accounts that do not name one')
+    parser.add_argument('--port', type=int, default=PORT, help='port of accounts that do not name one')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default the number of CPUs')
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds between polls of an account')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for the server')
+    parser.add_argument('--output', default=None, help='JSONL file to append new messages to, default stdout')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run, default until interrupted')
+    parser.add_argument('--stats-interval', type=float, default=10.0,
+                        help='seconds between throughput lines on stderr, 0 for none')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='polls per second to start from and adapt to the server, shared by all workers, '
+                             'default no limit')
+    parser.add_argument('--max-rate', type=float, default=None, help='polls per second never to go above')
+    parser.add_argument('--max-in-flight', type=int, default=256,
+                        help='most polls waiting for a response at a time when --rate is given')
+    args = parser.parse_args(argv)
+
+    accounts = load_roster(args.roster, args.server, args.port)
+    governor = None
+    if args.rate:
+        governor = Governor(args.rate, burst=max(1.0, args.rate / 10), max_in_flight=args.max_in_flight,
+                            max_rate=args.max_rate, shared=True)
+    daemon = PollingDaemon(accounts, JSONLSink(args.output), args.workers, args.interval, args.timeout,
+                           governor=governor)
+    daemon.run(args.duration, args.stats_interval or None)
+    print(json.dumps(daemon.stats()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+ds_failover connects DirectMessenger to the first DS server that answers out of a list of addresses, trying them
+in parallel the way happy eyeballs does, and keeps a circuit breaker for each address so that a dead server is left
+alone for a while instead of being tried on every call.
+"""
+import errno
+import os
+import random
+import selectors
+import socket
+import threading
+import time
+from collections import Counter, deque
+
+
+_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, getattr(errno, 'WSAEWOULDBLOCK', -1)}
+
+
+def parse_address(address, port:int) -> tuple:
+    """
+    Returns a (host, port) pair for a server address.
+
+    :param address: "host", "host:port" or a (host, port) pair.  
+    :param port: The port used when the address has none.
+
+    :return: tuple
+    """
+    if isinstance(address, (tuple, list)):
+        return (address[0], int(address[1]))
+    host, colon, rest = str(address).rpartition(':')
+    # a bare IPv6 address has colons but no port
+    if colon and rest.isdigit() and ':' not in host.strip('[]'):
+        return (host.strip('[]'), int(rest))
+    return (str(address).strip('[]'), port)
+
+
+def backoff_delays(retries:int, base:float=0.1, cap:float=5.0):
+    """
+    Yields how long to wait before each retry: exponential backoff with full jitter.
+
+    :param retries: How many delays to yield.  
+    :param base: The largest delay before the first retry.  
+    :param cap: The largest delay before any retry.
+    """
+    for attempt in range(retries):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    The CircuitBreaker class tracks whether a server is worth trying. After `threshold` failures in a row the
+    breaker opens and no attempts are allowed for `reset_timeout` seconds. Then one trial attempt is let through
+    every `reset_timeout` seconds: success closes the breaker again, failure keeps it open.
+    """
+    def __init__(self, threshold:int=3, reset_timeout:float=30.0):
+        """
+        Initializer for CircuitBreaker.
+
+        :param threshold: How many failures in a row open the breaker.  
+        :param reset_timeout: How many seconds the breaker stays open before a trial attempt.
+
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+
+    @property
+    def state(self) -> str:
+        """
+        'closed', 'open' or 'half-open'.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._trial or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+
+    def allow(self) -> bool:
+        """
+        Returns True if an attempt may be made now.
+
+        :return: bool
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            # a trial whose outcome is never recorded holds the breaker open for one more reset_timeout
+            self._opened_at = now
+            self._trial = True
+            return True
+
+
+    def success(self):
+        """
+        Record a successful attempt, closing the breaker.
+        """
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+
+    def failure(self):
+        """
+        Record a failed attempt.
+        """
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+def connect_any(addresses, timeout:float=None, stagger:float=0.25, breakers:dict=None, failed:set=None) -> tuple:
+    """
+    Connect to the first server that accepts the connection. The first address is tried at once, and each next one
+    is started `stagger` seconds later, or as soon as an earlier attempt fails, while earlier attempts go on.
+    Attempts still running when one succeeds are abandoned.
+
+    Addresses whose circuit breaker is open are skipped as long as another address is allowed; when none is, every
+    address is tried, so a breaker never stands between the caller and its last server. Failed addresses are
+    recorded in their circuit breakers, once per call when the caller passes the same `failed` set to each retry,
+    while success is left to the caller to record once the server has answered.
+
+    Raises TimeoutError if no attempt succeeds within the timeout, and otherwise the OSError of the last failed
+    attempt.
+
+    :param addresses: A list of (host, port) pairs, in order of preference.  
+    :param timeout: The most seconds to spend connecting altogether, None to wait as long as the system does.  
+    :param stagger: Seconds to wait for an attempt before starting the next one alongside it.  
+    :param breakers: A dict of (host, port) to CircuitBreaker, told how each address did.  
+    :param failed: A set of the addresses that already failed during this call, whose breakers are not told again.
+                   Addresses that fail are added to it.
+
+    :return: tuple of the connected blocking socket and the (host, port) it is connected to
+    """
+    breakers = breakers or {}
+    failed = set() if failed is None else failed
+    deadline = None if timeout is None else time.monotonic() + timeout
+    allowed = [address for address in addresses if address not in breakers or breakers[address].allow()]
+    candidates = deque()
+    error = None
+
+    def record_failure(address):
+        if address not in failed:
+            failed.add(address)
+            if address in breakers:
+                breakers[address].failure()
+
+    for address in allowed or addresses:
+        try:
+            infos = socket.getaddrinfo(address[0], address[1], type=socket.SOCK_STREAM)
+        except OSError as e:
+            error = e
+            record_failure(address)
+            continue
+        candidates.extend((address, info) for info in infos)
+    if not candidates:
+        raise error or ConnectionError("No DS server address was given.")
+
+    # how many attempts of each address have not failed yet
+    remaining = Counter(address for address, _ in candidates)
+
+    def attempt_failed(address):
+        nonlocal next_start
+        # start the next attempt right away
+        next_start = time.monotonic()
+        remaining[address] -= 1
+        if remaining[address] == 0:
+            record_failure(address)
+
+    next_start = time.monotonic()
+    selector = selectors.DefaultSelector()
+    pending = {}
+    try:
+        while candidates or pending:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                break
+            if candidates and (not pending or now >= next_start):
+                address, (family, kind, proto, _, sockaddr) = candidates.popleft()
+                sock = None
+                try:
+                    sock = socket.socket(family, kind, proto)
+                    sock.setblocking(False)
+                    code = sock.connect_ex(sockaddr)
+                except OSError as e:
+                    if sock is not None:
+                        sock.close()
+                    error = e
+                    attempt_failed(address)
+                    continue
+                if code == 0:
+                    return _connected(sock, address)
+                if code not in _IN_PROGRESS:
+                    sock.close()
+                    error = OSError(code, os.strerror(code))
+                    attempt_failed(address)
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE)
+                pending[sock] = address
+                next_start = now + stagger
+                continue
+
+            waits = []
+            if candidates:
+                waits.append(next_start - now)
+            if deadline is not None:
+                waits.append(deadline - now)
+            for key, _ in selector.select(max(0.0, min(waits)) if waits else None):
+                sock = key.fileobj
+                address = pending.pop(sock)
+                selector.unregister(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    return _connected(sock, address)
+                sock.close()
+                error = OSError(code, os.strerror(code))
+                attempt_failed(address)
+
+        # out of time: the attempts still running count as failures
+        for address in set(pending.values()):
+            remaining[address] = 1
+            attempt_failed(address)
+        if pending or (deadline is not None and time.monotonic() >= deadline):
+            raise TimeoutError("Timed out connecting to the DS server."
+                               + ("" if error is None else " The last attempt failed with: " + str(error)))
+        raise error
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+
+def _connected(sock, address:tuple) -> tuple:
+    sock.setblocking(True)
+    return sock, address
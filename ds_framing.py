@@ -0,0 +1,172 @@
+import codecs
+import select
+import socket
+
+
+MAX_FRAME = 2 ** 26
+
+
+class FrameTooLarge(ValueError):
+    """
+    FrameTooLarge is raised when a line from the DS server is longer than the largest frame the LineFramer accepts.
+    The connection cannot be used after that, because the rest of the line is still unread.
+    """
+    pass
+
+
+class LineFramer:
+    """
+    The LineFramer class reads and writes the newline-delimited JSON frames of the DS protocol directly on a socket.
+
+    Received bytes go into one preallocated buffer with recv_into, and frames are found and cut out of it through a
+    memoryview, so a frame is copied once on its way out. Outgoing frames are encoded straight to bytes and can be
+    queued to be sent together.
+    """
+    def __init__(self, sock, buffer_size:int=65536, max_frame:int=MAX_FRAME, metrics=None, peer=None):
+        """
+        Initializer for LineFramer.
+
+        :param sock: A connected socket.  
+        :param buffer_size: The starting size of the receive buffer in bytes.  
+        :param max_frame: The longest frame in bytes that read_frame accepts.  
+        :param metrics: A ds_metrics.Metrics to count bytes sent and received in, or None.  
+        :param peer: The (host, port) the socket is connected to.
+
+        """
+        self.sock = sock
+        self.max_frame = max_frame
+        self.metrics = metrics
+        self.peer = peer
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._out = []
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+
+    def close(self):
+        """
+        Close the socket.
+        """
+        self._view.release()
+        self.sock.close()
+
+
+    def peer_closed(self) -> bool:
+        """
+        Returns True if the other end has closed or reset the connection, without waiting and without taking
+        anything from it. A connection with unread bytes is not closed yet.
+
+        :return: bool
+        """
+        if self._start < self._end:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+
+
+    def write_frame(self, msg:str, flush:bool=True):
+        """
+        Encode a frame and send it, or queue it to be sent by the next flush.
+
+        :param msg: A JSON string, without the newline.  
+        :param flush: False to queue the frame instead of sending it now.
+        """
+        self._out.append((msg + '\n').encode())
+        if flush:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Send all queued frames.
+        """
+        if self._out:
+            data = self._out[0] if len(self._out) == 1 else b''.join(self._out)
+            self._out.clear()
+            self.sock.sendall(data)
+            if self.metrics is not None:
+                self.metrics.count('bytes_sent', len(data))
+
+
+    def read_frame(self) -> bytes:
+        """
+        Returns the next frame, without its newline.
+
+        Raises ConnectionError if the connection closes first and FrameTooLarge if the frame is longer than max_frame.
+
+        :return: bytes
+        """
+        scan = self._start
+        while True:
+            nl = self._buf.find(b'\n', scan, self._end)
+            if nl >= 0:
+                frame = bytes(self._view[self._start:nl])
+                self._start = nl + 1
+                return frame
+            scan = self._end
+            if self._end - self._start >= self.max_frame:
+                raise FrameTooLarge("A frame from the DS server is longer than " + str(self.max_frame) + " bytes.")
+            scan -= self._fill()
+
+
+    def read_text(self, size:int) -> str:
+        """
+        Returns up to size more characters of the current frame, reading at most one buffer at a time, or '' once
+        the frame has ended. Frames of any length can be read this way.
+
+        Raises ConnectionError if the connection closes before the frame ends.
+
+        :param size: The most bytes to take from the buffer.
+
+        :return: str
+        """
+        while True:
+            if self._start == self._end:
+                self._fill()
+            if self._buf[self._start] == 10:
+                # the end of the frame
+                self._start += 1
+                self._decoder.decode(b'', final=True)
+                self._decoder.reset()
+                return ''
+            stop = min(self._end, self._start + max(1, size))
+            nl = self._buf.find(b'\n', self._start, stop)
+            if nl >= 0:
+                stop = nl
+            text = self._decoder.decode(self._view[self._start:stop])
+            self._start = stop
+            if text:
+                return text
+
+
+    def _fill(self) -> int:
+        """
+        Receive more bytes into the buffer, first moving unread bytes to its front or growing it if it is full.
+
+        :return: int, how far the unread bytes moved towards the front
+        """
+        shift = 0
+        if self._end == len(self._buf):
+            unread = self._end - self._start
+            if self._start == 0:
+                # a full buffer holding part of one frame
+                self._view.release()
+                self._buf.extend(bytes(len(self._buf)))
+                self._view = memoryview(self._buf)
+            else:
+                shift = self._start
+                self._view[:unread] = self._view[self._start:self._end]
+                self._start = 0
+                self._end = unread
+        n = self.sock.recv_into(self._view[self._end:])
+        if n == 0:
+            raise ConnectionError("The connection to the DS server was closed.")
+        self._end += n
+        if self.metrics is not None:
+            self.metrics.count('bytes_received', n)
+        return shift
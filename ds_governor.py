@@ -0,0 +1,191 @@
+"""
+ds_governor limits how fast requests are sent to the DS server. A Governor combines a token bucket, which caps the
+request rate, with a cap on the requests in flight, and adjusts the rate to how the server is coping: it grows
+slowly while requests succeed and callers are waiting for it, and is cut when the server answers with errors or
+its latency climbs well above its usual level.
+
+Pass one Governor to every DirectMessenger, AsyncDirectMessenger or PollingDaemon that talks to the same server.
+Created with shared=True its state lives in shared memory, so it can also be handed to worker processes.
+"""
+import asyncio
+import multiprocessing
+import threading
+import time
+from array import array
+
+
+# the fields of the governor state
+_TOKENS, _REFILLED, _RATE, _IN_FLIGHT, _LATENCY, _BASE_LATENCY, _DECREASED, _LIMITED, _GRANTED, _ERRORS = range(10)
+_FIELDS = 10
+
+
+class Governor:
+    """
+    The Governor class decides when a request may be sent. Call acquire() before sending a request and release()
+    with its outcome once the response has arrived, or try_acquire() to find out how long to wait instead of
+    waiting.
+
+    The rate is adjusted like TCP congestion control: every success adds increase / rate to it, so it grows by
+    about `increase` requests per second each second, and an error response or a latency above latency_factor
+    times the lowest latency seen, and latency_slack above it, multiplies it by `decrease`. The rate is cut at most
+    once per round trip, so the many errors of one overload only count once.
+    """
+    def __init__(self, rate:float=50.0, burst:float=10.0, max_in_flight:int=32, min_rate:float=1.0,
+                 max_rate:float=None, increase:float=1.0, decrease:float=0.7, latency_factor:float=3.0,
+                 latency_slack:float=0.05, shared:bool=False):
+        """
+        Initializer for Governor.
+
+        :param rate: The requests per second allowed at first.  
+        :param burst: The most requests that can be sent at once after a quiet spell.  
+        :param max_in_flight: The most requests waiting for a response at the same time.  
+        :param min_rate: The rate is never cut below this.  
+        :param max_rate: The rate never grows above this, None for no limit.  
+        :param increase: About how many requests per second the rate grows by each second.  
+        :param decrease: What the rate is multiplied by when the server is overloaded.  
+        :param latency_factor: How many times the lowest latency seen a latency has to be to count as overload.  
+        :param latency_slack: How many seconds above the lowest latency seen a latency also has to be to count as
+                              overload, so jitter on a fast network does not.  
+        :param shared: True to keep the state in shared memory, so the governor can be passed to other processes.
+
+        """
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.min_rate = min_rate
+        self.max_rate = float('inf') if max_rate is None else max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.latency_slack = latency_slack
+        if shared:
+            context = multiprocessing.get_context()
+            self._state = context.RawArray('d', _FIELDS)
+            self._lock = context.Lock()
+        else:
+            self._state = array('d', [0.0] * _FIELDS)
+            self._lock = threading.Lock()
+        self._state[_TOKENS] = burst
+        self._state[_REFILLED] = time.monotonic()
+        self._state[_RATE] = min(self.max_rate, max(min_rate, rate))
+
+
+    def try_acquire(self) -> float:
+        """
+        Take the permission to send a request if it is allowed now.
+
+        :return: float, 0 if the request may be sent, otherwise about how many seconds to wait before asking again
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._state
+            state[_TOKENS] = min(self.burst, state[_TOKENS] + (now - state[_REFILLED]) * state[_RATE])
+            state[_REFILLED] = now
+            if state[_IN_FLIGHT] >= self.max_in_flight:
+                # a slot frees up when a response arrives
+                return max(0.001, state[_LATENCY] / 4) if state[_LATENCY] else 0.005
+            if state[_TOKENS] < 1.0:
+                state[_LIMITED] = now
+                return (1.0 - state[_TOKENS]) / state[_RATE]
+            state[_TOKENS] -= 1.0
+            state[_IN_FLIGHT] += 1
+            state[_GRANTED] += 1
+            return 0.0
+
+
+    def acquire(self, timeout:float=None) -> bool:
+        """
+        Wait until a request may be sent and take the permission to send it.
+
+        :param timeout: The most seconds to wait, None to wait as long as it takes.
+
+        :return: bool, False if the timeout ran out first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            time.sleep(wait)
+
+
+    async def acquire_async(self, timeout:float=None) -> bool:
+        """
+        Like acquire, but waits with asyncio.sleep so the event loop keeps running.
+
+        :param timeout: The most seconds to wait, None to wait as long as it takes.
+
+        :return: bool, False if the timeout ran out first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            await asyncio.sleep(wait)
+
+
+    def release(self, ok:bool=None, latency:float=None):
+        """
+        Give back the permission taken for a request and adjust the rate to its outcome.
+
+        :param ok: True if the server handled the request, False if it answered with an error or failed, None if
+                   the request was abandoned and says nothing about the server.  
+        :param latency: Seconds the response took, None if unknown.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._state
+            state[_IN_FLIGHT] = max(0.0, state[_IN_FLIGHT] - 1)
+            if ok is None:
+                return
+            overloaded = not ok
+            if not ok:
+                state[_ERRORS] += 1
+            if latency is not None:
+                if state[_LATENCY]:
+                    state[_LATENCY] += (latency - state[_LATENCY]) * 0.2
+                    # the lowest latency drifts up slowly, so a lasting change of route is learned
+                    base = state[_BASE_LATENCY]
+                    state[_BASE_LATENCY] = min(latency, base + (latency - base) * 0.001)
+                else:
+                    state[_LATENCY] = state[_BASE_LATENCY] = latency
+                base = state[_BASE_LATENCY]
+                overloaded = overloaded or state[_LATENCY] > max(base * self.latency_factor, base + self.latency_slack)
+            if overloaded:
+                if now - state[_DECREASED] >= max(0.1, state[_LATENCY]):
+                    state[_RATE] = max(self.min_rate, state[_RATE] * self.decrease)
+                    state[_DECREASED] = now
+            elif now - state[_LIMITED] < 1.0:
+                # only grow while callers are waiting for the rate, not while demand is below it
+                state[_RATE] = min(self.max_rate, state[_RATE] + self.increase / state[_RATE])
+
+
+    @property
+    def rate(self) -> float:
+        """
+        The requests per second currently allowed.
+        """
+        return self._state[_RATE]
+
+
+    def stats(self) -> dict:
+        """
+        Returns the current rate, the requests in flight, the average and lowest latency, and how many requests
+        were allowed and how many failed.
+
+        :return: dict
+        """
+        with self._lock:
+            state = list(self._state)
+        return {"rate": state[_RATE], "in_flight": int(state[_IN_FLIGHT]), "latency": state[_LATENCY],
+                "base_latency": state[_BASE_LATENCY], "granted": int(state[_GRANTED]), "errors": int(state[_ERRORS])}
@@ -1,10 +1,28 @@
-import socket
+import argparse
+import getpass
+import hashlib
+import os
+import sys
+import threading
 import json
-from collections import namedtuple
+from array import array
+from collections import namedtuple, deque
+from collections.abc import Mapping
 import ds_protocol
+import ds_codec
+from ds_framing import LineFramer, MAX_FRAME
+from ds_failover import CircuitBreaker, backoff_delays, connect_any, parse_address
+from ds_metrics import NULL_METRICS
+from ds_token_cache import TokenCache, default_path as default_token_path
 import time
 
 
+PORT = 3021
+
+# a namedtuple to hold the values we expect to retrieve from json messages
+DataTuple = namedtuple('DataTuple', ['type','message','token'])
+
+
 class FailToJoin(Exception):
     """
     FailToJoin is a custom exception that is raised when attempting to join the official
@@ -33,220 +51,1201 @@ class RetrieveProtocol:
         """
         Formats a request in which unread new messages are requested from the DS server.
         """
-        return '{"token":"' + self.token + '", "directmessage": "' + self.status + '"}'
+        return ds_protocol.retrieve(self.token, self.status)
 
 
     def all_message(self):
         """
         Format a request in which all messages are requested from the DS server.
         """
-        return '{"token":"' + self.token + '", "directmessage": "' + self.status + '"}'
+        return ds_protocol.retrieve(self.token, self.status)
 
 
 class DirectMessage:
     """
     The DirectMessage class stores message data in each response from a "retrieve_new" or "retrieve_all" request
     and makes DirectMessage objects.
+
+    The fields are slots, so a DirectMessage costs much less than a dict, and they can still be read like dict keys:
+    dm['recipient'] is dm.recipient. It is a read-only Mapping of its three fields, so `in`, iteration, items(),
+    values() and dict(dm) work as they did on the dicts retrieve_new and retrieve_all used to return. The timestamp
+    is a float.
     """
-    def __init__(self):
+    __slots__ = ('recipient', 'message', 'timestamp')
+
+    def __init__(self, recipient:str=None, message:str=None, timestamp:float=None):
         """
         Initializer for DirectMessage.
 
+        :param recipient: The user who sent the message.  
+        :param message: The text of the message.  
+        :param timestamp: When the message was sent, in seconds since the epoch.
+
+        """
+        self.recipient = recipient
+        self.message = message
+        self.timestamp = timestamp
+
+    def __getitem__(self, key:str):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key:str, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self) -> tuple:
+        return self.__slots__
+
+    def values(self) -> tuple:
+        return (self.recipient, self.message, self.timestamp)
+
+    def items(self) -> tuple:
+        return tuple(zip(self.__slots__, self.values()))
+
+    def __contains__(self, key) -> bool:
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, (DirectMessage, dict)):
+            return len(other) == len(self) and all(self[k] == other.get(k) for k in self.__slots__)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'DirectMessage(%r, %r, %r)' % (self.recipient, self.message, self.timestamp)
+
+
+Mapping.register(DirectMessage)
+
+
+class MessageBatch:
+    """
+    The MessageBatch class holds many messages in three columns, senders, texts and timestamps, instead of one
+    object per message. Timestamps are kept as floats in an array and each sender name is stored once.
+
+    A MessageBatch reads like a list of DirectMessage objects: it has a length, can be indexed, sliced and iterated,
+    and compares equal to a list of the same messages. It is not a list, so call to_list() where one is needed, for
+    example before json.dumps.
+    """
+    def __init__(self, messages=()):
+        """
+        Initializer for MessageBatch.
+
+        :param messages: DirectMessage objects or dicts to start the batch with.
+
+        """
+        self.recipients = []
+        self.messages = []
+        self.timestamps = array('d')
+        for m in messages:
+            self.append(m['recipient'], m['message'], m['timestamp'])
+
+    def append(self, recipient:str, message:str, timestamp):
+        """
+        Add a message to the end of the batch.
+
+        :param recipient: The user who sent the message.  
+        :param message: The text of the message.  
+        :param timestamp: When the message was sent, as a number or a string.
+        """
+        self.recipients.append(sys.intern(recipient))
+        self.messages.append(message)
+        self.timestamps.append(float(timestamp))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            batch = MessageBatch()
+            batch.recipients = self.recipients[index]
+            batch.messages = self.messages[index]
+            batch.timestamps = self.timestamps[index]
+            return batch
+        return DirectMessage(self.recipients[index], self.messages[index], self.timestamps[index])
+
+    def __iter__(self):
+        for recipient, message, timestamp in zip(self.recipients, self.messages, self.timestamps):
+            yield DirectMessage(recipient, message, timestamp)
+
+    def __eq__(self, other):
+        if isinstance(other, MessageBatch):
+            return (self.recipients == other.recipients and self.messages == other.messages
+                    and self.timestamps == other.timestamps)
+        if isinstance(other, list):
+            return len(other) == len(self) and all(m == o for m, o in zip(self, other))
+        return NotImplemented
+
+    def to_list(self) -> list:
+        """
+        Returns the messages as a list of dicts with the keys recipient, message and timestamp, like the list
+        retrieve_new and retrieve_all used to return.
+
+        :return: list
         """
-        self.recipient = None
-        self.message = None
-        self.timestamp = None 
+        return [{'recipient': recipient, 'message': message, 'timestamp': timestamp}
+                for recipient, message, timestamp in zip(self.recipients, self.messages, self.timestamps)]
+
+    def __repr__(self):
+        return 'MessageBatch(%d messages)' % len(self)
+
+
+def response_type(srv_msg:str) -> str:
+    """
+    Returns the type, 'ok' or 'error', of a response from the DS server.
+
+    :param srv_msg: A JSON formatted response.
+
+    :return: str
+    """
+    try:
+        return ds_codec.loads(srv_msg)['response']['type']
+    except (ValueError, KeyError, TypeError):
+        return 'error'
+
+
+def token_rejected(srv_msg:str) -> bool:
+    """
+    Returns True if a response from the DS server is an error about the token, meaning the client has to join again.
+
+    :param srv_msg: A JSON formatted response.
+
+    :return: bool
+    """
+    # error responses are short, so long responses are not decoded a second time just to check
+    if len(srv_msg) > 1024:
+        return False
+    try:
+        response = ds_codec.loads(srv_msg)['response']
+        return response['type'] == 'error' and 'token' in str(response.get('message', '')).lower()
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+
+def messages_from_response(srv_msg:str) -> MessageBatch:
+    """
+    Convert the messages in a response to a retrieve request into a MessageBatch.
+
+    :param srv_msg: A JSON formatted response.
+
+    :return: MessageBatch
+    """
+    batch = MessageBatch()
+    json_obj = ds_codec.loads(srv_msg)
+    for i in json_obj['response']['messages']:
+        batch.append(i["from"], i["message"], i["timestamp"])
+    return batch
+
+
+def iter_response_messages(read, chunk_size:int=65536):
+    """
+    Parse the messages array of a response to a retrieve request incrementally, yielding one DirectMessage at a
+    time, so the whole response never has to be held in memory.
+
+    :param read: A function taking a size and returning up to that many more characters of the response line,
+                 or '' at the end of the line.  
+    :param chunk_size: How many characters to read at a time.
+
+    :return: generator of DirectMessage objects
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    start = -1
+    # find the start of the messages array
+    while start < 0:
+        chunk = read(chunk_size)
+        if not chunk or chunk.endswith('\n') and '"messages"' not in buf + chunk:
+            raise ValueError("The response has no messages: " + (buf + chunk)[:200])
+        buf += chunk
+        key = buf.find('"messages"')
+        if key >= 0:
+            start = buf.find('[', key)
+    pos = start + 1
+    while True:
+        # skip to the next message or the end of the array
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            break
+        try:
+            i, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            chunk = read(chunk_size)
+            if not chunk:
+                raise ValueError("The response ended in the middle of the messages.")
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        pos = end
+        yield DirectMessage(i["from"], i["message"], float(i["timestamp"]))
+    # read the rest of the response line
+    rest = buf[pos:]
+    while not rest.endswith('\n'):
+        rest = read(chunk_size)
+        if not rest:
+            break
 
 
 class DirectMessenger:
     """
     The DirectMessenger class is responsible for communicating with the DS server. This class can be implemented to
     send direct messages to other users and retrieve unread messages or all messages from the DS server.
+
+    By default every call opens its own connection and joins the server. Calling open(), or using the messenger
+    as a context manager, starts a session instead: one connection and its token are kept across calls and are
+    re-established on their own when the socket drops.
+
+    Connections go to the first of the DS server and any fallback servers to answer, and give up after the connect
+    and read timeouts. Calls that fail to connect are retried after a growing, jittered delay, as are requests that
+    are safe to send twice, and a server that keeps failing is skipped until its circuit breaker lets it be tried
+    again.
+
+    The token from the last join is reused by later calls and connections, so the server is only joined again when
+    it rejects the token. With a ds_token_cache.TokenCache the token also outlives the messenger.
+
+    With a ds_governor.Governor, requests wait for it before they are sent and report their outcome to it, error
+    responses counting as a sign that the server is overloaded.
+
+    Bio updates are skipped when the bio is the same as the last one the server accepted, which is remembered by
+    its hash, in the store if there is one. Updates made while another is being sent are merged into one, and
+    set_bio sends only the last of the updates made within its delay.
     """
-    def __init__(self, dsuserver=None, username=None, password=None):
+    def __init__(self, dsuserver=None, username=None, password=None, store=None, max_frame:int=MAX_FRAME,
+                 port:int=PORT, metrics=None, token_cache=None, servers=None, connect_timeout:float=5.0,
+                 timeout:float=30.0, retries:int=3, governor=None):
         """
         Initializer for DirectMessenger.
 
         :param dsuserver: The IP address of the official ICS 32 Distributed Social Server.  
         :param username: Initialize with your username.  
         :param password: Initialize with your password.  
+        :param store: A ds_store.MessageStore that retrieved messages are written into.  
+        :param max_frame: The longest response in bytes that is read whole. iter_new and iter_all have no limit.  
+        :param port: The port of the DS server.  
+        :param metrics: A ds_metrics.Metrics that times each phase of every call and counts bytes, messages,
+                        errors and reconnects. Nothing is recorded without one.  
+        :param token_cache: A ds_token_cache.TokenCache to look up a token in before joining, and to keep the
+                            token in once joined.  
+        :param servers: Fallback servers tried alongside dsuserver, as "host", "host:port" or (host, port).  
+        :param connect_timeout: The most seconds to spend connecting, None to wait as long as the system does.  
+        :param timeout: The most seconds to wait for the server to respond, None to wait forever.  
+        :param retries: How many times a call is retried after a failure that can be retried.  
+        :param governor: A ds_governor.Governor that every request waits for before it is sent, shared with the
+                         other clients of the server to keep their traffic within what it can handle.
         
         """
         self.token = None
         self.dsuserver = dsuserver
         self.username = username
         self.password = password
-        
-		
+        self.store = store
+        self.max_frame = max_frame
+        self.port = port
+        self.metrics = NULL_METRICS if metrics is None else metrics
+        self.token_cache = token_cache
+        self.servers = [(dsuserver, port)]
+        for address in servers or ():
+            address = parse_address(address, port)
+            if address not in self.servers:
+                self.servers.append(address)
+        self.breakers = {address: CircuitBreaker() for address in self.servers}
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.governor = governor
+        # True once the server has accepted self.token during this run
+        self._token_verified = False
+        self._session = False
+        self._session_opened = False
+        self._framer = None
+        self._bio_hash = None if store is None else store.bio_hash
+        self._bio_cond = threading.Condition()
+        # bio calls are numbered; the latest bio asked for and the number of the last call a send covered
+        self._bio_latest = None
+        self._bio_calls = 0
+        self._bio_covered = 0
+        self._bio_result = False
+        self._bio_sending = False
+        # the bio set_bio will send and the timer that sends it
+        self._bio_pending = None
+        self._bio_timer = None
+
+
+    def __enter__(self):
+        self.open()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def open(self):
+        """
+        Start a session: connect to the DS server, joining it unless there is a token already, and keep the
+        connection for later calls.
+
+        Raises OSError if the server cannot be reached and FailToJoin if the server rejects the user.
+        """
+        self._session = True
+        if self._framer is None:
+            self._connect(lambda failed: self._reconnect('open', failed))
+
+
+    def close(self):
+        """
+        End the session and close the connection to the DS server. A bio set_bio is still waiting to send is sent
+        first.
+        """
+        self.flush_bio()
+        self._session = False
+        self._session_opened = False
+        self._drop()
+
+
+    @property
+    def connected(self) -> bool:
+        """
+        True if a session connection to the DS server is currently open.
+        """
+        return self._framer is not None
+
+
     def send(self, message:str, recipient:str) -> bool:
         """ 
-        Make connection with the DS server and send direct messages to other users.
+        Send direct messages to other users through the DS server.
 
         :param message: The message you want to send.  
         :param recipient: The user you want to send messages to.
 
         :return: bool
         """
-        port = 3021
-        # connect to the DS server
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-            try:
-                client.connect((self.dsuserver, port))
-            except:
-                print("fail to connect to the server, change a server.")
-                return False
+        metrics = self.metrics
+        try:
+            srv_msg = self._request(lambda token: ds_protocol.post(token, message, recipient, str(time.time())),
+                                    'send')
+        except FailToJoin:
+            # fail to join
+            metrics.count('errors')
+            return False
+        except OSError:
+            print("fail to connect to the server, change a server.")
+            metrics.count('errors')
+            return False
 
-            # create send and receive files in the socket
-            send = client.makefile('w')
-            recv = client.makefile('r')
-            # get a JSON string of joining message
-            joined_msg = ds_protocol.join(self.dsuserver, self.username, self.password)
-            
-            # send the JSON string to join the server and get a response: r_join
-            r_join = self.write_and_receive(joined_msg, send, recv, join_=True)
-
-            if 'error' in r_join:
-                # fail to join
-                return False
-            if 'ok' in r_join:
-                t = self.extract_json(r_join)
-                self.token = t.token
-
-            post_msg = ds_protocol.post(self.token, message, recipient, str(time.time()))
-            # send the formatted post to the recipient and receive a response
-            response = self.write_and_receive(post_msg, send, recv)
-            
-            if response:
-                # successfully send the information
-                return True
-            else:
-                # fail to send the information
-                print("There is something wrong. You cannot put \' in your post.")
-                return False
-            
-        	
-    def retrieve_new(self) -> list:
+        start = metrics.clock()
+        ok = response_type(srv_msg) == 'ok'
+        metrics.observe('send', 'decode', metrics.clock() - start)
+        if ok:
+            # successfully send the information
+            metrics.count('messages_sent')
+            return True
+        else:
+            # fail to send the information
+            print("There is something wrong. The server did not accept the post.")
+            metrics.count('errors')
+            return False
+
+
+    def bio(self, bio:str) -> bool:
         """
-        Retrieve unread messages from the DS server and convert the responses into a list of DirectMessage objects.
+        Update the bio of the user. Nothing is sent if the server has already accepted this bio. If other threads
+        update the bio while this is being sent, only the last of their bios is sent after it, and they all get
+        the result of that.
 
-        :return: list
+        :param bio: The new bio.
+
+        :return: bool
+        """
+        with self._bio_cond:
+            self._bio_calls += 1
+            call = self._bio_calls
+            self._bio_latest = bio
+            while self._bio_sending and self._bio_covered < call:
+                self._bio_cond.wait()
+            if self._bio_covered >= call:
+                # a later bio was sent in place of this one
+                return self._bio_result
+            self._bio_sending = True
+            bio = self._bio_latest
+            covers = self._bio_calls
+        ok = False
+        try:
+            ok = self._send_bio(bio)
+        finally:
+            with self._bio_cond:
+                self._bio_sending = False
+                self._bio_covered = covers
+                self._bio_result = ok
+                self._bio_cond.notify_all()
+        return ok
+
+
+    def set_bio(self, bio:str, delay:float=1.0):
+        """
+        Update the bio of the user in the background. The bio is sent from a timer thread once the delay is over,
+        and if set_bio is called again before then only the bio of the last call is sent.
+
+        :param bio: The new bio.  
+        :param delay: The most seconds to wait for a later bio before sending.
+        """
+        with self._bio_cond:
+            self._bio_pending = bio
+            if self._bio_timer is None:
+                self._bio_timer = threading.Timer(delay, self.flush_bio)
+                self._bio_timer.daemon = True
+                self._bio_timer.start()
+
+
+    def flush_bio(self) -> bool:
+        """
+        Send the bio set_bio is waiting to send now.
+
+        :return: bool, True if there was none or it was sent
+        """
+        with self._bio_cond:
+            bio = self._bio_pending
+            self._bio_pending = None
+            if self._bio_timer is not None:
+                self._bio_timer.cancel()
+                self._bio_timer = None
+        if bio is None:
+            return True
+        return self.bio(bio)
+
+
+    def _send_bio(self, bio:str) -> bool:
+        """
+        Send a bio unless its hash is that of the last bio the server accepted.
+        """
+        metrics = self.metrics
+        digest = hashlib.sha256(bio.encode('utf-8')).hexdigest()
+        if digest == self._bio_hash:
+            metrics.count('bios_skipped')
+            return True
+        try:
+            srv_msg = self._request(lambda token: ds_protocol.bio(token, bio), 'bio', idempotent=True)
+        except FailToJoin:
+            metrics.count('errors')
+            return False
+        except OSError:
+            print("fail to connect to the server, change a server.")
+            metrics.count('errors')
+            return False
+
+        if response_type(srv_msg) != 'ok':
+            print("There is something wrong. The server did not accept the bio.")
+            metrics.count('errors')
+            return False
+        metrics.count('bios_sent')
+        self._bio_hash = digest
+        if self.store is not None:
+            self.store.mark_bio(digest)
+        return True
+
+
+    def send_many(self, messages, window:int=256) -> list:
+        """
+        Send many direct messages over one connection, writing the posts without waiting for each response.
+
+        Responses are read back in order whenever `window` posts are in flight, so the socket buffers never fill
+        up on both sides. A failed post does not stop the rest from being sent.
+
+        :param messages: An iterable of (message, recipient) pairs, or (message, recipient, timestamp) to send a
+                         message with the time it was written rather than the time it is sent.  
+        :param window: The largest number of posts written before their responses are read.
+
+        :return: list of bool, one for each message in the order given
+        """
+        return list(self._send_pipelined(messages, window, 'send_many'))
+
+
+    def iter_send(self, messages, window:int=256):
+        """
+        Send many direct messages like send_many, yielding whether each one was sent as soon as its response is
+        read. Messages are taken from the iterable only as they are sent, so memory use does not grow with the
+        number of messages.
+
+        :param messages: An iterable of (message, recipient) pairs, or (message, recipient, timestamp) to send a
+                         message with the time it was written rather than the time it is sent.  
+        :param window: The largest number of posts written before their responses are read.
+
+        :return: generator of bool, one for each message in the order given
+        """
+        return self._send_pipelined(messages, window, 'iter_send')
+
+
+    def send_outcomes(self, messages, window:int=256) -> list:
+        """
+        Send many direct messages like send_many, telling apart posts the server rejected from posts that never
+        got a response because the connection failed, which may be worth sending again later.
+
+        :param messages: An iterable of (message, recipient) pairs, or (message, recipient, timestamp) to send a
+                         message with the time it was written rather than the time it is sent.  
+        :param window: The largest number of posts written before their responses are read.
+
+        :return: list, for each message in the order given True if it was sent, False if the server rejected it
+                 and None if the connection failed before its response arrived
+        """
+        return list(self._send_pipelined(messages, window, 'send_outcomes', outcomes=True))
+
+
+    def _send_pipelined(self, messages, window:int, operation:str, outcomes:bool=False):
+        """
+        Write the posts of the messages over one connection and yield whether each was sent, in order. With
+        outcomes, posts lost to a failed connection are yielded as None rather than False.
+
+        With a governor every post waits for it before it is written, and the responses to posts in flight are
+        read while waiting, so the posts of this call never hold up each other.
+
+        If the server rejects the token, none of the posts in flight were handled: the server is joined again on a
+        new connection and they are written once more with the new token. This happens at most once per call.
+
+        If the generator is not run to the end while posts are in flight, a session connection is dropped, since
+        their responses are still waiting on it.
+        """
+        metrics = self.metrics
+        governor = self.governor
+        started = metrics.clock()
+        total = 0
+        sent = 0
+        # the number of posts written whose response has not been read yet
+        pending = 0
+        # the number of permissions taken from the governor and not given back yet
+        held = 0
+        # with a governor, when each post waiting for a response was written, so its latency can be reported
+        written_at = deque()
+        # the (message, recipient, timestamp) of each post whose response has not been read yet, oldest first
+        unanswered = deque()
+        rejoined = False
+        conn = None
+        lost = None if outcomes else False
+        messages = iter(messages)
+
+        def read() -> bool:
+            """
+            Read the response to the oldest post in flight and return whether it was sent.
+            """
+            nonlocal conn, rejoined
+            while True:
+                srv_msg = conn.read_frame().decode()
+                if rejoined or not token_rejected(srv_msg):
+                    unanswered.popleft()
+                    return response_type(srv_msg) == 'ok'
+                rejoined = True
+                self._forget_token()
+                self._release(conn, lost=True)
+                try:
+                    conn = self._pipeline_connection(operation)
+                except FailToJoin as e:
+                    # the posts in flight are lost like on a dropped connection
+                    raise ConnectionError(str(e))
+                for item in unanswered:
+                    conn.write_frame(ds_protocol.post(self.token, *item), flush=False)
+                conn.flush()
+                if governor is not None:
+                    now = time.monotonic()
+                    written_at.clear()
+                    written_at.extend(now for _ in unanswered)
+
+        try:
+            for message, recipient, *timestamp in messages:
+                total += 1
+                if conn is None:
+                    try:
+                        conn = self._pipeline_connection(operation)
+                    except (OSError, FailToJoin) as e:
+                        failure = False
+                        if isinstance(e, OSError):
+                            print("fail to connect to the server, change a server.")
+                            failure = lost
+                        yield failure
+                        for _ in messages:
+                            total += 1
+                            yield failure
+                        break
+                item = (message, recipient, str(timestamp[0] if timestamp else time.time()))
+                written = False
+                try:
+                    while governor is not None and held == pending:
+                        wait = governor.try_acquire()
+                        if not wait:
+                            held += 1
+                        elif pending:
+                            conn.flush()
+                            ok = read()
+                            pending -= 1
+                            held -= 1
+                            governor.release(ok, time.monotonic() - written_at.popleft())
+                            sent += ok
+                            yield ok
+                        else:
+                            time.sleep(wait)
+                    conn.write_frame(ds_protocol.post(self.token, *item), flush=False)
+                    written = True
+                    unanswered.append(item)
+                    pending += 1
+                    if governor is not None:
+                        written_at.append(time.monotonic())
+                    if pending >= window:
+                        conn.flush()
+                        ok = read()
+                        pending -= 1
+                    else:
+                        continue
+                except OSError:
+                    # the posts still waiting for a response are counted as failed, and so is this one if it
+                    # was not written
+                    failed = pending if written else pending + 1
+                    self._release(conn, lost=True)
+                    conn = None
+                    pending = 0
+                    unanswered.clear()
+                    written_at.clear()
+                    for _ in range(held):
+                        governor.release(False)
+                    held = 0
+                    for _ in range(failed):
+                        yield lost
+                    continue
+                if governor is not None:
+                    held -= 1
+                    governor.release(ok, time.monotonic() - written_at.popleft())
+                sent += ok
+                yield ok
+
+            if conn is not None:
+                try:
+                    conn.flush()
+                    while pending:
+                        ok = read()
+                        pending -= 1
+                        if governor is not None:
+                            held -= 1
+                            governor.release(ok, time.monotonic() - written_at.popleft())
+                        sent += ok
+                        yield ok
+                except OSError:
+                    self._release(conn, lost=True)
+                    conn = None
+                    for _ in range(held):
+                        governor.release(False)
+                    held = 0
+                    for _ in range(pending):
+                        yield lost
+                    pending = 0
+        finally:
+            if conn is not None:
+                self._release(conn, lost=pending > 0)
+            for _ in range(held):
+                governor.release()
+            if metrics.enabled:
+                metrics.count('messages_sent', sent)
+                metrics.count('errors', total - sent)
+                metrics.observe(operation, 'total', metrics.clock() - started)
+
+
+    def _pipeline_connection(self, operation:str):
+        """
+        Returns the LineFramer to pipeline requests over: the session connection when a session is open,
+        otherwise a new connection.
+
+        Pipelined requests cannot be sent again one by one, so a token the server has not accepted yet, such as
+        one from the token cache, is replaced by joining first.
+        """
+        if not self._session:
+            return self._connect(lambda failed: self._open_connection(operation, not self._token_verified, failed))
+        if self._framer is not None and self._framer.peer_closed():
+            # the server closed the session connection since the last call
+            self._drop()
+        if self._framer is None:
+            self._connect(lambda failed: self._reconnect(operation, failed))
+        if not self._token_verified:
+            self._timed_join(self._framer, operation)
+        return self._framer
+
+
+    def _release(self, conn, lost=False):
+        """
+        Give back a connection returned by _pipeline_connection. Session connections stay open unless lost.
+        """
+        if self._session:
+            if lost:
+                self._drop()
+            return
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+
+    def retrieve_new(self) -> MessageBatch:
+        """
+        Retrieve unread messages from the DS server and convert the responses into a MessageBatch.
+
+        A MessageBatch is indexed and iterated like the list of messages this used to return and compares equal to
+        one, but it is not a list: call to_list() on it for a list of dicts, for example to pass it to json.dumps.
+
+        :return: MessageBatch
+        """
+        # returns a MessageBatch containing all new messages
+        return self._store(self._retrieve(self._new_request, 'retrieve_new'))
+
+
+    def retrieve_all(self) -> MessageBatch:
+        """
+        Retrieve all messages from the DS server and convert the responses into a MessageBatch, which, as with
+        retrieve_new, stands in for the list this used to return.
+
+        :return: MessageBatch
+        """
+        # returns a MessageBatch containing all messages
+        return self._store(self._retrieve(self._all_request, 'retrieve_all', idempotent=True))
+
+
+    def iter_new(self):
+        """
+        Retrieve unread messages from the DS server, yielding them one at a time as the response is read.
+
+        :return: generator of DirectMessage objects
+        """
+        return self._iter_messages(self._new_request, 'iter_new')
+
+
+    def iter_all(self):
+        """
+        Retrieve all messages from the DS server, yielding them one at a time as the response is read. Memory use
+        does not grow with the size of the history.
+
+        :return: generator of DirectMessage objects
+        """
+        return self._iter_messages(self._all_request, 'iter_all', idempotent=True)
+
+
+    def _iter_messages(self, build, operation:str, store_batch:int=1000, idempotent:bool=False):
+        """
+        Send a retrieve request and yield the messages in the response as they are parsed. Yielded messages are
+        written into the message store in batches.
+
+        Within a session, a request that fails before any of the response arrives is sent once more on a new
+        connection, but only if its write failed or it is idempotent, like _request: the server marks the
+        messages of a 'new' retrieval read once it has handled it.
+
+        If the generator is not run to the end, a session connection is dropped, since the rest of the response
+        is still waiting on it.
+
+        :param build: A function taking the current token and returning the retrieve request.  
+        :param operation: The name the call is timed under.  
+        :param store_batch: How many messages to write into the store at a time.  
+        :param idempotent: True if the request can be sent again when no response arrives.
         """
-        dm_new_list = []      
-        port = 3021
-        # connect to the DS server
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+        metrics = self.metrics
+        for attempt in range(2):
             try:
-                client.connect((self.dsuserver, port))
-            except:
+                conn = self._pipeline_connection(operation)
+            except FailToJoin:
+                metrics.count('errors')
+                raise FailToJoin("Failed to join the server. The password is incorrect.")
+            except OSError:
                 print("fail to connect to the server, change a server.")
+                metrics.count('errors')
+                return
+
+            complete = False
+            retry = False
+            batch = []
+            try:
+                unsent = True
+                try:
+                    start = metrics.clock()
+                    conn.write_frame(build(self.token))
+                    unsent = False
+                    written = metrics.clock()
+                    metrics.observe(operation, 'write', written - start)
+                    first = [conn.read_text(1)]
+                    start = metrics.clock()
+                    metrics.observe(operation, 'wait', start - written)
+                except OSError:
+                    # the session connection was dropped, join again and send the request once more if the server
+                    # cannot have handled it or handling it twice does no harm
+                    retry = self._session and attempt == 0 and (unsent or idempotent)
+                    if not retry:
+                        raise
+                else:
+                    def read(size):
+                        return first.pop() if first else conn.read_text(size)
+
+                    for dm in iter_response_messages(read):
+                        batch.append(dm)
+                        if len(batch) >= store_batch:
+                            self._store(batch)
+                            batch = []
+                        metrics.count('messages_received')
+                        yield dm
+                    complete = True
+                    metrics.observe(operation, 'decode', metrics.clock() - start)
+            except OSError:
+                print("Fail to receive the response from the server.")
+                metrics.count('errors')
+            finally:
+                self._store(batch)
+                self._release(conn, lost=not complete)
+            if not retry:
+                return
+
+
+    def sync(self) -> list:
+        """
+        Bring the message store up to date. The first sync writes the full history into the store, later ones
+        only fetch unread messages.
+
+        :return: list of the messages that were not in the store before, False if the server cannot be reached
+        """
+        if self.store.synced:
+            dm_list = self._retrieve(self._new_request, 'sync')
+            if dm_list is False:
                 return False
+            return self.store.add(dm_list)
+        dm_list = self._retrieve(self._all_request, 'sync', idempotent=True)
+        if dm_list is False:
+            return False
+        added = self.store.add(dm_list)
+        self.store.mark_synced()
+        return added
 
-            # create send and receive files in the socket
-            send = client.makefile('w')
-            recv = client.makefile('r')
 
-            # get a JSON string of joining message
-            joined_msg = ds_protocol.join(self.dsuserver, self.username, self.password)
-            
-            # send the JSON string to join the server and get a response: r_join
-            r_join = self.write_and_receive(joined_msg, send, recv, join_=True)
+    def _new_request(self, token:str) -> str:
+        return RetrieveProtocol(token, 'new').new_message()
 
-            if 'error' in r_join:
-                raise FailToJoin("Failed to join the server. The password is incorrect.")
-            if 'ok' in r_join:
-                t = self.extract_json(r_join)
-                self.token = t.token
 
-            # format a retireve-all-new-messages request
-            retrieve_msg = RetrieveProtocol(self.token, 'new').new_message()
+    def _all_request(self, token:str) -> str:
+        return RetrieveProtocol(token, 'all').all_message()
+
+
+    def _store(self, dm_list):
+        """
+        Write retrieved messages into the message store, if there is one, and return them.
+        """
+        if self.store is not None and dm_list is not False:
+            self.store.add(dm_list)
+        return dm_list
+
+
+    def _retrieve(self, build, operation:str, idempotent:bool=False) -> MessageBatch:
+        """
+        Send a retrieve request and convert the messages in the response into a MessageBatch.
+
+        :param build: A function taking the current token and returning the retrieve request.  
+        :param operation: The name the call is timed under.  
+        :param idempotent: True if the request can be sent again when no response arrives.
+
+        :return: MessageBatch
+        """
+        metrics = self.metrics
+        try:
+            srv_msg = self._request(build, operation, idempotent)
+        except FailToJoin:
+            metrics.count('errors')
+            raise FailToJoin("Failed to join the server. The password is incorrect.")
+        except OSError:
+            print("fail to connect to the server, change a server.")
+            metrics.count('errors')
+            return False
+
+        start = metrics.clock()
+        batch = messages_from_response(srv_msg)
+        metrics.observe(operation, 'decode', metrics.clock() - start)
+        metrics.count('messages_received', len(batch))
+        return batch
+
+
+    def _request(self, build, operation:str, idempotent:bool=False) -> str:
+        """
+        Send one request to the DS server and return the line it responds with.
+
+        Outside a session a new connection is opened for the request. Inside a session the open connection is used,
+        and if it turns out to be dropped it is re-established and the request is sent once more. Either way the
+        server is only joined when there is no token yet or the server rejects it.
+
+        Failing to connect is retried after a backoff delay, up to self.retries times. Failing once the request
+        was written is only retried if the request is idempotent, since the server may have handled it. A session
+        connection the server has closed is noticed before the request is written, and replaced.
+
+        :param build: A function taking the current token and returning the JSON request.  
+        :param operation: The name the call is timed under.  
+        :param idempotent: True if the request can be sent again when no response arrives.
+
+        :return: str
+        """
+        delays = self._backoff()
+        failed = set()
+        while True:
+            reused = self._session and self._framer is not None
+            if reused and self._framer.peer_closed():
+                # the server closed the session connection since the last call, nothing has been sent on it
+                self._drop()
+                reused = False
             try:
-                send.write(retrieve_msg + '\n')
-                send.flush()
-            except:
-                print("Fail to send the request to the server.")
-            else:
-                srv_msg = recv.readline()
-                json_obj = json.loads(srv_msg)
-                for i in json_obj['response']['messages']:
-                    dm_new = DirectMessage()
-                    dm_new.recipient = i["from"]
-                    dm_new.message = i["message"]
-                    dm_new.timestamp = i["timestamp"]
-                    dm_new_list.append(dm_new.__dict__)
-
-                # returns a list of DirectMessage objects containing all new messages
-                return dm_new_list
-                
-            
-    def retrieve_all(self) -> list:
-        """
-        Retrieve all messages from the DS server and convert the responses into a list of DirectMessage objects.
+                if not self._session:
+                    framer = self._open_connection(operation, failed=failed)
+                else:
+                    if self._framer is None:
+                        self._reconnect(operation, failed)
+                    framer = self._framer
+            except OSError:
+                if not self._wait_retry(delays):
+                    raise
+                continue
 
-        :return: list
+            try:
+                governed = self._govern()
+            except OSError:
+                self._release(framer)
+                raise
+            lost = True
+            srv_msg = None
+            started = time.monotonic()
+            try:
+                srv_msg = self._authorized_exchange(framer, build, operation)
+                lost = False
+                self._peer_ok(framer.peer)
+                return srv_msg
+            except OSError as e:
+                # a request that was not written whole cannot have been handled, so it is safe to send again
+                again = idempotent or getattr(e, 'unsent', False)
+                if reused and again:
+                    # the session connection was dropped since the last call, join again and retry at once
+                    continue
+                self._peer_failed(framer.peer, failed)
+                if not again or not self._wait_retry(delays):
+                    raise
+            finally:
+                self._release(framer, lost)
+                if governed:
+                    self.governor.release(srv_msg is not None and response_type(srv_msg) != 'error',
+                                          time.monotonic() - started)
+
+
+    def _govern(self) -> bool:
+        """
+        Wait for the governor to allow a request. Returns False if there is no governor, and raises TimeoutError if
+        it does not allow the request within the read timeout.
+        """
+        if self.governor is None:
+            return False
+        if not self.governor.acquire(self.timeout):
+            self.metrics.count('errors')
+            raise TimeoutError("The rate limit did not allow the request in time.")
+        return True
+
+
+    def _connect(self, connect):
+        """
+        Call connect until it succeeds, waiting a backoff delay after each OSError, up to self.retries times.
+        Nothing has been sent when connecting fails, so this is safe for every request.
+
+        connect is passed the set of servers that failed during the call, so each counts once against its
+        circuit breaker however often it is retried.
         """
-        dm_all_list = []
-        port = 3021
-        # connect to the DS server
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+        delays = self._backoff()
+        failed = set()
+        while True:
             try:
-                client.connect((self.dsuserver, port))
-            except:
-                print("fail to connect to the server, change a server.")
-                return False
+                return connect(failed)
+            except OSError:
+                if not self._wait_retry(delays):
+                    raise
 
-            # create send and receive files in the socket
-            send = client.makefile('w')
-            recv = client.makefile('r')
 
-            # get a JSON string of joining message
-            joined_msg = ds_protocol.join(self.dsuserver, self.username, self.password)
-            
-            # send the JSON string to join the server and get a response: r_join
-            r_join = self.write_and_receive(joined_msg, send, recv, join_=True)
+    def _backoff(self):
+        """
+        Returns the delays to wait before each retry of one call.
+        """
+        return backoff_delays(self.retries)
 
-            if 'error' in r_join:
-                raise FailToJoin("Failed to join the server. The password is incorrect.")
-            if 'ok' in r_join:
-                t = self.extract_json(r_join)
-                self.token = t.token
 
-            # format a retireve-all-messages request
-            retrieve_msg = RetrieveProtocol(self.token, 'all').all_message()
+    def _wait_retry(self, delays) -> bool:
+        """
+        Wait the next backoff delay and return True, or return False if there are no retries left.
+        """
+        delay = next(delays, None)
+        if delay is None:
+            return False
+        self.metrics.count('retries')
+        time.sleep(delay)
+        return True
+
+
+    def _peer_ok(self, address:tuple):
+        """
+        Record that a server answered, closing its circuit breaker.
+        """
+        breaker = self.breakers.get(address)
+        if breaker is not None:
+            breaker.success()
+
+
+    def _peer_failed(self, address:tuple, failed:set=None):
+        """
+        Count a failure against the circuit breaker of a server, unless it is in failed, the servers that already
+        failed during the call.
+        """
+        if failed is not None:
+            if address in failed:
+                return
+            failed.add(address)
+        breaker = self.breakers.get(address)
+        if breaker is not None:
+            breaker.failure()
+
+
+    def _authorized_exchange(self, framer:LineFramer, build, operation:str) -> str:
+        """
+        Send a request with the current token and return the response. If the server rejects the token, join
+        again on the same connection and send the request once more.
+        """
+        srv_msg = self._exchange(framer, build(self.token), operation)
+        if token_rejected(srv_msg):
+            self._forget_token()
+            self._timed_join(framer, operation)
+            srv_msg = self._exchange(framer, build(self.token), operation)
+        else:
+            self._token_verified = True
+        return srv_msg
+
+
+    def _exchange(self, framer:LineFramer, msg:str, operation:str) -> str:
+        """
+        Write one request and return the line the server responds with, timing both.
+        """
+        metrics = self.metrics
+        start = metrics.clock()
+        try:
+            framer.write_frame(msg)
+        except OSError as e:
+            # the server only handles whole lines, so _request may send the request again
+            e.unsent = True
+            raise
+        written = metrics.clock()
+        srv_msg = framer.read_frame().decode()
+        metrics.observe(operation, 'write', written - start)
+        metrics.observe(operation, 'wait', metrics.clock() - written)
+        return srv_msg
+
+
+    def _open_connection(self, operation:str, join:bool=False, failed:set=None):
+        """
+        Connect to the DS server and return a LineFramer on the connection. The server is joined first if asked to
+        or if there is no token to send requests with, neither from an earlier join nor in the token cache.
+
+        failed is the set of servers that already failed during the call, see _peer_failed.
+        """
+        if self.token is None and self.token_cache is not None:
+            self.token = self.token_cache.get(self.dsuserver, self.port, self.username, self.password)
+            self._token_verified = False
+        metrics = self.metrics
+        start = metrics.clock()
+        client, address = connect_any(self.servers, self.connect_timeout, breakers=self.breakers, failed=failed)
+        try:
+            client.settimeout(self.timeout)
+            metrics.observe(operation, 'connect', metrics.clock() - start)
+            framer = LineFramer(client, max_frame=self.max_frame, metrics=metrics if metrics.enabled else None,
+                                peer=address)
+            if join or self.token is None:
+                self._timed_join(framer, operation)
+        except OSError:
+            client.close()
+            self._peer_failed(address, failed)
+            raise
+        except:
+            client.close()
+            raise
+        return framer
+
+
+    def _timed_join(self, framer:LineFramer, operation:str):
+        """
+        Join the DS server over the given connection, timing it under the operation.
+        """
+        metrics = self.metrics
+        start = metrics.clock()
+        self._join(framer)
+        metrics.observe(operation, 'join', metrics.clock() - start)
+        self._peer_ok(framer.peer)
+
+
+    def _forget_token(self):
+        """
+        Drop a token the DS server rejected, here and in the token cache.
+        """
+        self.token = None
+        self._token_verified = False
+        if self.token_cache is not None:
+            self.token_cache.discard(self.dsuserver, self.port, self.username)
+
+
+    def _join(self, framer:LineFramer):
+        """
+        Join the DS server over the given connection and store the token it responds with.
+        """
+        # get a JSON string of joining message
+        joined_msg = ds_protocol.join(self.dsuserver, self.username, self.password)
+
+        # send the JSON string to join the server and get a response: r_join
+        framer.write_frame(joined_msg)
+        r_join = framer.read_frame().decode()
+        if response_type(r_join) != 'ok':
+            raise FailToJoin("Failed to join the server. The password is incorrect.")
+        t = self.extract_json(r_join)
+        self.token = t.token
+        self._token_verified = True
+        if self.token_cache is not None:
+            self.token_cache.put(self.dsuserver, self.port, self.username, self.password, self.token)
+
+
+    def _reconnect(self, operation:str='open', failed:set=None):
+        """
+        Open the session connection again.
+        """
+        self._drop()
+        if self._session_opened:
+            self.metrics.count('reconnects')
+        self._framer = self._open_connection(operation, failed=failed)
+        self._session_opened = True
+
+
+    def _drop(self):
+        """
+        Close the session connection if there is one.
+        """
+        if self._framer is not None:
             try:
-                send.write(retrieve_msg + '\n')
-                send.flush()
-            except:
-                print("Fail to send the request to the server.")
-            else:
-                srv_msg = recv.readline()
-                json_obj = json.loads(srv_msg)
-                for i in json_obj['response']['messages']:
-                    dm_new = DirectMessage()
-                    dm_new.recipient = i["from"]
-                    dm_new.message = i["message"]
-                    dm_new.timestamp = i["timestamp"]
-                    dm_all_list.append(dm_new.__dict__)
-
-                # returns a list of DirectMessage objects containing all messages
-                return dm_all_list
-            
+                self._framer.close()
+            except OSError:
+                pass
+        self._framer = None
+
 
     def extract_json(self, json_msg:str) -> "DataTuple":
         '''
-        Call json.loads function on a json string and then convert the json object into a DataTuple object.
+        Decode a json string with ds_codec and then convert the json object into a DataTuple object.
 
         :param json_msg: A JSON formatted string.
 
         :return: DataTuple
         '''
-        # Create a namedtuple to hold the values we expect to retrieve from json messages.
-        DataTuple = namedtuple('DataTuple', ['type','message','token'])
         try:
-            json_obj = json.loads(json_msg)
+            json_obj = ds_codec.loads(json_msg)
             mtype = json_obj['response']['type']
             message = json_obj['response']['message']
             token = json_obj['response']['token']
-        except json.JSONDecodeError:
+        except ValueError:
              print("Json cannot be decoded.")
 
         return DataTuple(mtype, message, token)
@@ -277,4 +1276,122 @@ class DirectMessenger:
                 return True
             if 'error' in srv_msg:
                 return False
-        
+
+
+def _read_records(lines, in_flight:deque, invalid):
+    """
+    Yield the (message, recipient) or (message, recipient, timestamp) tuples of JSON lines as they are read, putting
+    the line number and recipient of each on in_flight. Lines that are not a record are passed to
+    invalid(line_number, error) instead.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = ds_codec.loads(line)
+            message = record["message"]
+            recipient = record["recipient"]
+            timestamp = record.get("timestamp")
+            if not isinstance(message, str) or not isinstance(recipient, str):
+                raise TypeError("message and recipient must be strings")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            invalid(number, str(e) or type(e).__name__)
+            continue
+        in_flight.append((number, recipient))
+        yield (message, recipient) if timestamp is None else (message, recipient, timestamp)
+
+
+def send_command(args) -> int:
+    """
+    Send the messages of a JSON lines file or standard input over one session, writing the outcome of each to the
+    result file and throughput lines to stderr.
+
+    :param args: The parsed arguments of the send command.
+
+    :return: int, the exit status
+    """
+    servers = [parse_address(address.strip(), PORT) for address in args.server.split(',') if address.strip()]
+    server, port = servers[0]
+    password = args.password or os.environ.get("DS_PASSWORD") or getpass.getpass("Password: ")
+    messenger = DirectMessenger(server, args.username, password, port=port, servers=servers[1:],
+                                token_cache=TokenCache(default_token_path()))
+    source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    results = None if args.results is None else open(args.results, 'w', encoding='utf-8')
+    counts = {"sent": 0, "failed": 0, "invalid": 0}
+    started = time.monotonic()
+
+    def report(final=False):
+        elapsed = time.monotonic() - started
+        done = counts["sent"] + counts["failed"]
+        stats = dict(counts, seconds=round(elapsed, 3), messages_per_sec=round(done / elapsed if elapsed else 0.0, 1))
+        if final:
+            stats["done"] = True
+        print(json.dumps(stats), file=sys.stderr, flush=True)
+
+    def write_result(number, recipient, status, error=None):
+        counts[status] += 1
+        if results is not None:
+            result = {"line": number, "recipient": recipient, "status": status}
+            if error is not None:
+                result["error"] = error
+            results.write(ds_codec.dumps(result) + '\n')
+
+    in_flight = deque()
+    outcomes = None
+    status = 0
+    try:
+        messenger.open()
+        records = _read_records(source, in_flight, lambda number, error: write_result(number, None, 'invalid', error))
+        outcomes = messenger.iter_send(records, args.window)
+        next_report = started + args.stats_interval if args.stats_interval else None
+        for sent in outcomes:
+            number, recipient = in_flight.popleft()
+            write_result(number, recipient, 'sent' if sent else 'failed')
+            if next_report is not None and time.monotonic() >= next_report:
+                report()
+                next_report += args.stats_interval
+    except FailToJoin:
+        print("Failed to join the server. The password is incorrect.", file=sys.stderr)
+        status = 2
+    except OSError as e:
+        print("Failed to connect to the server: " + str(e), file=sys.stderr)
+        status = 2
+    except KeyboardInterrupt:
+        status = 130
+    finally:
+        if outcomes is not None:
+            outcomes.close()
+        messenger.close()
+        if source is not sys.stdin:
+            source.close()
+        if results is not None:
+            results.close()
+    report(final=True)
+    if status == 0 and (counts["failed"] or counts["invalid"]):
+        status = 1
+    return status
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='ds_messenger', description='Use the DS server without the GUI.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    send = commands.add_parser('send', help='send the messages of a JSON lines file',
+                               description='Send direct messages read as JSON lines of {"recipient", "message"} '
+                                           'objects, which may also hold a "timestamp", over one connection.')
+    send.add_argument('input', nargs='?', default='-', help='JSON lines file to send, default standard input')
+    send.add_argument('--username', required=True, help='user to send the messages as')
+    send.add_argument('--password', default=None, help='password of the user, default $DS_PASSWORD or a prompt')
+    send.add_argument('--server', default=os.environ.get("DS_SERVER", "168.235.86.101"),
+                      help='host or host:port of the server, more separated by commas to fail over to, '
+                           'default $DS_SERVER or the official server')
+    send.add_argument('--results', default=None,
+                      help='JSON lines file to write the line number, recipient and status of every record to')
+    send.add_argument('--window', type=int, default=256, help='most messages in flight at a time')
+    send.add_argument('--stats-interval', type=float, default=1.0,
+                      help='seconds between throughput lines on stderr, 0 for none')
+    args = parser.parse_args(argv)
+    return send_command(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+ds_metrics collects opt-in timings and counters from DirectMessenger. Pass a Metrics object to DirectMessenger to
+turn it on; without one the messenger uses NULL_METRICS, whose methods do nothing.
+"""
+import threading
+import time
+
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Metrics:
+    """
+    The Metrics class records how long each phase of a DirectMessenger operation takes, such as 'connect', 'join',
+    'write', 'wait' and 'decode' of a 'send', and counts bytes, messages, errors and reconnects.
+
+    Hooks added with add_hook are called with (operation, phase, seconds) every time a phase is timed.
+    """
+    enabled = True
+    clock = staticmethod(time.perf_counter)
+
+    def __init__(self):
+        """
+        Initializer for Metrics.
+
+        """
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._counters = {}
+        # (operation, phase) -> [count, total seconds, max seconds, bucket counts]
+        self._phases = {}
+
+
+    def add_hook(self, hook):
+        """
+        Call hook(operation, phase, seconds) whenever a phase is timed.
+
+        :param hook: The function to call.
+        """
+        self.hooks.append(hook)
+
+
+    def observe(self, operation:str, phase:str, seconds:float):
+        """
+        Record how long a phase of an operation took.
+
+        :param operation: The operation, such as 'send' or 'retrieve_all'.  
+        :param phase: The phase, such as 'connect' or 'wait'.  
+        :param seconds: How long it took.
+        """
+        key = (operation, phase)
+        with self._lock:
+            stats = self._phases.get(key)
+            if stats is None:
+                stats = self._phases[key] = [0, 0.0, 0.0, [0] * len(BUCKETS)]
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats[3][i] += 1
+                    break
+        for hook in self.hooks:
+            hook(operation, phase, seconds)
+
+
+    def count(self, name:str, n:int=1):
+        """
+        Add to a counter, such as 'bytes_sent', 'messages_received', 'errors' or 'reconnects'.
+
+        :param name: The counter.  
+        :param n: How much to add.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+
+    def reset(self):
+        """
+        Set every counter and timing back to zero.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._phases.clear()
+
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current counters and, for each operation and phase, the number of timings, their total, mean
+        and maximum in seconds, and the histogram bucket counts.
+
+        :return: dict
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            phases = {}
+            for (operation, phase), (n, total, longest, buckets) in self._phases.items():
+                phases[operation + '.' + phase] = {"count": n, "total": total, "mean": total / n, "max": longest,
+                                                   "buckets": dict(zip(map(str, BUCKETS), buckets))}
+        return {"counters": counters, "phases": phases}
+
+
+    def export_text(self, prefix:str='ds') -> str:
+        """
+        Returns the counters and timings in the Prometheus text exposition format, for scraping.
+
+        :param prefix: The prefix of every metric name.
+
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                lines.append('# TYPE ' + prefix + '_' + name + '_total counter')
+                lines.append(prefix + '_' + name + '_total ' + str(value))
+            if self._phases:
+                lines.append('# TYPE ' + prefix + '_phase_seconds histogram')
+            for (operation, phase), (n, total, longest, buckets) in sorted(self._phases.items()):
+                labels = 'operation="' + operation + '",phase="' + phase + '"'
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, buckets):
+                    cumulative += bucket
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(prefix + '_phase_seconds_bucket{' + labels + ',le="' + le + '"} ' + str(cumulative))
+                lines.append(prefix + '_phase_seconds_sum{' + labels + '} ' + repr(total))
+                lines.append(prefix + '_phase_seconds_count{' + labels + '} ' + str(n))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(Metrics):
+    """
+    The NullMetrics class takes the place of Metrics when instrumentation is off. Nothing is recorded.
+    """
+    enabled = False
+    clock = staticmethod(lambda: 0.0)
+
+    def observe(self, operation:str, phase:str, seconds:float):
+        pass
+
+    def count(self, name:str, n:int=1):
+        pass
+
+
+NULL_METRICS = NullMetrics()
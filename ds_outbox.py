@@ -0,0 +1,331 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+import ds_codec
+
+
+QUEUED = 'queued'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+def default_path(dsuserver:str, username:str) -> str:
+    """
+    Returns the default location of the outbox log for a user on a DS server.
+
+    :param dsuserver: The IP address of the DS server.  
+    :param username: The user sending the messages.
+
+    :return: str
+    """
+    return os.path.join(os.path.expanduser('~'), '.ds_messenger', str(dsuserver) + '_' + str(username) + '.outbox')
+
+
+class Outbox:
+    """
+    The Outbox class queues direct messages and sends them in the background. send() writes the message to an
+    append-only log and returns at once; a flusher thread syncs the log to disk, sends whatever is queued in
+    pipelined batches with DirectMessenger.send_outcomes, and logs the outcome of each message.
+
+    A message the server rejects is given up as failed. A message that is lost to a failed connection is tried
+    again after a delay that doubles with every attempt, and while nothing gets through the whole queue waits.
+    Messages still queued when the process stops are read back from the log and sent when an Outbox is created on
+    the same log again.
+    """
+    def __init__(self, messenger, path:str=None, batch_size:int=256, max_attempts:int=None, backoff:float=1.0,
+                 max_backoff:float=300.0, fsync:bool=True, on_status=None):
+        """
+        Initializer for Outbox.
+
+        :param messenger: The DirectMessenger that sends the messages.  
+        :param path: The log file, created along with its folder if it does not exist. None to keep the queue in
+                     memory only.  
+        :param batch_size: The most messages sent in one batch.  
+        :param max_attempts: How many times a message is tried before it is given up as failed, None to keep
+                             trying.  
+        :param backoff: Seconds to wait before trying a message the second time.  
+        :param max_backoff: The most seconds to wait between attempts.  
+        :param fsync: True to make the log durable on disk. The flusher thread syncs it, so send does not wait.  
+        :param on_status: Called as on_status(message_id, status) from the flusher thread when a message is sent
+                          or given up as failed.
+
+        """
+        self.messenger = messenger
+        self.path = path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.fsync = fsync
+        self.on_status = on_status
+        self._cond = threading.Condition()
+        # id -> [message, recipient, timestamp, attempts, time of the next attempt]
+        self._pending = OrderedDict()
+        self._status = {}
+        # while every attempt fails the server is likely down, and nothing is sent until this time
+        self._hold_until = 0.0
+        self._failures = 0
+        self._next_id = 1
+        self._closed = False
+        self._log = None
+        # True while records have been written to the log that have not been synced to disk yet
+        self._unsynced = False
+        if path is not None:
+            self._open_log()
+        self._thread = threading.Thread(target=self._run, name='ds-outbox', daemon=True)
+        self._thread.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def send(self, message:str, recipient:str) -> int:
+        """
+        Queue a direct message to be sent in the background.
+
+        :param message: The message you want to send.  
+        :param recipient: The user you want to send messages to.
+
+        :return: int, the id to look up the status of the message with
+        """
+        with self._cond:
+            if self._closed:
+                raise ValueError("The outbox is closed.")
+            message_id = self._next_id
+            self._next_id += 1
+            timestamp = time.time()
+            self._write([{"op": "add", "id": message_id, "message": message, "recipient": recipient,
+                          "timestamp": timestamp}])
+            self._pending[message_id] = [message, recipient, timestamp, 0, 0.0]
+            self._status[message_id] = QUEUED
+            self._cond.notify()
+        return message_id
+
+
+    def status(self, message_id:int) -> str:
+        """
+        Returns the status of a message: 'queued', 'sent' or 'failed', or None for an unknown id.
+
+        :param message_id: The id send returned.
+
+        :return: str
+        """
+        with self._cond:
+            return self._status.get(message_id)
+
+
+    def pending(self) -> int:
+        """
+        Returns how many messages are queued or being sent.
+
+        :return: int
+        """
+        with self._cond:
+            return len(self._pending)
+
+
+    def flush(self, timeout:float=None) -> bool:
+        """
+        Wait until every queued message has been sent or given up.
+
+        :param timeout: The most seconds to wait, None to wait as long as it takes.
+
+        :return: bool, False if messages were still queued when the timeout ran out
+        """
+        with self._cond:
+            self._poke()
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+
+    def close(self, timeout:float=None):
+        """
+        Stop the flusher and close the log. Messages still queued stay in the log and are sent the next time an
+        Outbox is created on it.
+
+        :param timeout: The most seconds to wait for a batch being sent to finish.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            if self._log is not None:
+                if self._unsynced and self.fsync:
+                    os.fsync(self._log.fileno())
+                self._log.close()
+                self._log = None
+
+
+    def _poke(self):
+        # make every queued message due now
+        self._hold_until = 0.0
+        for entry in self._pending.values():
+            entry[4] = 0.0
+        self._cond.notify_all()
+
+
+    def _run(self):
+        while True:
+            self._sync()
+            with self._cond:
+                batch = self._due()
+                while not batch and not self._closed and not self._unsynced:
+                    self._cond.wait(self._wait_time())
+                    batch = self._due()
+                if self._closed:
+                    return
+            if not batch:
+                continue
+            try:
+                results = self.messenger.send_outcomes([item for _, item in batch])
+            except Exception as e:
+                print("The outbox failed to send a batch: " + str(e))
+                results = [None] * len(batch)
+            self._record(batch, results)
+
+
+    def _sync(self):
+        """
+        Sync the records written to the log to disk, outside the lock, so send is not held up by the disk.
+        """
+        with self._cond:
+            log = self._log if self._unsynced and self.fsync else None
+            self._unsynced = False
+        if log is not None:
+            try:
+                os.fsync(log.fileno())
+            except (OSError, ValueError):
+                # the log was compacted or closed meanwhile, which syncs it as well
+                pass
+
+
+    def _due(self) -> list:
+        now = time.monotonic()
+        batch = []
+        if now < self._hold_until:
+            return batch
+        for message_id, entry in self._pending.items():
+            if entry[4] <= now:
+                batch.append((message_id, tuple(entry[:3])))
+                if len(batch) >= self.batch_size:
+                    break
+        return batch
+
+
+    def _wait_time(self):
+        if not self._pending:
+            return None
+        due = max(self._hold_until, min(entry[4] for entry in self._pending.values()))
+        return max(0.0, due - time.monotonic())
+
+
+    def _record(self, batch:list, results:list):
+        """
+        Log the outcome of a batch, and set when the messages lost to a failed connection are tried again.
+
+        results holds True for a message that was sent, False for one the server rejected and None for one that
+        got no response. Only when no message got a response is the whole queue held back.
+        """
+        changes = []
+        records = []
+        now = time.monotonic()
+        with self._cond:
+            if any(sent is not None for sent in results):
+                self._failures = 0
+                self._hold_until = 0.0
+            else:
+                self._failures += 1
+                self._hold_until = now + self._delay(self._failures)
+            for (message_id, _), sent in zip(batch, results):
+                entry = self._pending.get(message_id)
+                if entry is None:
+                    continue
+                if sent:
+                    status = SENT
+                elif sent is False:
+                    status = FAILED
+                else:
+                    entry[3] += 1
+                    if self.max_attempts is None or entry[3] < self.max_attempts:
+                        entry[4] = now + self._delay(entry[3])
+                        continue
+                    status = FAILED
+                del self._pending[message_id]
+                self._status[message_id] = status
+                records.append({"op": status, "id": message_id})
+                changes.append((message_id, status))
+            self._write(records)
+            if not self._pending and not self._closed:
+                self._compact()
+            self._cond.notify_all()
+        if self.on_status is not None:
+            for message_id, status in changes:
+                self.on_status(message_id, status)
+
+
+    def _delay(self, attempts:int) -> float:
+        return min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+
+
+    def _open_log(self):
+        """
+        Read back the messages the log still holds as queued, then rewrite it with only those.
+        """
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = ds_codec.loads(line)
+                        op = record["op"]
+                        message_id = record["id"]
+                    except (ValueError, KeyError, TypeError):
+                        # a line cut short when the process stopped
+                        continue
+                    self._next_id = max(self._next_id, message_id + 1)
+                    if op == "add":
+                        self._pending[message_id] = [record["message"], record["recipient"], record["timestamp"],
+                                                     0, 0.0]
+                        self._status[message_id] = QUEUED
+                    elif message_id in self._pending:
+                        del self._pending[message_id]
+                        self._status[message_id] = op
+        self._compact()
+
+
+    def _compact(self):
+        """
+        Replace the log with one holding only the queued messages, so it does not grow without end.
+        """
+        if self.path is None:
+            return
+        if self._log is not None:
+            self._log.close()
+        temp = self.path + '.' + secrets.token_hex(4) + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            for message_id, (message, recipient, timestamp, _, _) in self._pending.items():
+                f.write(ds_codec.dumps({"op": "add", "id": message_id, "message": message, "recipient": recipient,
+                                        "timestamp": timestamp}) + '\n')
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self._log = open(self.path, 'a', encoding='utf-8')
+        self._unsynced = False
+
+
+    def _write(self, records:list):
+        if self._log is None or not records:
+            return
+        self._log.write(''.join(ds_codec.dumps(record) + '\n' for record in records))
+        self._log.flush()
+        self._unsynced = True
+        self._cond.notify_all()
@@ -0,0 +1,108 @@
+"""
+ds_poller decides when to ask the DS server for new messages. Polls come quickly while a conversation is active and
+further and further apart while nothing arrives, so an idle client puts almost no load on the server.
+"""
+import time
+
+
+class PollScheduler:
+    """
+    The PollScheduler class keeps the polling interval and the time of the next poll. The interval drops to
+    min_interval when a poll brings messages or the user does something, and is multiplied by backoff after every
+    poll that brings nothing or fails, up to max_interval.
+
+    Views subscribe to the messages instead of polling on their own, so one poll serves all of them. The scheduler
+    does not run the polls itself: the caller asks delay() how long to wait, calls begin() before polling and
+    finish() with the result, which hands new messages to the subscribers.
+    """
+    def __init__(self, min_interval:float=2.0, max_interval:float=120.0, backoff:float=2.0, clock=time.monotonic):
+        """
+        Initializer for PollScheduler.
+
+        :param min_interval: Seconds between polls while messages are arriving.  
+        :param max_interval: The most seconds between polls while idle.  
+        :param backoff: What the interval is multiplied by after a poll that brings nothing.  
+        :param clock: A function returning the current time in seconds.
+
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.clock = clock
+        self.interval = min_interval
+        self.polling = False
+        self._next = clock()
+        self._subscribers = []
+
+
+    def subscribe(self, callback):
+        """
+        Call callback(messages) with the new messages of every poll that brings any.
+
+        :param callback: The function to call.
+        """
+        self._subscribers.append(callback)
+
+
+    def unsubscribe(self, callback):
+        """
+        Stop calling a subscribed function.
+
+        :param callback: The function to stop calling.
+        """
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+
+    def delay(self) -> float:
+        """
+        Returns how many seconds to wait before the next poll.
+
+        :return: float
+        """
+        return max(0.0, self._next - self.clock())
+
+
+    def begin(self) -> bool:
+        """
+        Mark a poll as started. Returns False if one is already running, in which case no other should be started.
+
+        :return: bool
+        """
+        if self.polling:
+            return False
+        self.polling = True
+        return True
+
+
+    def finish(self, messages):
+        """
+        Mark the running poll as finished, set the time of the next one and hand new messages to the subscribers.
+
+        :param messages: The new messages, or False if the poll failed.
+        """
+        self.polling = False
+        if messages:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        self._next = self.clock() + self.interval
+        if messages:
+            for callback in list(self._subscribers):
+                callback(messages)
+
+
+    def activity(self):
+        """
+        Note that the user did something that makes new messages likely, such as sending one, so polls come
+        quickly again.
+        """
+        self.interval = self.min_interval
+        self._next = min(self._next, self.clock() + self.min_interval)
+
+
+    def poll_now(self):
+        """
+        Make the next poll due at once.
+        """
+        self._next = self.clock()
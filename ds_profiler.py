@@ -0,0 +1,366 @@
+"""
+ds_profiler finds out where the Tk main thread spends its time. A StallMonitor measures how late the event loop runs
+a periodic heartbeat, times every Python callback Tk runs, and for each callback that runs longer than a threshold
+records its duration and the stack of the main thread while it was running. The report is written as JSON.
+
+It also generates synthetic history and incoming messages, so stalls can be reproduced without a DS server.
+"""
+import json
+import random
+import string
+import sys
+import threading
+import time
+import tkinter
+import traceback
+from collections import deque
+import ds_store
+from ds_messenger import MessageBatch
+
+
+_original_call = tkinter.CallWrapper.__call__
+
+# the monitor Tk callbacks are reported to, None while none is running
+_active = None
+
+
+def _monitored_call(wrapper, *args):
+    monitor = _active
+    if monitor is None:
+        return _original_call(wrapper, *args)
+    return monitor._time(_callback_target(wrapper.func), _original_call, wrapper, *args)
+
+
+def _callback_target(func):
+    """
+    Returns the function Tk ends up calling, looking through the wrapper root.after puts around it.
+    """
+    if getattr(func, '__qualname__', '').endswith('after.<locals>.callit') and func.__closure__:
+        for cell in func.__closure__:
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                continue
+            if callable(value) and value is not func and not isinstance(value, tkinter.Misc):
+                return value
+    return func
+
+
+def _callback_name(func) -> str:
+    name = getattr(func, '__qualname__', None) or type(func).__qualname__
+    module = getattr(func, '__module__', None)
+    return name if module in (None, '__main__') else module + '.' + name
+
+
+def run(fn, *args):
+    """
+    Call fn(*args), timing it like a Tk callback if a StallMonitor is running. Use it for callbacks that are run
+    from inside another callback, such as the ones BackgroundWorker runs, so they are reported on their own.
+
+    :param fn: The function to call.  
+    :param args: Its arguments.
+    """
+    monitor = _active
+    if monitor is None:
+        return fn(*args)
+    return monitor._time(fn, fn, *args)
+
+
+class StallMonitor:
+    """
+    The StallMonitor class records how responsive the Tk event loop is. While it runs:
+
+    - a heartbeat scheduled with root.after every interval measures how late the event loop gets to it;
+    - every Python callback Tk runs, from bindings, commands and root.after, is timed and added up by name;
+    - a callback that runs longer than the threshold is recorded with its duration and the stack of the main
+      thread, which a watchdog thread samples once the threshold has passed, so it shows where the time went.
+
+    start() replaces tkinter.CallWrapper.__call__, which Tk goes through for every Python callback, so callbacks
+    registered before start() are timed as well as those registered after it.
+    """
+    def __init__(self, root, threshold:float=0.1, interval:float=0.05, max_stalls:int=1000):
+        """
+        Initializer for StallMonitor.
+
+        :param root: The Tk root window.  
+        :param threshold: Seconds a callback has to run to be recorded as a stall.  
+        :param interval: Seconds between heartbeats.  
+        :param max_stalls: The most stalls kept, the longest ones are kept when there are more.
+
+        """
+        self.root = root
+        self.threshold = threshold
+        self.interval = interval
+        self.max_stalls = max_stalls
+        # anything else to put in the report, such as how long the window took to build
+        self.info = {}
+        self._lock = threading.Lock()
+        # [name, start, sampled stack] of the callbacks running, innermost last
+        self._running = []
+        # name -> [calls, total seconds, longest seconds]
+        self._callbacks = {}
+        self._stalls = []
+        self._stall_count = 0
+        self._stalled_seconds = 0.0
+        self._lags = deque(maxlen=100000)
+        self._thread_id = None
+        self._watchdog = None
+        self._stop = threading.Event()
+        self._after = None
+        self._expected = None
+        self._started = None
+        self._stopped = None
+
+
+    def start(self):
+        """
+        Start the heartbeat and the watchdog, and time every Tk callback from now on.
+        """
+        global _active
+        _active = self
+        tkinter.CallWrapper.__call__ = _monitored_call
+        self._thread_id = threading.get_ident()
+        self._started = time.perf_counter()
+        self._stopped = None
+        self._stop.clear()
+        self._expected = self._started + self.interval
+        self._after = self.root.after(int(self.interval * 1000), self._beat)
+        self._watchdog = threading.Thread(target=self._watch, name='ds-stall-watchdog', daemon=True)
+        self._watchdog.start()
+
+
+    def stop(self):
+        """
+        Stop the heartbeat and the watchdog. Callbacks are no longer timed.
+        """
+        global _active
+        if _active is self:
+            _active = None
+            tkinter.CallWrapper.__call__ = _original_call
+        self._stop.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+        if self._after is not None:
+            try:
+                self.root.after_cancel(self._after)
+            except tkinter.TclError:
+                # the window is already destroyed
+                pass
+            self._after = None
+        if self._stopped is None:
+            self._stopped = time.perf_counter()
+
+
+    def report(self, top:int=20) -> dict:
+        """
+        Returns the heartbeat latencies, the callbacks that took the most time in total and the longest stalls.
+
+        :param top: How many callbacks and stalls to list.
+
+        :return: dict
+        """
+        with self._lock:
+            lags = sorted(self._lags)
+            callbacks = sorted(self._callbacks.items(), key=lambda item: item[1][1], reverse=True)
+            stalls = sorted(self._stalls, key=lambda stall: stall["seconds"], reverse=True)
+            stall_count = self._stall_count
+            stalled_seconds = self._stalled_seconds
+        end = self._stopped or time.perf_counter()
+
+        def percentile(share):
+            return lags[min(len(lags) - 1, int(share * len(lags)))] if lags else 0.0
+
+        report = dict(self.info)
+        report.update({
+            "seconds": end - self._started if self._started is not None else 0.0,
+            "threshold": self.threshold,
+            "heartbeat": {"interval": self.interval, "beats": len(lags),
+                          "mean_lag": sum(lags) / len(lags) if lags else 0.0,
+                          "p50_lag": percentile(0.5), "p95_lag": percentile(0.95), "p99_lag": percentile(0.99),
+                          "max_lag": lags[-1] if lags else 0.0},
+            "stalls": stall_count,
+            "stalled_seconds": stalled_seconds,
+            "callbacks": [{"name": name, "calls": calls, "seconds": total, "max_seconds": longest}
+                          for name, (calls, total, longest) in callbacks[:top]],
+            "longest_stalls": stalls[:top],
+        })
+        return report
+
+
+    def write_report(self, path:str=None):
+        """
+        Write the report as JSON, and a one line summary to stderr.
+
+        :param path: The file to write, None for stderr.
+        """
+        report = self.report()
+        text = json.dumps(report, indent=2)
+        if path is None:
+            print(text, file=sys.stderr)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+        heartbeat = report["heartbeat"]
+        print("{} stalls over {:.0f} ms, {:.3f} s stalled, event loop lag p99 {:.1f} ms, max {:.1f} ms".format(
+            report["stalls"], self.threshold * 1000, report["stalled_seconds"], heartbeat["p99_lag"] * 1000,
+            heartbeat["max_lag"] * 1000), file=sys.stderr)
+
+
+    def _beat(self):
+        now = time.perf_counter()
+        with self._lock:
+            self._lags.append(max(0.0, now - self._expected))
+        self._expected = now + self.interval
+        if not self._stop.is_set():
+            self._after = self.root.after(int(self.interval * 1000), self._beat)
+
+
+    def _time(self, target, call, *args):
+        """
+        Call call(*args), timing it under the name of target.
+        """
+        if getattr(target, '__self__', None) is self:
+            return call(*args)
+        name = _callback_name(target)
+        entry = [name, time.perf_counter(), None]
+        with self._lock:
+            self._running.append(entry)
+        try:
+            return call(*args)
+        finally:
+            seconds = time.perf_counter() - entry[1]
+            with self._lock:
+                # callbacks nest, so this is the innermost one
+                self._running.pop()
+                stats = self._callbacks.get(name)
+                if stats is None:
+                    stats = self._callbacks[name] = [0, 0.0, 0.0]
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+                if seconds >= self.threshold:
+                    self._add_stall({"name": name, "seconds": seconds, "at": entry[1] - self._started,
+                                     "stack": entry[2]})
+
+
+    def _add_stall(self, stall:dict):
+        self._stall_count += 1
+        self._stalled_seconds += stall["seconds"]
+        self._stalls.append(stall)
+        if len(self._stalls) > 2 * self.max_stalls:
+            self._stalls.sort(key=lambda item: item["seconds"], reverse=True)
+            del self._stalls[self.max_stalls:]
+
+
+    def _watch(self):
+        """
+        Sample the stack of the main thread once for every callback that runs past the threshold.
+        """
+        while not self._stop.wait(self.threshold / 2):
+            now = time.perf_counter()
+            with self._lock:
+                if not self._running:
+                    continue
+                entry = self._running[-1]
+                if entry[2] is not None or now - entry[1] < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self._thread_id)
+                entry[2] = traceback.format_stack(frame) if frame is not None else []
+
+
+def synthetic_store(senders:int, messages:int, size:int=40, seed:int=None) -> ds_store.MessageStore:
+    """
+    Returns an in-memory MessageStore filled with messages from made-up senders.
+
+    :param senders: How many senders.  
+    :param messages: How many messages from each sender.  
+    :param size: How many characters each message has.  
+    :param seed: The seed of the random messages, None for a different history every time.
+
+    :return: ds_store.MessageStore
+    """
+    rng = random.Random(seed)
+    store = ds_store.MessageStore()
+    now = time.time()
+    # every sender gets exactly `messages` messages, in a random order
+    order = ['user' + str(i) for i in range(senders) for _ in range(messages)]
+    rng.shuffle(order)
+    total = len(order)
+    batch = MessageBatch()
+    for i, name in enumerate(order):
+        batch.append(name, _text(rng, size), now - (total - i))
+        if len(batch) >= 10000:
+            store.add(batch)
+            batch = MessageBatch()
+    store.add(batch)
+    store.mark_synced()
+    return store
+
+
+class OfflineMessenger:
+    """
+    The OfflineMessenger class stands in for DirectMessenger when there is no server. It holds the store and
+    rejects every message sent without touching the network, so sent messages end up failed.
+    """
+    def __init__(self, username:str, store):
+        """
+        Initializer for OfflineMessenger.
+
+        :param username: The user sending the messages.  
+        :param store: The MessageStore the GUI reads the history from.
+
+        """
+        self.username = username
+        self.store = store
+
+
+    def send(self, message:str, recipient:str) -> bool:
+        return False
+
+
+    def send_many(self, messages, window:int=256) -> list:
+        return [False for _ in messages]
+
+
+    def send_outcomes(self, messages, window:int=256) -> list:
+        return [False for _ in messages]
+
+
+class SyntheticFeed:
+    """
+    The SyntheticFeed class stands in for DirectMessenger.sync when there is no server. Every call writes a burst of
+    made-up messages from random senders into the store and returns them.
+    """
+    def __init__(self, store, senders:int, burst:int=50, size:int=40, seed:int=None):
+        """
+        Initializer for SyntheticFeed.
+
+        :param store: The MessageStore to write the messages into.  
+        :param senders: How many senders the messages come from.  
+        :param burst: The most messages a call brings.  
+        :param size: How many characters each message has.  
+        :param seed: The seed of the random messages.
+
+        """
+        self.store = store
+        self.senders = max(1, senders)
+        self.burst = burst
+        self.size = size
+        self._rng = random.Random(seed)
+
+
+    def __call__(self) -> list:
+        batch = MessageBatch()
+        now = time.time()
+        for _ in range(self._rng.randint(0, self.burst)):
+            batch.append('user' + str(self._rng.randrange(self.senders)), _text(self._rng, self.size), now)
+        return self.store.add(batch)
+
+
+# the words made-up messages are written with
+_WORDS = [''.join(random.Random(i).choices(string.ascii_lowercase, k=1 + i % 9)) for i in range(500)]
+
+
+def _text(rng, size:int) -> str:
+    return ' '.join(rng.choices(_WORDS, k=max(1, size // 6)))
@@ -1,4 +1,5 @@
 import time
+import ds_codec
 
 
 """
@@ -8,7 +9,7 @@ the JSON string will be used to join the server.
 """
 def join(server:str, username:str, password:str) -> str:
 
-    join_msg = '{"join": {"username": "' + username + '","password": "' + password + '","token":""}}'
+    join_msg = ds_codec.dumps({"join": {"username": username, "password": password, "token": ""}})
         
     return join_msg
 
@@ -19,7 +20,7 @@ post will format a journal post for the current user and return a JSON string.
 """
 def post(token:str, entry:str, reci:str, time:str) -> str:
 
-    post_msg = '{"token":"' + token + '", "directmessage": {"entry": "' + entry + '","recipient":"' + reci + '", "timestamp": "' + time + '"}}'
+    post_msg = ds_codec.dumps({"token": token, "directmessage": {"entry": entry, "recipient": reci, "timestamp": time}})
 
     return post_msg
 
@@ -32,10 +33,18 @@ def bio(token:str, bio:str) ->str:
     # create a timestamp for a bio
     bio_time = str(time.time())
     
-    bio_msg = '{"token":"' + token + '", "bio": {"entry": "' + bio + '","timestamp": "' + bio_time + '"}}'
+    bio_msg = ds_codec.dumps({"token": token, "bio": {"entry": bio, "timestamp": bio_time}})
 
     return bio_msg
 
+
+"""
+retrieve will format a request for unread ('new') or all ('all') direct messages and return a JSON string.
+
+"""
+def retrieve(token:str, status:str) -> str:
+
+    return ds_codec.dumps({"token": token, "directmessage": status})
+
     
     
-
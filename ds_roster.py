@@ -0,0 +1,196 @@
+"""
+ds_roster keeps the list of users the GUI shows, with how many messages each has sent, how many of them are unread
+and when the last one arrived. The list is kept sorted as messages arrive, so a view only has to ask for the rows
+it displays.
+"""
+from bisect import bisect_left, insort
+
+
+# the orders the roster can be sorted in
+ACTIVITY = 'activity'
+NAME = 'name'
+ADDED = 'added'
+
+# the fields of a roster entry
+_COUNT, _UNREAD, _LAST, _ADDED = range(4)
+
+
+class Roster:
+    """
+    The Roster class keeps the users of a conversation list keyed by username. Counting a message updates the
+    counters of its sender in constant time, and moves the sender to its new place in the sorted order with a
+    binary search instead of sorting the whole list again.
+
+    The order is by most recent activity, by name, or by when the user was added. version is incremented on every
+    change, so views can tell whether they have to redraw.
+    """
+    def __init__(self, order:str=ACTIVITY):
+        """
+        Initializer for Roster.
+
+        :param order: ACTIVITY for the most recently active users first, NAME for alphabetical order or ADDED for
+                      the order the users were added in.
+
+        """
+        if order not in (ACTIVITY, NAME, ADDED):
+            raise ValueError("Unknown roster order: " + str(order))
+        self.order = order
+        self.version = 0
+        # username -> [messages, unread messages, time of the last message, when it was added]
+        self._entries = {}
+        # the sort keys of the users, in order; the username is the last item of each key
+        self._keys = []
+        self._added = 0
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def __contains__(self, username:str) -> bool:
+        return username in self._entries
+
+
+    def add(self, username:str, count:int=0, last_activity:float=0.0) -> bool:
+        """
+        Add a user to the roster.
+
+        :param username: The user to add.  
+        :param count: How many messages the user has sent already.  
+        :param last_activity: The time of the last of those messages.
+
+        :return: bool, False if the user was in the roster already
+        """
+        if username in self._entries:
+            return False
+        self._added += 1
+        entry = [count, 0, last_activity, self._added]
+        self._entries[username] = entry
+        insort(self._keys, self._key(username, entry))
+        self.version += 1
+        return True
+
+
+    def message(self, username:str, timestamp:float, unread:bool=True):
+        """
+        Count a message from a user, adding the user if they are not in the roster yet.
+
+        :param username: The user who sent the message.  
+        :param timestamp: When the message was sent.  
+        :param unread: False if the message is being read as it arrives.
+        """
+        entry = self._entries.get(username)
+        if entry is None:
+            self.add(username)
+            entry = self._entries[username]
+        old_key = self._key(username, entry)
+        entry[_COUNT] += 1
+        if unread:
+            entry[_UNREAD] += 1
+        if timestamp > entry[_LAST]:
+            entry[_LAST] = timestamp
+            if self.order == ACTIVITY:
+                self._move(old_key, self._key(username, entry))
+        self.version += 1
+
+
+    def mark_read(self, username:str):
+        """
+        Mark every message of a user as read.
+
+        :param username: The user whose messages were read.
+        """
+        entry = self._entries.get(username)
+        if entry is not None and entry[_UNREAD]:
+            entry[_UNREAD] = 0
+            self.version += 1
+
+
+    def unread(self, username:str) -> int:
+        """
+        Returns how many messages of a user are unread.
+
+        :param username: The user.
+
+        :return: int
+        """
+        entry = self._entries.get(username)
+        return 0 if entry is None else entry[_UNREAD]
+
+
+    def count(self, username:str) -> int:
+        """
+        Returns how many messages a user has sent.
+
+        :param username: The user.
+
+        :return: int
+        """
+        entry = self._entries.get(username)
+        return 0 if entry is None else entry[_COUNT]
+
+
+    def last_activity(self, username:str) -> float:
+        """
+        Returns the time of the last message of a user, 0 if there is none.
+
+        :param username: The user.
+
+        :return: float
+        """
+        entry = self._entries.get(username)
+        return 0.0 if entry is None else entry[_LAST]
+
+
+    def set_order(self, order:str):
+        """
+        Sort the roster in another order.
+
+        :param order: ACTIVITY, NAME or ADDED.
+        """
+        if order not in (ACTIVITY, NAME, ADDED):
+            raise ValueError("Unknown roster order: " + str(order))
+        if order == self.order:
+            return
+        self.order = order
+        self._keys = sorted(self._key(username, entry) for username, entry in self._entries.items())
+        self.version += 1
+
+
+    def rows(self, start:int, stop:int) -> list:
+        """
+        Returns the usernames at positions start to stop of the sorted roster.
+
+        :param start: The first position.  
+        :param stop: The position after the last.
+
+        :return: list
+        """
+        return [key[-1] for key in self._keys[start:stop]]
+
+
+    def index(self, username:str) -> int:
+        """
+        Returns the position of a user in the sorted roster, or -1 if they are not in it.
+
+        :param username: The user.
+
+        :return: int
+        """
+        entry = self._entries.get(username)
+        if entry is None:
+            return -1
+        return bisect_left(self._keys, self._key(username, entry))
+
+
+    def _key(self, username:str, entry:list) -> tuple:
+        if self.order == ACTIVITY:
+            return (-entry[_LAST], entry[_ADDED], username)
+        if self.order == NAME:
+            return (username.lower(), username)
+        return (entry[_ADDED], username)
+
+
+    def _move(self, old_key:tuple, new_key:tuple):
+        del self._keys[bisect_left(self._keys, old_key)]
+        insort(self._keys, new_key)
@@ -0,0 +1,221 @@
+"""
+ds_server is a local stand-in for the DS server, for offline development, load testing and benchmarks. It speaks the
+same newline-delimited JSON protocol and keeps every user's mailbox in memory.
+
+Run it with:
+
+    [YOUR PYTHON] -m ds_server [--host HOST] [--port PORT] [--latency SECONDS] [--error-rate RATE]
+
+and point DirectMessenger at the host it listens on.
+"""
+import argparse
+import asyncio
+import random
+import secrets
+import time
+import ds_codec
+from ds_messenger import PORT
+
+
+class LocalDSServer:
+    """
+    The LocalDSServer class answers join, directmessage and bio requests like the DS server does. Users are created
+    the first time they join. Mailboxes live in memory and are lost when the server stops.
+
+    For testing, every response can be delayed, a share of requests can be answered with errors, and 'all' and 'new'
+    retrievals can be padded with generated messages.
+    """
+    def __init__(self, host:str='127.0.0.1', port:int=PORT, latency:float=0.0, error_rate:float=0.0,
+                 history_size:int=0, message_size:int=32, seed:int=None):
+        """
+        Initializer for LocalDSServer.
+
+        :param host: The address to listen on.  
+        :param port: The port to listen on, 0 for any free port.  
+        :param latency: Seconds to wait before each response.  
+        :param error_rate: The share of requests, from 0 to 1, answered with an error instead of being handled.  
+        :param history_size: How many generated messages to add to each user's mailbox when they first join.  
+        :param message_size: The length of each generated message.  
+        :param seed: Seed for the random error injection.
+
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.history_size = history_size
+        self.message_size = message_size
+        self._random = random.Random(seed)
+        self._passwords = {}
+        self._tokens = {}
+        self._user_tokens = {}
+        self._bios = {}
+        # username -> list of messages as they are sent in responses
+        self._mailboxes = {}
+        # username -> how many messages of their mailbox have been retrieved as 'new'
+        self._read = {}
+        self._server = None
+        self.requests = 0
+
+
+    async def start(self):
+        """
+        Start listening. If the port was 0, self.port is set to the port chosen.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=2 ** 26)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+
+    async def serve_forever(self):
+        """
+        Start listening and handle connections until cancelled.
+        """
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+
+    async def close(self):
+        """
+        Stop listening and close the server.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+    def handle_request(self, request:dict) -> dict:
+        """
+        Handle one decoded request. Like the DS server, a token is accepted on any connection, joined or not,
+        until the server stops.
+
+        :param request: The decoded JSON request.
+
+        :return: dict
+        """
+        self.requests += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._error("Injected error.")
+
+        if 'join' in request:
+            return self._join(request['join'])
+
+        user = self._tokens.get(request.get('token'))
+        if user is None:
+            return self._error("Invalid user token.")
+        if 'directmessage' in request:
+            dm = request['directmessage']
+            if isinstance(dm, dict):
+                return self._post(user, dm)
+            if dm in ('new', 'all'):
+                return self._retrieve(user, dm)
+            return self._error("Invalid directmessage request.")
+        if 'bio' in request:
+            self._bios[user] = request['bio'].get('entry', '')
+            return {"response": {"type": "ok", "message": "Bio published to DS server."}}
+        return self._error("Invalid request.")
+
+
+    async def _handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = ds_codec.loads(line)
+                except ValueError:
+                    response = self._error("Invalid JSON.")
+                else:
+                    response = self.handle_request(request)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write((ds_codec.dumps(response) + '\n').encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+    def _join(self, join:dict) -> dict:
+        username = join.get('username')
+        password = join.get('password')
+        if not username or not password:
+            return self._error("Username and password are required.")
+        if username not in self._passwords:
+            self._passwords[username] = password
+            # generated history comes before anything sent to the user before they joined, and counts as read
+            generated = self._generated_history(username)
+            self._mailboxes[username] = generated + self._mailboxes.get(username, [])
+            self._read[username] = len(generated)
+        elif self._passwords[username] != password:
+            return self._error("Invalid password or username already taken")
+        token = self._token_of(username)
+        return {"response": {"type": "ok", "message": "Welcome to the ICS 32 Distributed Social!", "token": token}}
+
+
+    def _post(self, user:str, dm:dict) -> dict:
+        recipient = dm.get('recipient')
+        entry = dm.get('entry')
+        if not recipient or entry is None:
+            return self._error("Recipient and entry are required.")
+        self._mailboxes.setdefault(recipient, []).append({"message": entry, "from": user,
+                                                          "timestamp": str(dm.get('timestamp', time.time()))})
+        return {"response": {"type": "ok", "message": "Direct message sent"}}
+
+
+    def _retrieve(self, user:str, status:str) -> dict:
+        # 'all' returns the whole mailbox, 'new' what has arrived since the last 'new'
+        mailbox = self._mailboxes.setdefault(user, [])
+        if status == 'all':
+            return {"response": {"type": "ok", "messages": mailbox}}
+        read = self._read.get(user, 0)
+        self._read[user] = len(mailbox)
+        return {"response": {"type": "ok", "messages": mailbox[read:]}}
+
+
+    def _generated_history(self, username:str) -> list:
+        start = time.time() - self.history_size
+        text = ('generated message for ' + username + ' ' * self.message_size)[:self.message_size]
+        return [{"message": text, "from": 'sender' + str(i % 100), "timestamp": str(start + i)}
+                for i in range(self.history_size)]
+
+
+    def _token_of(self, username:str) -> str:
+        token = self._user_tokens.get(username)
+        if token is None:
+            token = secrets.token_hex(16)
+            self._tokens[token] = username
+            self._user_tokens[username] = token
+        return token
+
+
+    def _error(self, message:str) -> dict:
+        return {"response": {"type": "error", "message": message}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='ds_server', description='Run a local stand-in DS server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with an error')
+    parser.add_argument('--history-size', type=int, default=0, help='generated messages in each new mailbox')
+    parser.add_argument('--message-size', type=int, default=32, help='length of each generated message')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    server = LocalDSServer(args.host, args.port, args.latency, args.error_rate, args.history_size,
+                           args.message_size, args.seed)
+    print("DS server listening on " + args.host + ":" + str(args.port))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
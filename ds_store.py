@@ -0,0 +1,322 @@
+import os
+import sqlite3
+import threading
+from ds_messenger import MessageBatch
+
+
+# how much of a database file is read through mmap
+MMAP_SIZE = 2 ** 30
+
+
+def default_path(dsuserver:str, username:str) -> str:
+    """
+    Returns the default location of the message store for a user on a DS server.
+
+    :param dsuserver: The IP address of the DS server.  
+    :param username: The user the messages belong to.
+
+    :return: str
+    """
+    return os.path.join(os.path.expanduser('~'), '.ds_messenger', str(dsuserver) + '_' + str(username) + '.sqlite3')
+
+
+class MessageStore:
+    """
+    The MessageStore class keeps the messages a user has received in a local SQLite database, indexed by sender and
+    timestamp. A message that is already stored is dropped when it is added again, so the responses of
+    "retrieve_all" and "retrieve_new" can both be written into the store as they are.
+
+    Each sender's messages are indexed in the order they arrived, and a senders table keeps every sender with the
+    number of their messages, so the list of senders and the latest page of a conversation are read without going
+    through the whole history. File databases are read through mmap.
+
+    The text of every message is also kept in a full-text index, an SQLite FTS5 table updated by a trigger as
+    messages are added, which search() looks words up in. Without FTS5 in the SQLite library, search() scans.
+    """
+    def __init__(self, path:str=':memory:'):
+        """
+        Initializer for MessageStore.
+
+        :param path: The database file, created along with its folder if it does not exist.
+
+        """
+        if path != ':memory:':
+            folder = os.path.dirname(os.path.abspath(path))
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            # appends go to the write-ahead log and reads come straight from the mapped file
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA mmap_size = ' + str(MMAP_SIZE))
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                             'id INTEGER PRIMARY KEY, sender TEXT NOT NULL, message TEXT NOT NULL, '
+                             'timestamp REAL NOT NULL, UNIQUE (sender, timestamp, message))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS messages_by_time ON messages (timestamp)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (sender, id)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._create_senders()
+            self._fts = self._create_index()
+
+
+    def _create_senders(self):
+        """
+        Create the senders table if it does not exist yet, filling it from the messages already stored.
+        """
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'senders'").fetchone()
+        if exists:
+            return
+        self._db.execute('CREATE TABLE senders (sender TEXT PRIMARY KEY, first_id INTEGER NOT NULL, '
+                         'last_id INTEGER NOT NULL, count INTEGER NOT NULL, last_timestamp REAL NOT NULL)')
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS senders_add AFTER INSERT ON messages BEGIN '
+                         'INSERT INTO senders (sender, first_id, last_id, count, last_timestamp) '
+                         'VALUES (new.sender, new.id, new.id, 1, new.timestamp) '
+                         'ON CONFLICT (sender) DO UPDATE SET last_id = new.id, count = count + 1, '
+                         'last_timestamp = MAX(last_timestamp, new.timestamp); END')
+        self._db.execute('INSERT INTO senders (sender, first_id, last_id, count, last_timestamp) '
+                         'SELECT sender, MIN(id), MAX(id), COUNT(*), MAX(timestamp) FROM messages GROUP BY sender')
+
+
+    def _create_index(self) -> bool:
+        """
+        Create the full-text index if it does not exist yet, indexing the messages already stored. Returns False
+        if the SQLite library has no FTS5.
+        """
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        if exists:
+            return True
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(message, content='messages', "
+                             "content_rowid='id', prefix='2 3', tokenize='unicode61 remove_diacritics 2')")
+        except sqlite3.OperationalError:
+            return False
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS messages_fts_add AFTER INSERT ON messages BEGIN '
+                         'INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message); END')
+        self._db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        return True
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
+
+
+    @property
+    def synced(self) -> bool:
+        """
+        True once a full history has been written into the store.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'synced'").fetchone()
+        return row is not None
+
+
+    def mark_synced(self):
+        """
+        Record that a full history has been written into the store.
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced', '1')")
+
+
+    @property
+    def bio_hash(self) -> str:
+        """
+        The hash of the last bio the server accepted, or None if none is recorded.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'bio_hash'").fetchone()
+        return None if row is None else row[0]
+
+
+    def mark_bio(self, digest:str):
+        """
+        Record the hash of a bio the server accepted.
+
+        :param digest: The hash of the bio.
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bio_hash', ?)", (digest,))
+
+
+    def add(self, messages) -> list:
+        """
+        Write messages into the store, dropping the ones that are already stored.
+
+        :param messages: An iterable of DirectMessage objects, or dicts with the same keys.
+
+        :return: list of the messages that were not stored before
+        """
+        added = []
+        with self._lock, self._db:
+            for m in messages:
+                cursor = self._db.execute('INSERT OR IGNORE INTO messages (sender, message, timestamp) VALUES (?, ?, ?)',
+                                          (m['recipient'], m['message'], float(m['timestamp'])))
+                if cursor.rowcount:
+                    added.append(m)
+        return added
+
+
+    def senders(self) -> list:
+        """
+        Returns the users who have sent messages, in the order their first message arrived.
+
+        :return: list
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT sender FROM senders ORDER BY first_id').fetchall()
+        return [row[0] for row in rows]
+
+
+    def sender_activity(self) -> list:
+        """
+        Returns every user who has sent messages with the number of their messages and the timestamp of the latest
+        one, in the order their first message arrived.
+
+        :return: list of (sender, count, last timestamp) tuples
+        """
+        with self._lock:
+            return self._db.execute('SELECT sender, count, last_timestamp FROM senders ORDER BY first_id').fetchall()
+
+
+    def messages(self, sender:str=None, since:float=None, limit:int=None) -> MessageBatch:
+        """
+        Returns stored messages, oldest first, as a MessageBatch.
+
+        :param sender: Only return messages from this user.  
+        :param since: Only return messages with a later timestamp.  
+        :param limit: Only return this many of the most recent messages.
+
+        :return: MessageBatch
+        """
+        query = 'SELECT sender, message, timestamp FROM messages'
+        where = []
+        args = []
+        if sender is not None:
+            where.append('sender = ?')
+            args.append(sender)
+        if since is not None:
+            where.append('timestamp > ?')
+            args.append(since)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY timestamp DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+        rows.reverse()
+        batch = MessageBatch()
+        for sender, message, timestamp in rows:
+            batch.append(sender, message, timestamp)
+        return batch
+
+
+    def page(self, sender:str, before:int=None, limit:int=500) -> tuple:
+        """
+        Returns one page of a user's messages, the most recent ones before a position, oldest first. Reading a page
+        takes the same time whatever the size of the history.
+
+        :param sender: The user whose messages to return.  
+        :param before: The position returned with the page after this one, None for the most recent page.  
+        :param limit: The most messages on the page.
+
+        :return: tuple of the MessageBatch and the position to read the page before it from, None if there is none
+        """
+        query = 'SELECT id, message, timestamp FROM messages WHERE sender = ?'
+        args = [sender]
+        if before is not None:
+            query += ' AND id < ?'
+            args.append(before)
+        query += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+        rows.reverse()
+        batch = MessageBatch()
+        for _, message, timestamp in rows:
+            batch.append(sender, message, timestamp)
+        cursor = rows[0][0] if len(rows) == limit else None
+        return batch, cursor
+
+
+    def search(self, text:str, sender:str=None, since:float=None, until:float=None, limit:int=100) -> MessageBatch:
+        """
+        Returns the most recently stored messages containing every word of the text, oldest first, as a
+        MessageBatch. Words match case-insensitively and as prefixes, so "hel" finds "Hello".
+
+        :param text: The words to look for. Empty to match every message.  
+        :param sender: Only return messages from this user.  
+        :param since: Only return messages with this timestamp or later.  
+        :param until: Only return messages with this timestamp or earlier.  
+        :param limit: The most messages to return, None for all of them.
+
+        :return: MessageBatch
+        """
+        words = text.split()
+        where = []
+        args = []
+        if words and self._fts:
+            # every word is quoted, so nothing the user types is read as FTS5 query syntax
+            query = ('SELECT m.sender, m.message, m.timestamp FROM messages_fts '
+                     'JOIN messages m ON m.id = messages_fts.rowid')
+            where.append('messages_fts MATCH ?')
+            args.append(' '.join('"' + word.replace('"', '""') + '"*' for word in words))
+            order = ' ORDER BY messages_fts.rowid DESC'
+        else:
+            query = 'SELECT m.sender, m.message, m.timestamp FROM messages m'
+            for word in words:
+                where.append("m.message LIKE ? ESCAPE '\\'")
+                args.append('%' + word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+            order = ' ORDER BY m.id DESC'
+        if sender is not None:
+            where.append('m.sender = ?')
+            args.append(sender)
+        if since is not None:
+            where.append('m.timestamp >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('m.timestamp <= ?')
+            args.append(until)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += order
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+        rows.reverse()
+        batch = MessageBatch()
+        for sender, message, timestamp in rows:
+            batch.append(sender, message, timestamp)
+        return batch
+
+
+    def count(self, sender:str=None) -> int:
+        """
+        Returns the number of stored messages, from one user if a sender is given.
+
+        :param sender: Only count messages from this user.
+
+        :return: int
+        """
+        with self._lock:
+            if sender is None:
+                return self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+            row = self._db.execute('SELECT count FROM senders WHERE sender = ?', (sender,)).fetchone()
+        return 0 if row is None else row[0]
@@ -0,0 +1,149 @@
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+
+
+def default_path() -> str:
+    """
+    Returns the default location of the token cache file.
+
+    :return: str
+    """
+    return os.path.join(os.path.expanduser('~'), '.ds_messenger', 'tokens.json')
+
+
+class TokenCache:
+    """
+    The TokenCache class remembers the token the DS server gave each user, keyed by server, port and username, so
+    that DirectMessenger can send requests without joining first.
+
+    Tokens are kept in memory, and in a JSON file readable only by its owner when a path is given. The file holds
+    a salted PBKDF2 hash of the password next to each token, never the password itself. A token is only handed out
+    for the password it was issued to, so a wrong password still fails to join.
+    """
+    def __init__(self, path:str=None, iterations:int=100000):
+        """
+        Initializer for TokenCache.
+
+        :param path: The file the tokens are kept in, created along with its folder if it does not exist. None
+                     to keep them in memory only.  
+        :param iterations: The PBKDF2 iterations used to hash passwords in the file.
+
+        """
+        self.path = path
+        self.iterations = iterations
+        self._lock = threading.Lock()
+        # key -> {"token", "salt", "check"}
+        self._entries = {}
+        # (key, password) pairs already checked against the file this run
+        self._checked = {}
+        if path is not None:
+            self._entries = self._load()
+
+
+    def get(self, dsuserver:str, port:int, username:str, password:str) -> str:
+        """
+        Returns the cached token of a user on a DS server, or None.
+
+        :param dsuserver: The IP address of the DS server.  
+        :param port: The port of the DS server.  
+        :param username: The user the token belongs to.  
+        :param password: The password of the user.
+
+        :return: str
+        """
+        key = self._key(dsuserver, port, username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            token = self._checked.get((key, password))
+            if token == entry["token"]:
+                return token
+            if not hmac.compare_digest(self._hash(password, entry["salt"]), entry["check"]):
+                return None
+            self._checked[(key, password)] = entry["token"]
+            return entry["token"]
+
+
+    def put(self, dsuserver:str, port:int, username:str, password:str, token:str):
+        """
+        Remember the token the DS server gave a user.
+
+        :param dsuserver: The IP address of the DS server.  
+        :param port: The port of the DS server.  
+        :param username: The user the token belongs to.  
+        :param password: The password the user joined with.  
+        :param token: The token.
+        """
+        key = self._key(dsuserver, port, username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["token"] == token and self._checked.get((key, password)) == token:
+                return
+            salt = secrets.token_hex(16)
+            self._entries[key] = {"token": token, "salt": salt, "check": self._hash(password, salt)}
+            self._checked = {checked: t for checked, t in self._checked.items() if checked[0] != key}
+            self._checked[(key, password)] = token
+            self._save()
+
+
+    def discard(self, dsuserver:str, port:int, username:str):
+        """
+        Forget the token of a user, such as after the DS server rejected it.
+
+        :param dsuserver: The IP address of the DS server.  
+        :param port: The port of the DS server.  
+        :param username: The user the token belongs to.
+        """
+        key = self._key(dsuserver, port, username)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._checked = {checked: t for checked, t in self._checked.items() if checked[0] != key}
+                self._save()
+
+
+    def _key(self, dsuserver:str, port:int, username:str) -> str:
+        return str(dsuserver) + ':' + str(port) + '/' + str(username)
+
+
+    def _hash(self, password:str, salt:str) -> str:
+        if self.path is None:
+            # nothing is written to disk, so there is no need to slow down guessing
+            return hashlib.sha256((salt + str(password)).encode()).hexdigest()
+        return hashlib.pbkdf2_hmac('sha256', str(password).encode(), bytes.fromhex(salt), self.iterations).hex()
+
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return {key: entry for key, entry in entries.items()
+                if isinstance(entry, dict) and {"token", "salt", "check"} <= entry.keys()}
+
+
+    def _save(self):
+        if self.path is None:
+            return
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        # write a private temporary file and move it into place, so the file is never half written or readable
+        # by other users
+        temp = self.path + '.' + secrets.token_hex(4) + '.tmp'
+        try:
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temp, self.path)
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
@@ -0,0 +1,43 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+# the modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ds_server import LocalDSServer
+
+
+@pytest.fixture
+def ds_server():
+    """
+    Returns a factory that runs a LocalDSServer on a thread of its own and returns it once it listens.
+    """
+    loops = []
+
+    def serve(**options):
+        server = LocalDSServer(port=0, **options)
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(server.start())
+            ready.set()
+            loop.run_forever()
+            loop.run_until_complete(server.close())
+            loop.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        ready.wait(5)
+        loops.append((loop, thread))
+        return server
+
+    yield serve
+    for loop, thread in loops:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
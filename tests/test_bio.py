@@ -0,0 +1,90 @@
+import threading
+import time
+
+import ds_messenger
+from ds_metrics import Metrics
+
+
+def recording(server):
+    """
+    Make the server record the entry of every bio request it handles, in order.
+    """
+    bios = []
+    handle = server.handle_request
+
+    def handle_request(request):
+        if 'bio' in request:
+            bios.append(request['bio'].get('entry', ''))
+        return handle(request)
+
+    server.handle_request = handle_request
+    return bios
+
+
+def test_only_the_last_of_quick_bios_is_sent(ds_server):
+    server = ds_server()
+    bios = recording(server)
+    metrics = Metrics()
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, metrics=metrics)
+    for bio in ('first', 'second', 'last'):
+        messenger.set_bio(bio, delay=0.2)
+    deadline = time.monotonic() + 5
+    while not bios and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.3)
+    assert bios == ['last']
+    assert server._bios['ana'] == 'last'
+    assert metrics.snapshot()["counters"]["bios_sent"] == 1
+    messenger.close()
+    assert bios == ['last']
+
+
+def test_close_sends_the_pending_bio(ds_server):
+    server = ds_server()
+    bios = recording(server)
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port)
+    messenger.set_bio('before', delay=60)
+    messenger.set_bio('pending', delay=60)
+    assert bios == []
+    messenger.close()
+    assert bios == ['pending']
+    assert server._bios['ana'] == 'pending'
+    # the timer was cancelled, so nothing is sent again later
+    assert messenger.flush_bio() is True
+    assert bios == ['pending']
+
+
+def test_bios_set_while_one_is_sent_coalesce(ds_server):
+    server = ds_server(latency=0.1)
+    bios = recording(server)
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port)
+    results = {}
+
+    def update(bio):
+        results[bio] = messenger.bio(bio)
+
+    first = threading.Thread(target=update, args=('first',))
+    first.start()
+    # wait until the first bio is being sent
+    time.sleep(0.05)
+    later = [threading.Thread(target=update, args=(bio,)) for bio in ('second', 'third', 'last')]
+    for thread in later:
+        thread.start()
+        time.sleep(0.01)
+    for thread in [first] + later:
+        thread.join(5)
+    assert bios == ['first', 'last']
+    assert results == {'first': True, 'second': True, 'third': True, 'last': True}
+    messenger.close()
+
+
+def test_the_same_bio_is_not_sent_again(ds_server):
+    server = ds_server()
+    bios = recording(server)
+    metrics = Metrics()
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, metrics=metrics)
+    assert messenger.bio('same') is True
+    assert messenger.bio('same') is True
+    assert bios == ['same']
+    assert metrics.snapshot()["counters"]["bios_skipped"] == 1
+    messenger.close()
@@ -0,0 +1,29 @@
+import asyncio
+import queue
+import threading
+
+from ds_daemon import _poll_accounts
+from ds_server import LocalDSServer
+
+
+def test_stop_delivers_polls_in_flight():
+    async def scenario():
+        server = LocalDSServer(port=0, latency=0.3)
+        await server.start()
+        server.handle_request({"join": {"username": "ana", "password": "pw", "token": ""}})
+        server._mailboxes["ana"].append({"message": "hi", "from": "bo", "timestamp": "1.0"})
+        account = {"username": "ana", "password": "pw", "server": "127.0.0.1", "port": server.port}
+        results = queue.Queue()
+        stop = threading.Event()
+        poll = asyncio.create_task(_poll_accounts([account], 0.01, 5.0, 4, None, results, stop))
+        # the join takes 0.3 s, so the retrieval is waiting for its response by now
+        await asyncio.sleep(0.45)
+        stop.set()
+        await asyncio.wait_for(poll, 5)
+        await server.close()
+        return [results.get_nowait() for _ in range(results.qsize())], server
+
+    items, server = asyncio.run(scenario())
+    delivered = [item for item in items if item[0] == 'messages']
+    assert delivered == [('messages', 'ana', [('bo', 'hi', 1.0)])]
+    assert server._read["ana"] == 1
@@ -0,0 +1,194 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import ds_messenger
+from ds_failover import CircuitBreaker, connect_any
+from ds_server import LocalDSServer
+
+
+def refused_address():
+    # a port that was just free, so nothing is listening on it
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+class ScriptedServer:
+    """
+    Answers one connection after another with LocalDSServer. Each plan is (answered, drop): the connection is closed
+    after answering that many requests, either at once or, if drop is True, after handling one more request without
+    answering it, as if the response were lost. The first request other than a join is answered
+    after delay seconds.
+    """
+    def __init__(self, plans, delay=0.0):
+        self.server = LocalDSServer()
+        self.delay = delay
+        self.requests = []
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.closed = [threading.Event() for _ in plans]
+        self.plans = plans
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        for (answered, drop), closed in zip(self.plans, self.closed):
+            conn, _ = self.listener.accept()
+            with conn, conn.makefile('rwb') as f:
+                for _ in range(answered):
+                    line = f.readline()
+                    if not line:
+                        break
+                    request = json.loads(line)
+                    self.requests.append(request)
+                    response = self.server.handle_request(request)
+                    if 'join' not in request:
+                        time.sleep(self.delay)
+                        self.delay = 0.0
+                    try:
+                        f.write((json.dumps(response) + '\n').encode())
+                        f.flush()
+                    except OSError:
+                        break
+                line = f.readline() if drop else None
+                if line:
+                    self.server.handle_request(json.loads(line))
+            closed.set()
+        self.listener.close()
+
+    def posts(self, recipient):
+        return len(self.server._mailboxes.get(recipient, []))
+
+
+def test_breaker_opens_and_half_opens():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+    breaker.failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open' and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+
+
+def test_open_breaker_never_blocks_the_last_address():
+    address = refused_address()
+    breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+    breaker.failure()
+    assert not breaker.allow()
+    with pytest.raises(ConnectionRefusedError):
+        connect_any([address], timeout=2, breakers={address: breaker})
+
+
+def test_open_breaker_skipped_while_another_is_allowed():
+    dead = refused_address()
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    alive = listener.getsockname()
+    breakers = {dead: CircuitBreaker(threshold=1, reset_timeout=60), alive: CircuitBreaker()}
+    breakers[dead].failure()
+    try:
+        sock, address = connect_any([dead, alive], timeout=2, breakers=breakers)
+        sock.close()
+    finally:
+        listener.close()
+    assert address == alive
+    assert breakers[dead].failures == 1
+
+
+def test_failures_count_once_per_call():
+    address = refused_address()
+    breakers = {address: CircuitBreaker()}
+    failed = set()
+    for _ in range(3):
+        with pytest.raises(ConnectionRefusedError):
+            connect_any([address], timeout=2, breakers=breakers, failed=failed)
+    assert breakers[address].failures == 1
+    assert breakers[address].state == 'closed'
+
+
+def test_messenger_retries_count_as_one_failure(capsys):
+    host, port = refused_address()
+    messenger = ds_messenger.DirectMessenger(host, 'ana', 'pw', port=port, retries=3)
+    assert messenger.send('hi', 'bo') is False
+    assert messenger.breakers[(host, port)].failures == 1
+    assert messenger.breakers[(host, port)].state == 'closed'
+
+
+def test_closed_session_is_replaced_before_sending():
+    # the first connection is closed right after the join, as a server closing an idle connection would
+    server = ScriptedServer([(1, False), (1, False)])
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, retries=0)
+    messenger.open()
+    assert server.closed[0].wait(2)
+    assert messenger.send('hi', 'bo') is True
+    messenger.close()
+    assert server.posts('bo') == 1
+
+
+def test_post_not_sent_twice_when_the_response_is_lost(capsys):
+    # the first connection handles the post and closes without answering it, the second would answer it again
+    server = ScriptedServer([(1, True), (2, False)])
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, retries=0)
+    messenger.open()
+    assert messenger.send('hi', 'bo') is False
+    assert server.closed[0].wait(2)
+    messenger.close()
+    assert server.posts('bo') == 1
+
+
+def forget_tokens(server):
+    # what a restart of the DS server does to the tokens it gave out
+    server._tokens.clear()
+    server._user_tokens.clear()
+
+
+@pytest.mark.parametrize("session", [False, True])
+def test_pipelined_posts_rejoin_when_the_token_is_rejected(ds_server, session):
+    server = ds_server()
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, retries=0)
+    if session:
+        messenger.open()
+    assert messenger.send_outcomes([('one', 'bo')]) == [True]
+    forget_tokens(server)
+    assert messenger.send_outcomes([('two', 'bo'), ('three', 'bo')], window=2) == [True, True]
+    forget_tokens(server)
+    assert messenger.send_many([('four', 'bo')]) == [True]
+    messenger.close()
+    assert [dm["message"] for dm in server._mailboxes['bo']] == ['one', 'two', 'three', 'four']
+
+
+def test_new_messages_not_retrieved_twice_after_a_timeout(capsys):
+    # the first 'new' is answered after the client gave up on it, and marks the message read
+    server = ScriptedServer([(2, False), (2, False)], delay=0.5)
+    server.server.handle_request({"join": {"username": "ana", "password": "pw", "token": ""}})
+    server.server._mailboxes["ana"].append({"message": "hi", "from": "bo", "timestamp": "1.0"})
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, retries=0, timeout=0.3)
+    messenger.open()
+    assert list(messenger.iter_new()) == []
+    time.sleep(0.8)
+    messenger.close()
+    assert [request["directmessage"] for request in server.requests if "directmessage" in request] == ['new']
+    assert "Fail to receive" in capsys.readouterr().out
+
+
+def test_all_messages_retrieved_again_after_a_timeout(capsys):
+    server = ScriptedServer([(2, False), (1, False)], delay=0.4)
+    server.server.handle_request({"join": {"username": "ana", "password": "pw", "token": ""}})
+    server.server._mailboxes["ana"].append({"message": "hi", "from": "bo", "timestamp": "1.0"})
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, retries=0, timeout=0.3)
+    messenger.open()
+    assert [dm.message for dm in messenger.iter_all()] == ['hi']
+    messenger.close()
+    assert [request["directmessage"] for request in server.requests if "directmessage" in request] == \
+        ['all', 'all']
@@ -0,0 +1,111 @@
+import pytest
+
+from ds_framing import FrameTooLarge, LineFramer
+
+
+class FakeSocket:
+    """
+    Hands out the chunks it was given, one per recv_into, then reports the connection closed.
+    """
+    def __init__(self, chunks):
+        self.chunks = [bytes(chunk) for chunk in chunks]
+        self.sent = []
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        n = min(len(chunk), len(view))
+        view[:n] = chunk[:n]
+        if n < len(chunk):
+            self.chunks.insert(0, chunk[n:])
+        return n
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+    def close(self):
+        pass
+
+
+def test_read_frame_splits_lines():
+    framer = LineFramer(FakeSocket([b'{"a": 1}\n{"b"', b': 2}\n\n']))
+    assert framer.read_frame() == b'{"a": 1}'
+    assert framer.read_frame() == b'{"b": 2}'
+    assert framer.read_frame() == b''
+
+
+def test_read_frame_grows_buffer():
+    frame = b'x' * 1000
+    framer = LineFramer(FakeSocket([frame[i:i + 7] for i in range(0, len(frame), 7)] + [b'\nend\n']), buffer_size=16)
+    assert framer.read_frame() == frame
+    assert framer.read_frame() == b'end'
+
+
+def test_read_frame_compacts_buffer():
+    framer = LineFramer(FakeSocket([b'abcdefghij\nklm', b'nopqrstuvwxyz\n']), buffer_size=16)
+    assert framer.read_frame() == b'abcdefghij'
+    assert framer.read_frame() == b'klmnopqrstuvwxyz'
+
+
+def test_read_frame_max_frame():
+    framer = LineFramer(FakeSocket([b'y' * 64, b'y' * 64, b'\n']), buffer_size=32, max_frame=100)
+    with pytest.raises(FrameTooLarge):
+        framer.read_frame()
+
+
+def test_read_frame_at_max_frame():
+    framer = LineFramer(FakeSocket([b'y' * 100 + b'\n']), buffer_size=32, max_frame=101)
+    assert framer.read_frame() == b'y' * 100
+
+
+def test_read_frame_closed():
+    framer = LineFramer(FakeSocket([b'{"partial"']))
+    with pytest.raises(ConnectionError):
+        framer.read_frame()
+
+
+def test_read_text_multibyte_split():
+    data = 'héllo wörld €'.encode()
+    # cut the euro sign and the first é in the middle of their bytes
+    cuts = [2, data.index('€'.encode()) + 1]
+    chunks = [data[:cuts[0]], data[cuts[0]:cuts[1]], data[cuts[1]:] + b'\n']
+    framer = LineFramer(FakeSocket(chunks))
+    text = ''
+    while True:
+        part = framer.read_text(4)
+        if not part:
+            break
+        text += part
+    assert text == 'héllo wörld €'
+
+
+def test_read_text_across_buffer_growth():
+    message = 'ü' * 500
+    data = message.encode() + b'\n' + b'next\n'
+    framer = LineFramer(FakeSocket([data[i:i + 5] for i in range(0, len(data), 5)]), buffer_size=8)
+    parts = []
+    while True:
+        part = framer.read_text(3)
+        if not part:
+            break
+        parts.append(part)
+    assert ''.join(parts) == message
+    assert framer.read_frame() == b'next'
+
+
+def test_read_text_closed():
+    framer = LineFramer(FakeSocket([b'unfinished']))
+    assert framer.read_text(100) == 'unfinished'
+    with pytest.raises(ConnectionError):
+        framer.read_text(100)
+
+
+def test_write_frame_queues_until_flush():
+    sock = FakeSocket([])
+    framer = LineFramer(sock)
+    framer.write_frame('{"a": 1}', flush=False)
+    framer.write_frame('{"b": 2}', flush=False)
+    assert sock.sent == []
+    framer.flush()
+    assert sock.sent == [b'{"a": 1}\n{"b": 2}\n']
@@ -0,0 +1,44 @@
+import ds_messenger
+from ds_governor import Governor
+
+
+class RecordingGovernor(Governor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.released = []
+
+    def release(self, ok=None, latency=None):
+        self.released.append((ok, latency))
+        super().release(ok, latency)
+
+
+def test_burst_and_in_flight_cap():
+    governor = Governor(rate=1.0, burst=2.0, max_in_flight=5)
+    assert governor.try_acquire() == 0.0
+    assert governor.try_acquire() == 0.0
+    assert governor.try_acquire() > 0.0
+    governor = Governor(rate=1000.0, burst=10.0, max_in_flight=1)
+    assert governor.try_acquire() == 0.0
+    assert governor.try_acquire() > 0.0
+    governor.release(True, 0.01)
+    assert governor.try_acquire() == 0.0
+
+
+def test_errors_cut_the_rate():
+    governor = Governor(rate=100.0, decrease=0.5)
+    governor.try_acquire()
+    governor.release(False)
+    assert governor.rate == 50.0
+    assert governor.stats()["errors"] == 1
+
+
+def test_pipelined_posts_report_their_latency(ds_server):
+    server = ds_server(latency=0.02)
+    governor = RecordingGovernor(rate=1000.0, burst=1000.0, max_in_flight=4)
+    messenger = ds_messenger.DirectMessenger('127.0.0.1', 'ana', 'pw', port=server.port, governor=governor)
+    assert messenger.send_many([('hi ' + str(i), 'bo') for i in range(12)]) == [True] * 12
+    posts = governor.released[-12:]
+    assert all(ok is True for ok, _ in posts)
+    # each post waits for the server's 20 ms and, behind it, the ones written before it
+    assert all(latency is not None and latency >= 0.015 for _, latency in posts)
+    assert governor.stats()["in_flight"] == 0
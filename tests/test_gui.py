@@ -0,0 +1,160 @@
+import threading
+import time
+import types
+
+import ds_roster
+import ds_store
+from ds_messenger import DirectMessage, MessageBatch
+from Final_Project_GUI import BackgroundWorker, Body
+
+
+class FakeTree:
+    def __init__(self):
+        self.selected = ()
+        # iid -> text, values and tags, and the iids in the order shown
+        self.items = {}
+        self.order = []
+
+    def get_children(self):
+        return tuple(self.order)
+
+    def exists(self, iid):
+        return iid in self.items
+
+    def insert(self, parent, position, iid, **options):
+        self.items[iid] = options
+        self.order.insert(position, iid)
+
+    def item(self, iid, **options):
+        self.items[iid].update(options)
+
+    def move(self, iid, parent, position):
+        self.order.remove(iid)
+        self.order.insert(position, iid)
+
+    def delete(self, *iids):
+        for iid in iids:
+            del self.items[iid]
+            self.order.remove(iid)
+
+    def selection(self):
+        return self.selected
+
+    def selection_set(self, item):
+        self.selected = (item,)
+
+    def selection_remove(self, *items):
+        self.selected = tuple(item for item in self.selected if item not in items)
+
+
+class FakeText:
+    def __init__(self):
+        self.text = ''
+        self.deletes = 0
+
+    def delete(self, *args):
+        self.text = ''
+        self.deletes += 1
+
+    def insert(self, index, text, *tags):
+        self.text = text + self.text if index == 0.0 else self.text + text
+
+    def see(self, *args):
+        pass
+
+
+class FakeScrollbar:
+    def set(self, first, last):
+        pass
+
+
+def fake_body():
+    body = types.SimpleNamespace(user_tree=FakeTree(), message_reader=FakeText(), selected=None, _shown_user=None,
+                                 _shown_from=0, shown=[], _format_message=lambda dm: '')
+    body.show_conversation = lambda user: (body.shown.append(user), setattr(body, '_shown_user', user))
+    for name in ('node_select', 'show_search_results', '_clear_selection'):
+        setattr(body, name, types.MethodType(getattr(Body, name), body))
+    return body
+
+
+def test_reselecting_after_search_shows_the_conversation():
+    body = fake_body()
+    body.user_tree.selection_set('alice')
+    body.node_select(None)
+    assert body.shown == ['alice']
+    # a redraw selecting the same row again does nothing
+    body.node_select(None)
+    assert body.shown == ['alice']
+
+    body.show_search_results('hi', [])
+    assert body.user_tree.selection() == ()
+    body.user_tree.selection_set('alice')
+    body.node_select(None)
+    assert body.shown == ['alice', 'alice']
+
+
+class FakeRoot:
+    def after(self, ms, func):
+        pass
+
+
+def test_local_work_does_not_wait_for_network_calls():
+    worker = BackgroundWorker(FakeRoot())
+    release = threading.Event()
+    results = []
+    worker.submit(release.wait, 5, on_done=lambda result, error: results.append('network'))
+    worker.submit(lambda: 'found', local=True, on_done=lambda result, error: results.append(result))
+    deadline = time.monotonic() + 5
+    while not results and time.monotonic() < deadline:
+        time.sleep(0.01)
+        worker._drain()
+    assert results == ['found']
+    release.set()
+    worker.shutdown()
+
+
+def rendering_body(store):
+    body = types.SimpleNamespace(user_tree=FakeTree(), message_reader=FakeText(), user_tree_scrollbar=FakeScrollbar(),
+                                 store=store, roster=ds_roster.Roster(), selected=None,
+                                 _shown_user=None, _shown_from=0, _conversations={}, _cursors={}, _roster_top=0,
+                                 _roster_rows=20, _roster_pending=False, WINDOW=Body.WINDOW, idle=[])
+    body.after_idle = body.idle.append
+    for name in ('add_messages', 'show_conversation', 'set_users', '_schedule_roster', '_draw_roster',
+                 '_format_message', '_format_activity'):
+        setattr(body, name, types.MethodType(getattr(Body, name), body))
+    return body
+
+
+def run_idle(body):
+    while body.idle:
+        body.idle.pop(0)()
+
+
+def test_incremental_rendering_and_roster_order():
+    store = ds_store.MessageStore()
+    store.add(MessageBatch([DirectMessage('alice', 'a1', 100.0), DirectMessage('bob', 'b1', 200.0),
+                            DirectMessage('alice', 'a2', 300.0)]))
+    body = rendering_body(store)
+    body.set_users()
+    assert body.user_tree.get_children() == ('alice', 'bob')
+
+    body.show_conversation('bob')
+    assert body.message_reader.text.count('\n') == 1 and 'b1' in body.message_reader.text
+    deletes = body.message_reader.deletes
+
+    # a message of the conversation shown is appended without rendering the conversation again
+    store.add(MessageBatch([DirectMessage('bob', 'b2', 400.0)]))
+    body.add_messages([DirectMessage('bob', 'b2', 400.0)])
+    run_idle(body)
+    assert body.message_reader.deletes == deletes
+    assert body.message_reader.text.index('b1') < body.message_reader.text.index('b2')
+    assert body.user_tree.get_children() == ('bob', 'alice')
+    assert body.roster.unread('bob') == 0
+
+    # a message of another conversation counts as unread and moves its sender to the top
+    body.add_messages([DirectMessage('alice', 'a3', 500.0), DirectMessage('carol', 'c1', 450.0)])
+    run_idle(body)
+    assert body.user_tree.get_children() == ('alice', 'carol', 'bob')
+    assert body.user_tree.items['alice']['values'][0] == 1
+    assert 'a3' not in body.message_reader.text
+    assert body.user_tree.items['alice']['tags'] == ('unread',)
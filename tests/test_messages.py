@@ -0,0 +1,36 @@
+import json
+from collections.abc import Mapping
+
+from ds_messenger import DirectMessage, MessageBatch
+
+
+def test_direct_message_mapping():
+    dm = DirectMessage('ana', 'hi', 1.5)
+    assert isinstance(dm, Mapping)
+    assert 'message' in dm
+    assert 'from' not in dm
+    assert list(dm) == ['recipient', 'message', 'timestamp']
+    assert list(dm.values()) == ['ana', 'hi', 1.5]
+    assert dict(dm.items()) == dict(dm) == {'recipient': 'ana', 'message': 'hi', 'timestamp': 1.5}
+    assert len(dm) == 3
+    assert dm == {'recipient': 'ana', 'message': 'hi', 'timestamp': 1.5}
+    assert dm != {'recipient': 'ana', 'message': 'hi', 'timestamp': 1.5, 'extra': 1}
+
+
+def test_batch_equals_list():
+    batch = MessageBatch([{'recipient': 'ana', 'message': 'hi', 'timestamp': 1}])
+    batch.append('bo', 'yo', '2.5')
+    expected = [{'recipient': 'ana', 'message': 'hi', 'timestamp': 1.0},
+                {'recipient': 'bo', 'message': 'yo', 'timestamp': 2.5}]
+    assert batch == expected
+    assert batch != expected[:1]
+    assert MessageBatch() == []
+    assert batch[1:] == MessageBatch([expected[1]])
+
+
+def test_batch_to_list():
+    batch = MessageBatch()
+    batch.append('ana', 'hi', 1)
+    result = batch.to_list()
+    assert isinstance(result, list)
+    assert json.loads(json.dumps(result)) == [{'recipient': 'ana', 'message': 'hi', 'timestamp': 1.0}]
@@ -0,0 +1,111 @@
+import json
+import threading
+
+import ds_outbox
+from ds_outbox import FAILED, QUEUED, SENT, Outbox
+
+
+class FakeMessenger:
+    """
+    Answers each batch with the outcome outcome(message) gives every message in it, and remembers the batches.
+    """
+    def __init__(self, outcome=lambda message: True):
+        self.outcome = outcome
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def send_outcomes(self, messages, window=256):
+        with self.lock:
+            self.batches.append(list(messages))
+        return [self.outcome(message) for message, _, _ in messages]
+
+
+def log_records(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_sends_and_compacts(tmp_path):
+    path = str(tmp_path / 'ana.outbox')
+    statuses = []
+    with Outbox(FakeMessenger(), path, on_status=lambda i, status: statuses.append((i, status))) as outbox:
+        ids = [outbox.send('hi ' + str(i), 'bo') for i in range(3)]
+        assert outbox.flush(5)
+        assert [outbox.status(i) for i in ids] == [SENT] * 3
+    assert sorted(statuses) == [(i, SENT) for i in ids]
+    # once nothing is queued the log holds nothing
+    assert log_records(path) == []
+
+
+def test_replays_queued_messages(tmp_path):
+    path = str(tmp_path / 'ana.outbox')
+    down = FakeMessenger(lambda message: None)
+    outbox = Outbox(down, path, backoff=60)
+    first = outbox.send('one', 'bo')
+    second = outbox.send('two', 'cy')
+    assert not outbox.flush(0.2)
+    outbox.close()
+    assert [record["op"] for record in log_records(path)] == ['add', 'add']
+
+    up = FakeMessenger()
+    with Outbox(up, path) as outbox:
+        assert outbox.flush(5)
+        assert outbox.status(first) == outbox.status(second) == SENT
+        # ids go on from the ones in the log
+        assert outbox.send('three', 'bo') > second
+        assert outbox.flush(5)
+    assert [(message, recipient) for batch in up.batches for message, recipient, _ in batch] == \
+        [('one', 'bo'), ('two', 'cy'), ('three', 'bo')]
+    assert log_records(path) == []
+
+
+def test_compaction_keeps_only_queued(tmp_path):
+    path = str(tmp_path / 'ana.outbox')
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in (1, 2, 3):
+            f.write(json.dumps({"op": "add", "id": i, "message": str(i), "recipient": "bo", "timestamp": 1.0}) + '\n')
+        f.write(json.dumps({"op": SENT, "id": 1}) + '\n')
+        f.write(json.dumps({"op": FAILED, "id": 3}) + '\n')
+        # a line cut short when the process stopped
+        f.write('{"op": "add", "id": 4, "mess')
+    outbox = Outbox(FakeMessenger(lambda message: None), path, backoff=60)
+    try:
+        assert outbox.pending() == 1
+        assert [record["id"] for record in log_records(path)] == [2]
+    finally:
+        outbox.close()
+
+
+def test_rejected_fail_at_once_without_holding_the_queue(tmp_path):
+    messenger = FakeMessenger(lambda message: message != 'bad')
+    with Outbox(messenger, str(tmp_path / 'ana.outbox'), backoff=60) as outbox:
+        bad = outbox.send('bad', 'bo')
+        assert outbox.flush(5)
+        assert outbox.status(bad) == FAILED
+        good = outbox.send('good', 'bo')
+        assert outbox.flush(5)
+        assert outbox.status(good) == SENT
+    assert len(messenger.batches) == 2
+
+
+def test_lost_messages_hold_the_queue(tmp_path):
+    messenger = FakeMessenger(lambda message: None)
+    with Outbox(messenger, None, backoff=60, max_attempts=3) as outbox:
+        message_id = outbox.send('hi', 'bo')
+        assert not outbox.flush(0.2)
+        assert outbox.status(message_id) == QUEUED
+        assert outbox._hold_until > 0
+    assert len(messenger.batches) == 1
+
+
+def test_gives_up_after_max_attempts():
+    messenger = FakeMessenger(lambda message: None)
+    with Outbox(messenger, None, backoff=0.01, max_attempts=2) as outbox:
+        message_id = outbox.send('hi', 'bo')
+        assert outbox.flush(5)
+        assert outbox.status(message_id) == FAILED
+    assert len(messenger.batches) == 2
+
+
+def test_default_path():
+    assert ds_outbox.default_path('1.2.3.4', 'ana').endswith('1.2.3.4_ana.outbox')
@@ -0,0 +1,51 @@
+import time
+import tkinter
+
+import ds_outbox
+import ds_profiler
+from ds_profiler import OfflineMessenger, StallMonitor, synthetic_store
+
+
+class FakeRoot:
+    def after(self, ms, func):
+        return 'after#1'
+
+    def after_cancel(self, after_id):
+        pass
+
+
+def slow_callback():
+    time.sleep(0.03)
+
+
+def test_synthetic_store_gives_every_sender_the_same_count():
+    store = synthetic_store(5, 7, seed=1)
+    activity = store.sender_activity()
+    assert sorted(sender for sender, _, _ in activity) == ['user' + str(i) for i in range(5)]
+    assert all(count == 7 for _, count, _ in activity)
+
+
+def test_offline_messenger_fails_sends_at_once():
+    store = synthetic_store(1, 1, seed=1)
+    statuses = []
+    with ds_outbox.Outbox(OfflineMessenger('synthetic', store), max_attempts=1,
+                          on_status=lambda i, status: statuses.append(status)) as outbox:
+        outbox.send('hi', 'user0')
+        assert outbox.flush(5)
+    assert statuses == [ds_outbox.FAILED]
+
+
+def test_callbacks_registered_before_start_are_timed():
+    # Tk keeps a CallWrapper for every callback it was given, and calls it when the callback runs
+    wrapper = tkinter.CallWrapper(slow_callback, None, None)
+    monitor = StallMonitor(FakeRoot(), threshold=0.02)
+    monitor.start()
+    try:
+        wrapper()
+    finally:
+        monitor.stop()
+    report = monitor.report()
+    assert [callback["name"].rpartition('.')[2] for callback in report["callbacks"]] == ['slow_callback']
+    assert report["stalls"] == 1
+    # stop puts the original back
+    assert tkinter.CallWrapper.__call__ is ds_profiler._original_call
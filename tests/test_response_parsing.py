@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from ds_messenger import DirectMessage, iter_response_messages
+
+
+def reader(text):
+    """
+    Returns a read function handing out a response line the way LineFramer.read_text does.
+    """
+    state = {"pos": 0}
+
+    def read(size):
+        start = state["pos"]
+        if text.startswith('\n', start):
+            # the end of the line
+            state["pos"] += 1
+            return ''
+        end = text.find('\n', start, start + size)
+        state["pos"] = end if end >= 0 else min(len(text), start + size)
+        return text[start:state["pos"]]
+    return read
+
+
+MESSAGES = [{"message": "hello [there]", "from": "ana", "timestamp": "1603167689.3928561"},
+            {"message": "a \"quoted\", {braced} one", "from": "bo", "timestamp": 1603167690},
+            {"message": "ünïcödé ✓", "from": "cy", "timestamp": "1603167691.5"}]
+
+EXPECTED = [DirectMessage("ana", "hello [there]", 1603167689.3928561),
+            DirectMessage("bo", "a \"quoted\", {braced} one", 1603167690.0),
+            DirectMessage("cy", "ünïcödé ✓", 1603167691.5)]
+
+
+def response(messages):
+    return json.dumps({"response": {"type": "ok", "messages": messages}}, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("chunk_size", range(1, 40))
+def test_split_across_chunks(chunk_size):
+    # every chunk size up to 40 splits the "messages" key, the [ and the messages in a different place
+    assert list(iter_response_messages(reader(response(MESSAGES)), chunk_size)) == EXPECTED
+
+
+def test_key_and_bracket_split():
+    text = response(MESSAGES)
+    key = text.index('"messages"')
+    bracket = text.index('[')
+    chunks = [text[:key + 4], text[key + 4:bracket], text[bracket:bracket + 1], text[bracket + 1:]]
+
+    def read(size):
+        return chunks.pop(0) if chunks else ''
+    assert list(iter_response_messages(read)) == EXPECTED
+
+
+def test_whitespace_in_array():
+    text = '{"response": {"type": "ok", "messages": [  {"message": "hi", "from": "ana", "timestamp": "1"} ,\t]}}'
+    assert list(iter_response_messages(reader(text), 8)) == [DirectMessage("ana", "hi", 1.0)]
+
+
+def test_empty():
+    assert list(iter_response_messages(reader(response([])), 3)) == []
+
+
+def test_reads_rest_of_line():
+    read = reader(response(MESSAGES) + '\n{"next": 1}')
+    assert list(iter_response_messages(read, 16)) == EXPECTED
+    assert read(100) == '{"next": 1}'
+
+
+def test_error_response():
+    text = json.dumps({"response": {"type": "error", "message": "Invalid token."}})
+    with pytest.raises(ValueError):
+        list(iter_response_messages(reader(text), 7))
+
+
+def test_truncated():
+    text = response(MESSAGES)
+    cut = text.index('"from": "bo"')
+    messages = iter_response_messages(reader(text[:cut]), 10)
+    assert next(messages) == EXPECTED[0]
+    with pytest.raises(ValueError):
+        list(messages)
+
+
+def test_truncated_before_array():
+    with pytest.raises(ValueError):
+        list(iter_response_messages(reader('{"response": {"type": "ok", "mess'), 4))
@@ -0,0 +1,77 @@
+import pytest
+
+from ds_roster import ACTIVITY, ADDED, NAME, Roster
+
+
+def make_roster(order=ACTIVITY):
+    roster = Roster(order)
+    roster.add('carol', 2, 30.0)
+    roster.add('alice', 1, 10.0)
+    roster.add('Bob', 0, 20.0)
+    return roster
+
+
+def test_activity_order():
+    roster = make_roster()
+    assert roster.rows(0, 10) == ['carol', 'Bob', 'alice']
+    roster.message('alice', 40.0)
+    assert roster.rows(0, 10) == ['alice', 'carol', 'Bob']
+    # an older message counts, but does not move its sender
+    roster.message('Bob', 5.0)
+    assert roster.rows(0, 10) == ['alice', 'carol', 'Bob']
+    assert roster.count('Bob') == 1
+
+
+def test_activity_ties_keep_the_order_added():
+    roster = Roster()
+    for name in ('zed', 'amy', 'kim'):
+        roster.add(name)
+    assert roster.rows(0, 3) == ['zed', 'amy', 'kim']
+
+
+def test_name_order():
+    roster = make_roster(NAME)
+    assert roster.rows(0, 10) == ['alice', 'Bob', 'carol']
+    roster.message('dave', 50.0)
+    roster.message('alice', 60.0)
+    assert roster.rows(0, 10) == ['alice', 'Bob', 'carol', 'dave']
+
+
+def test_added_order():
+    roster = make_roster(ADDED)
+    roster.message('alice', 99.0)
+    assert roster.rows(0, 10) == ['carol', 'alice', 'Bob']
+
+
+def test_set_order_and_index():
+    roster = make_roster()
+    roster.set_order(NAME)
+    assert roster.rows(0, 10) == ['alice', 'Bob', 'carol']
+    assert roster.index('carol') == 2
+    assert roster.index('nobody') == -1
+    roster.set_order(ACTIVITY)
+    assert roster.rows(1, 2) == ['Bob']
+    assert roster.index('carol') == 0
+    with pytest.raises(ValueError):
+        roster.set_order('size')
+
+
+def test_unread_counts():
+    roster = Roster()
+    roster.message('alice', 1.0)
+    roster.message('alice', 2.0)
+    roster.message('alice', 3.0, unread=False)
+    assert (roster.count('alice'), roster.unread('alice'), roster.last_activity('alice')) == (3, 2, 3.0)
+    version = roster.version
+    roster.mark_read('alice')
+    assert roster.unread('alice') == 0 and roster.version > version
+    version = roster.version
+    roster.mark_read('alice')
+    assert roster.version == version
+
+
+def test_add_twice():
+    roster = Roster()
+    assert roster.add('alice')
+    assert not roster.add('alice')
+    assert len(roster) == 1 and 'alice' in roster